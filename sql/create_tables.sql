@@ -242,4 +242,69 @@ CREATE INDEX IF NOT EXISTS idx_block_blocknumber_desc ON blocks (blocknumber DES
 CREATE INDEX IF NOT EXISTS idx_block_hash ON blocks (hash);
 CREATE INDEX IF NOT EXISTS idx_block_parent_hash ON blocks (parent_hash);
 
-UPDATE database_version SET version_number = 25;
+CREATE OR REPLACE FUNCTION notify_eth_address_change() RETURNS TRIGGER AS $$
+DECLARE
+    still_registered BOOLEAN;
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM pg_notify(TG_TABLE_NAME, 'add:' || NEW.eth_address);
+    ELSIF TG_OP = 'DELETE' THEN
+        -- only notify about removals when there are no more
+        -- registrations left for the address
+        EXECUTE format('SELECT EXISTS (SELECT 1 FROM %I WHERE eth_address = $1)', TG_TABLE_NAME)
+            INTO still_registered USING OLD.eth_address;
+        IF NOT still_registered THEN
+            PERFORM pg_notify(TG_TABLE_NAME, 'remove:' || OLD.eth_address);
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_notification_registrations_notify ON notification_registrations;
+CREATE TRIGGER trg_notification_registrations_notify
+    AFTER INSERT OR DELETE ON notification_registrations
+    FOR EACH ROW EXECUTE PROCEDURE notify_eth_address_change();
+
+DROP TRIGGER IF EXISTS trg_token_registrations_notify ON token_registrations;
+CREATE TRIGGER trg_token_registrations_notify
+    AFTER INSERT OR DELETE ON token_registrations
+    FOR EACH ROW EXECUTE PROCEDURE notify_eth_address_change();
+
+CREATE OR REPLACE FUNCTION notify_filter_registration_change() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM pg_notify(TG_TABLE_NAME, json_build_object(
+            'action', 'add', 'filter_id', NEW.filter_id, 'contract_address', NEW.contract_address,
+            'topic_id', NEW.topic_id, 'topic', NEW.topic)::text);
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify(TG_TABLE_NAME, json_build_object(
+            'action', 'remove', 'filter_id', OLD.filter_id, 'contract_address', OLD.contract_address,
+            'topic_id', OLD.topic_id)::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_filter_registrations_notify ON filter_registrations;
+CREATE TRIGGER trg_filter_registrations_notify
+    AFTER INSERT OR DELETE ON filter_registrations
+    FOR EACH ROW EXECUTE PROCEDURE notify_filter_registration_change();
+
+CREATE OR REPLACE FUNCTION notify_token_change() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM pg_notify(TG_TABLE_NAME, 'add:' || NEW.contract_address);
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify(TG_TABLE_NAME, 'remove:' || OLD.contract_address);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_tokens_notify ON tokens;
+CREATE TRIGGER trg_tokens_notify
+    AFTER INSERT OR DELETE ON tokens
+    FOR EACH ROW EXECUTE PROCEDURE notify_token_change();
+
+UPDATE database_version SET version_number = 28;
@@ -0,0 +1,28 @@
+CREATE OR REPLACE FUNCTION notify_eth_address_change() RETURNS TRIGGER AS $$
+DECLARE
+    still_registered BOOLEAN;
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM pg_notify(TG_TABLE_NAME, 'add:' || NEW.eth_address);
+    ELSIF TG_OP = 'DELETE' THEN
+        -- only notify about removals when there are no more
+        -- registrations left for the address
+        EXECUTE format('SELECT EXISTS (SELECT 1 FROM %I WHERE eth_address = $1)', TG_TABLE_NAME)
+            INTO still_registered USING OLD.eth_address;
+        IF NOT still_registered THEN
+            PERFORM pg_notify(TG_TABLE_NAME, 'remove:' || OLD.eth_address);
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_notification_registrations_notify ON notification_registrations;
+CREATE TRIGGER trg_notification_registrations_notify
+    AFTER INSERT OR DELETE ON notification_registrations
+    FOR EACH ROW EXECUTE PROCEDURE notify_eth_address_change();
+
+DROP TRIGGER IF EXISTS trg_token_registrations_notify ON token_registrations;
+CREATE TRIGGER trg_token_registrations_notify
+    AFTER INSERT OR DELETE ON token_registrations
+    FOR EACH ROW EXECUTE PROCEDURE notify_eth_address_change();
@@ -0,0 +1,19 @@
+CREATE OR REPLACE FUNCTION notify_filter_registration_change() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM pg_notify(TG_TABLE_NAME, json_build_object(
+            'action', 'add', 'filter_id', NEW.filter_id, 'contract_address', NEW.contract_address,
+            'topic_id', NEW.topic_id, 'topic', NEW.topic)::text);
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify(TG_TABLE_NAME, json_build_object(
+            'action', 'remove', 'filter_id', OLD.filter_id, 'contract_address', OLD.contract_address,
+            'topic_id', OLD.topic_id)::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_filter_registrations_notify ON filter_registrations;
+CREATE TRIGGER trg_filter_registrations_notify
+    AFTER INSERT OR DELETE ON filter_registrations
+    FOR EACH ROW EXECUTE PROCEDURE notify_filter_registration_change();
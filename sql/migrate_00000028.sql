@@ -0,0 +1,15 @@
+CREATE OR REPLACE FUNCTION notify_token_change() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM pg_notify(TG_TABLE_NAME, 'add:' || NEW.contract_address);
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify(TG_TABLE_NAME, 'remove:' || OLD.contract_address);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_tokens_notify ON tokens;
+CREATE TRIGGER trg_tokens_notify
+    AFTER INSERT OR DELETE ON tokens
+    FOR EACH ROW EXECUTE PROCEDURE notify_token_change();
@@ -0,0 +1,61 @@
+"""Cache of the account state (balance and nonces) the transaction queue works
+out for an address, shared between the manager workers using Redis.
+
+The state is only valid for the `last_blocknumber` it was worked out at, so a
+new block processed by the monitor makes it stale. Changes that can affect the
+state without a new block (transactions the queue didn't send itself, and
+unconfirmed transactions failing) invalidate it by incrementing the address's
+version, and reorgs invalidate every address's state by incrementing the
+global version.
+"""
+
+from tornado.escape import json_decode, json_encode
+from toshi.utils import parse_int
+
+ACCOUNT_STATE_KEY = "toshieth.account_state:{}"
+ACCOUNT_STATE_VERSION_KEY = "toshieth.account_state:{}:version"
+ACCOUNT_STATE_GLOBAL_VERSION_KEY = "toshieth.account_state:version"
+ACCOUNT_STATE_EXPIRY = 60
+# the version keys must outlive the states, so that a version can't
+# restart from 0 and match an old state
+ACCOUNT_STATE_VERSION_EXPIRY = 86400
+
+async def get_account_state(redis, address, blocknumber):
+    """Returns a tuple of (state, version) where state is a dict with the
+    `balance`, `nonce` and `network_nonce` of the address at the given
+    blocknumber, or None if there is no valid cached state. The version
+    should be passed to `set_account_state` when storing a new state"""
+
+    pipe = redis.pipeline()
+    pipe.get(ACCOUNT_STATE_KEY.format(address))
+    pipe.get(ACCOUNT_STATE_VERSION_KEY.format(address))
+    pipe.get(ACCOUNT_STATE_GLOBAL_VERSION_KEY)
+    state, address_version, global_version = await pipe.execute()
+    version = "{}:{}".format(parse_int(address_version) or 0, parse_int(global_version) or 0)
+    if state is None:
+        return None, version
+    state = json_decode(state)
+    if state['blocknumber'] != blocknumber or state['version'] != version:
+        return None, version
+    return state, version
+
+async def set_account_state(redis, address, blocknumber, version, *, balance, nonce, network_nonce):
+    """Stores the state of the address at the given blocknumber. If the state
+    has been invalidated since `version` was returned by `get_account_state`
+    the stored state will never be used"""
+
+    state = {'blocknumber': blocknumber, 'version': version,
+             'balance': balance, 'nonce': nonce, 'network_nonce': network_nonce}
+    tr = redis.multi_exec()
+    tr.set(ACCOUNT_STATE_KEY.format(address), json_encode(state), expire=ACCOUNT_STATE_EXPIRY)
+    tr.expire(ACCOUNT_STATE_VERSION_KEY.format(address), ACCOUNT_STATE_VERSION_EXPIRY)
+    await tr.execute()
+
+async def invalidate_account_state(redis, address):
+    tr = redis.multi_exec()
+    tr.incr(ACCOUNT_STATE_VERSION_KEY.format(address))
+    tr.expire(ACCOUNT_STATE_VERSION_KEY.format(address), ACCOUNT_STATE_VERSION_EXPIRY)
+    await tr.execute()
+
+async def invalidate_all_account_states(redis):
+    await redis.incr(ACCOUNT_STATE_GLOBAL_VERSION_KEY)
@@ -14,7 +14,22 @@ from toshi.jsonrpc.client import JsonRPCClient
 
 def extra_service_config():
     config.set_from_os_environ('ethereum', 'url', 'ETHEREUM_NODE_URL')
+    config.set_from_os_environ('ethereum', 'urls', 'ETHEREUM_NODE_URLS')
     config.set_from_os_environ('monitor', 'url', 'MONITOR_ETHEREUM_NODE_URL')
+    config.set_from_os_environ('monitor', 'urls', 'MONITOR_ETHEREUM_NODE_URLS')
+    config.set_from_os_environ('monitor', 'ws_url', 'MONITOR_ETHEREUM_NODE_WS_URL')
+    config.set_from_os_environ('monitor', 'transaction_shards', 'MONITOR_TRANSACTION_SHARDS')
+    config.set_from_os_environ('monitor', 'fetch_receipts', 'MONITOR_FETCH_RECEIPTS')
+    config.set_from_os_environ('monitor', 'block_events_maxlen', 'MONITOR_BLOCK_EVENTS_MAXLEN')
+    config.set_from_os_environ('monitor', 'batch_status_updates', 'MONITOR_BATCH_STATUS_UPDATES')
+    config.set_from_os_environ('monitor', 'gas_price_window', 'MONITOR_GAS_PRICE_WINDOW')
+    config.set_from_os_environ('monitor', 'gas_station_refresh_interval', 'MONITOR_GAS_STATION_REFRESH_INTERVAL')
+    config.set_from_os_environ('monitor_worker', 'shard', 'MONITOR_WORKER_SHARD')
+    # when a list of nodes is given, the first is used for anything that
+    # needs a single node
+    for section in ['ethereum', 'monitor']:
+        if section in config and 'urls' in config[section] and 'url' not in config[section]:
+            config[section]['url'] = config[section]['urls'].split(',')[0].strip()
     if 'ethereum' in config:
         if 'ETHEREUM_NETWORK_ID' in os.environ:
             config['ethereum']['network_id'] = os.environ['ETHEREUM_NETWORK_ID']
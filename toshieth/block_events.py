@@ -0,0 +1,152 @@
+"""A bounded Redis stream of per-block events published by the block monitor,
+so that other services can follow the chain (and the logs they care about)
+without each fetching the blocks and logs from the node themselves.
+
+Every processed block gets an entry with the fields:
+
+    type: "block"
+    number, hash, parent_hash: the block's details
+    logs: json object of address -> first topic -> list of
+          [transaction_hash, log_index, remaining topics, data]
+
+Only the logs for the token events in `toshieth.constants` and the logs that
+match a filter registration are included.
+
+When a reorg replaces a block that has already been published, an entry with
+`type` "retract" and the number and hash of the replaced block is added.
+
+Streams need Redis >= 5.0. As aioredis doesn't have stream commands yet the
+commands are sent using `execute`.
+"""
+
+from aioredis import ReplyError
+from tornado.escape import json_decode, json_encode
+from toshi.utils import parse_int
+
+from .constants import TRANSFER_TOPIC, DEPOSIT_TOPIC, WITHDRAWAL_TOPIC
+
+BLOCK_EVENTS_STREAM_KEY = "toshieth.monitor:block_events"
+# roughly the last few hours of blocks
+DEFAULT_BLOCK_EVENTS_MAXLEN = 1000
+BLOCK_EVENT_TOPICS = {TRANSFER_TOPIC, DEPOSIT_TOPIC, WITHDRAWAL_TOPIC}
+
+def group_block_logs(logs_list, registrations=None):
+    """Groups the relevant logs by address and first topic. Logs matching
+    filter registrations are only included if `registrations` is given and
+    ready"""
+
+    logs = {}
+    check_filters = registrations is not None and registrations.ready
+    for _log in logs_list:
+        if not _log['topics']:
+            continue
+        topic = _log['topics'][0]
+        if topic not in BLOCK_EVENT_TOPICS and \
+           not (check_filters and registrations.get_filters(_log['address'], topic)):
+            continue
+        logs.setdefault(_log['address'], {}).setdefault(topic, []).append(
+            [_log['transactionHash'], parse_int(_log['logIndex']), _log['topics'][1:], _log['data']])
+    return logs
+
+def build_block_event(block, logs_list, registrations=None):
+    """Returns the fields of the stream entry for the block"""
+
+    return {
+        'type': 'block',
+        'number': str(parse_int(block['number'])),
+        'hash': block['hash'],
+        'parent_hash': block['parentHash'],
+        'logs': json_encode(group_block_logs(logs_list, registrations))
+    }
+
+def build_retract_event(block_number, block_hash):
+    return {
+        'type': 'retract',
+        'number': str(block_number),
+        'hash': block_hash
+    }
+
+def decode_event(fields):
+    """Converts the flat [field, value, ...] list of a stream entry into
+    an event dict"""
+
+    if isinstance(fields, dict):
+        items = fields.items()
+    else:
+        items = zip(fields[::2], fields[1::2])
+    event = {}
+    for field, value in items:
+        if isinstance(field, bytes):
+            field = field.decode('utf-8')
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+        event[field] = value
+    event['number'] = int(event['number'])
+    if 'logs' in event:
+        event['logs'] = json_decode(event['logs'])
+    return event
+
+def parse_stream_entries(reply):
+    """Parses the reply of XREAD or XREADGROUP for a single stream into a
+    list of (entry_id, event) tuples"""
+
+    if not reply:
+        return []
+    _, entries = reply[0]
+    results = []
+    for entry_id, fields in entries:
+        if isinstance(entry_id, bytes):
+            entry_id = entry_id.decode('utf-8')
+        # entries that were deleted while pending come back without fields
+        results.append((entry_id, decode_event(fields) if fields else None))
+    return results
+
+async def publish_block_events(redis, events, maxlen=DEFAULT_BLOCK_EVENTS_MAXLEN):
+    """Adds the events (as returned by `build_block_event` and
+    `build_retract_event`) to the stream in order"""
+
+    for event in events:
+        args = []
+        for field, value in event.items():
+            args.extend((field, value))
+        await redis.execute(b'XADD', BLOCK_EVENTS_STREAM_KEY, b'MAXLEN', b'~', maxlen, b'*', *args)
+
+class BlockEventConsumer:
+    """Reads the block events stream as part of a consumer group, so that
+    multiple processes can share the work and entries aren't lost if a
+    consumer restarts before acknowledging them. Each entry should be
+    acknowledged with `ack` once it has been handled.
+    """
+
+    def __init__(self, redis, group, consumer, stream=BLOCK_EVENTS_STREAM_KEY):
+        self.redis = redis
+        self.group = group
+        self.consumer = consumer
+        self.stream = stream
+
+    async def create_group(self, start_id='$'):
+        """Creates the consumer group (and the stream if needed), starting from
+        `start_id`. Does nothing if the group already exists"""
+
+        try:
+            await self.redis.execute(b'XGROUP', b'CREATE', self.stream, self.group, start_id, b'MKSTREAM')
+        except ReplyError as e:
+            if not str(e).startswith('BUSYGROUP'):
+                raise
+
+    async def read(self, count=100, block=None, pending=False):
+        """Returns up to `count` (entry_id, event) tuples not yet delivered to
+        the group, waiting up to `block` milliseconds for new entries if given.
+
+        If `pending` is True, returns the entries already delivered to this
+        consumer that haven't been acknowledged (e.g. after a restart)"""
+
+        args = [b'GROUP', self.group, self.consumer, b'COUNT', count]
+        if block is not None:
+            args.extend((b'BLOCK', block))
+        args.extend((b'STREAMS', self.stream, '0' if pending else '>'))
+        return parse_stream_entries(await self.redis.execute(b'XREADGROUP', *args))
+
+    async def ack(self, *entry_ids):
+        if entry_ids:
+            await self.redis.execute(b'XACK', self.stream, self.group, *entry_ids)
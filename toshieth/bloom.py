@@ -0,0 +1,41 @@
+from functools import lru_cache
+from ethereum.utils import sha3
+from toshi.ethereum.utils import data_decoder
+
+BLOOM_BITS = 2048
+
+@lru_cache(maxsize=65536)
+def bloom_mask(value):
+    """Returns the bits (as an int) set in a logs bloom for the given hex
+    encoded address or topic"""
+
+    h = sha3(data_decoder(value.lower()))
+    mask = 0
+    for i in range(0, 6, 2):
+        mask |= 1 << (((h[i] << 8) | h[i + 1]) % BLOOM_BITS)
+    return mask
+
+def parse_logs_bloom(logs_bloom):
+    """Converts the hex encoded logsBloom of a block into an int so it can
+    be tested multiple times without re-parsing it"""
+
+    if isinstance(logs_bloom, int):
+        return logs_bloom
+    return int(logs_bloom, 16)
+
+def bloom_add(logs_bloom, *values):
+    logs_bloom = parse_logs_bloom(logs_bloom)
+    for value in values:
+        logs_bloom |= bloom_mask(value)
+    return logs_bloom
+
+def bloom_contains(logs_bloom, *values):
+    """Returns False if any of the values are definitely not in the bloom,
+    or True if all the values might be present"""
+
+    logs_bloom = parse_logs_bloom(logs_bloom)
+    for value in values:
+        mask = bloom_mask(value)
+        if logs_bloom & mask != mask:
+            return False
+    return True
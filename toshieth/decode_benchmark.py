@@ -0,0 +1,105 @@
+"""Micro-benchmark comparing `toshieth.events.decode_token_logs` with decoding
+the same logs using pyethereum's generic abi decoder:
+
+    python -m toshieth.decode_benchmark --logs 10000
+"""
+
+import argparse
+import os
+import random
+import time
+
+from ethereum.abi import decode_abi, decode_single
+from toshi.ethereum.utils import data_decoder
+
+from .constants import TRANSFER_TOPIC, DEPOSIT_TOPIC, WITHDRAWAL_TOPIC, WETH_CONTRACT_ADDRESS
+from .events import decode_token_logs, ZERO_ADDRESS
+from .utils import get_transaction_log_index
+
+def generate_logs(count, token_count=20):
+    """Generates a mix of indexed and non-indexed Transfer, and WETH Deposit
+    and Withdrawal logs"""
+
+    token_addresses = ["0x{}".format(os.urandom(20).hex()) for _ in range(token_count)]
+    logs_list = []
+    for i in range(count):
+        address_words = ["0" * 24 + os.urandom(20).hex() for _ in range(2)]
+        value_word = "{:064x}".format(random.randrange(2 ** 128))
+        kind = random.random()
+        if kind < 0.8:
+            _log = {"address": random.choice(token_addresses),
+                    "topics": [TRANSFER_TOPIC, "0x" + address_words[0], "0x" + address_words[1]],
+                    "data": "0x" + value_word}
+        elif kind < 0.9:
+            _log = {"address": random.choice(token_addresses),
+                    "topics": [TRANSFER_TOPIC],
+                    "data": "0x" + address_words[0] + address_words[1] + value_word}
+        else:
+            _log = {"address": WETH_CONTRACT_ADDRESS,
+                    "topics": [random.choice([DEPOSIT_TOPIC, WITHDRAWAL_TOPIC]), "0x" + address_words[0]],
+                    "data": "0x" + value_word}
+        _log['transactionHash'] = "0x{}".format(os.urandom(32).hex())
+        _log['transactionLogIndex'] = hex(i % 10)
+        logs_list.append(_log)
+    return logs_list, set(token_addresses)
+
+def generic_decode_token_logs(logs_list, known_tokens):
+    """Decodes the logs the way the monitor did before `toshieth.events`"""
+
+    transfers = []
+    for _log in logs_list:
+        if _log['topics'][0] == TRANSFER_TOPIC:
+            if _log['address'] not in known_tokens:
+                continue
+            if len(_log['topics']) == 3 and len(_log['data']) == 66:
+                from_address = decode_single(('address', '', []), data_decoder(_log['topics'][1]))
+                to_address = decode_single(('address', '', []), data_decoder(_log['topics'][2]))
+                value = decode_abi(['uint256'], data_decoder(_log['data']))[0]
+            elif len(_log['topics']) == 1 and len(_log['data']) == 194:
+                from_address, to_address, value = decode_abi(
+                    ['address', 'address', 'uint256'], data_decoder(_log['data']))
+            else:
+                continue
+        elif (_log['topics'][0] == DEPOSIT_TOPIC or _log['topics'][0] == WITHDRAWAL_TOPIC) and \
+             _log['address'] == WETH_CONTRACT_ADDRESS:
+            eth_address = decode_single(('address', '', []), data_decoder(_log['topics'][1]))
+            value = decode_abi(['uint256'], data_decoder(_log['data']))[0]
+            if _log['topics'][0] == DEPOSIT_TOPIC:
+                from_address, to_address = ZERO_ADDRESS, eth_address
+            else:
+                from_address, to_address = eth_address, ZERO_ADDRESS
+        else:
+            continue
+        transfers.append((_log['transactionHash'], _log['address'], get_transaction_log_index(_log),
+                          from_address, to_address, value))
+    return transfers
+
+def time_decoder(decoder, logs_list, known_tokens, repeat):
+    best = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        decoder(logs_list, known_tokens)
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Token event decoding micro-benchmark")
+    parser.add_argument('--logs', type=int, default=10000, help="number of logs to decode")
+    parser.add_argument('--repeat', type=int, default=5, help="number of runs, the best is reported")
+    args = parser.parse_args(argv)
+
+    logs_list, known_tokens = generate_logs(args.logs)
+    fast_transfers, _ = decode_token_logs(logs_list, known_tokens)
+    if fast_transfers != generic_decode_token_logs(logs_list, known_tokens):
+        raise Exception("Decoders gave different results")
+
+    generic_time = time_decoder(generic_decode_token_logs, logs_list, known_tokens, args.repeat)
+    fast_time = time_decoder(decode_token_logs, logs_list, known_tokens, args.repeat)
+    print("Decoded {} logs".format(args.logs))
+    print("generic: {:.3f}s ({:.2f}us per log)".format(generic_time, generic_time / args.logs * 1000000))
+    print("fast:    {:.3f}s ({:.2f}us per log)".format(fast_time, fast_time / args.logs * 1000000))
+    print("speedup: {:.1f}x".format(generic_time / fast_time))
+
+if __name__ == '__main__':
+    main()
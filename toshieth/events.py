@@ -0,0 +1,80 @@
+"""Decoding for the fixed layout token events in `toshieth.constants`.
+
+The generic abi decoder converts the hex strings to bytes and parses the types
+for every value, which is slow when decoding every token event in a block. All
+the values in these events are 32 byte words, so they can be sliced straight
+out of the hex strings of the log's topics and data.
+"""
+
+from .constants import TRANSFER_TOPIC, DEPOSIT_TOPIC, WITHDRAWAL_TOPIC, WETH_CONTRACT_ADDRESS
+from .utils import get_transaction_log_index
+
+ZERO_ADDRESS = "0x0000000000000000000000000000000000000000"
+
+def decode_address(word):
+    """Decodes an address from a hex encoded 32 byte word (e.g. a topic)"""
+    return "0x" + word[-40:].lower()
+
+def decode_uint256(word):
+    """Decodes a uint256 from a hex encoded 32 byte word, with or without
+    the 0x prefix"""
+    return int(word[-64:], 16)
+
+def decode_transfer_log(_log):
+    """Decodes a Transfer(address,address,uint256) event, in either the standard
+    form or the non-indexed form some older tokens use.
+
+    Returns a tuple of (from_address, to_address, value), or None if the log
+    doesn't have the structure of a Transfer event"""
+
+    topics = _log['topics']
+    data = _log['data']
+    if len(topics) == 3 and len(data) == 66:
+        return (decode_address(topics[1]), decode_address(topics[2]), decode_uint256(data))
+    elif len(topics) == 1 and len(data) == 194:
+        return (decode_address(data[2:66]), decode_address(data[66:130]), decode_uint256(data[130:194]))
+    return None
+
+def decode_weth_log(_log):
+    """Decodes a WETH Deposit(address,uint256) or Withdrawal(address,uint256) event
+    as a transfer from/to the zero address.
+
+    Returns a tuple of (from_address, to_address, value)"""
+
+    eth_address = decode_address(_log['topics'][1])
+    value = decode_uint256(_log['data'][2:66])
+    if _log['topics'][0] == DEPOSIT_TOPIC:
+        return (ZERO_ADDRESS, eth_address, value)
+    return (eth_address, ZERO_ADDRESS, value)
+
+def decode_token_logs(logs_list, known_tokens):
+    """Decodes all the token transfers in the given logs in a single pass. Only
+    Transfer events from contracts in `known_tokens` and WETH Deposit and
+    Withdrawal events are included.
+
+    Returns a tuple of (transfers, invalid_logs), where transfers is a list of
+    tuples in the form:
+      (transaction_hash, contract_address, transaction_log_index, from_address, to_address, value)
+    and invalid_logs are the logs from known tokens with Transfer's topic that
+    don't have the structure of a Transfer event"""
+
+    transfers = []
+    invalid_logs = []
+    for _log in logs_list:
+        topics = _log['topics']
+        if not topics:
+            continue
+        topic = topics[0]
+        if topic == TRANSFER_TOPIC:
+            if _log['address'] not in known_tokens:
+                continue
+            transfer = decode_transfer_log(_log)
+            if transfer is None:
+                invalid_logs.append(_log)
+                continue
+        elif (topic == DEPOSIT_TOPIC or topic == WITHDRAWAL_TOPIC) and _log['address'] == WETH_CONTRACT_ADDRESS:
+            transfer = decode_weth_log(_log)
+        else:
+            continue
+        transfers.append((_log['transactionHash'], _log['address'], get_transaction_log_index(_log)) + transfer)
+    return transfers, invalid_logs
@@ -0,0 +1,217 @@
+"""Gas price estimates and an in memory cache of them.
+
+The block monitor estimates the gas prices from the transactions in the
+blocks it processes using a `GasPriceEstimator`, raising the estimates to
+the prices from the external sources (EthGasStation and the node) that the
+manager's `update_default_gas_price` task refreshes every few minutes.
+
+`GasPriceOracle` caches the stored prices so that the transaction queue and
+the request handlers can check them without a round trip to redis each time.
+The cached values are refreshed from redis at most every
+`GAS_PRICE_CACHE_TTL` seconds, and straight away when `set_gas_prices`
+publishes that they've changed on `GAS_PRICE_CHANNEL`.
+"""
+
+import asyncio
+import bisect
+import logging
+
+from collections import OrderedDict
+
+import aioredis
+from toshi.config import config
+from toshi.redis import get_redis_connection
+from toshi.utils import parse_int
+
+log = logging.getLogger("toshieth.gasprice")
+
+GAS_PRICE_KEYS = {
+    'safelow': 'gas_station_safelow_gas_price',
+    'standard': 'gas_station_standard_gas_price',
+    'fast': 'gas_station_fast_gas_price',
+    # the last prices from the external sources
+    'external_safelow': 'external_safelow_gas_price',
+    'external_standard': 'external_standard_gas_price',
+    'external_fast': 'external_fast_gas_price',
+    # the last gas price reported by the node
+    'node': 'eth_node_gas_price'
+}
+GAS_PRICE_CHANNEL = "toshieth.gas_price"
+GAS_PRICE_CACHE_TTL = 10
+# the external prices are ignored if they haven't been refreshed for this long
+EXTERNAL_GAS_PRICE_EXPIRY = 900
+
+# name -> percentile of the gas prices in the estimator's window
+GAS_PRICE_PERCENTILES = {
+    'safelow': 35,
+    'standard': 60,
+    'fast': 90
+}
+# roughly the last 45 minutes of blocks
+DEFAULT_GAS_PRICE_WINDOW = 200
+# too few transactions to give useful estimates (e.g. on test networks)
+MIN_ESTIMATE_TRANSACTIONS = 50
+
+class GasPriceEstimator:
+    """Keeps the gas prices of the transactions in the last `window` blocks
+    in sorted order, updated as blocks are added, so the percentiles can be
+    read off directly"""
+
+    def __init__(self, window=DEFAULT_GAS_PRICE_WINDOW):
+        self.window = window
+        # block number -> the gas prices in the block, in block number order
+        self.blocks = OrderedDict()
+        self.prices = []
+
+    def add_block(self, block):
+        """Adds the gas prices of the block's transactions, replacing the
+        block (and any after it) if it's already in the window"""
+
+        block_number = parse_int(block['number'])
+        self.remove_blocks_from(block_number)
+        # zero priced transactions are only included by the miners
+        # themselves, so don't say anything about the going price
+        prices = [parse_int(tx['gasPrice']) for tx in block['transactions']
+                  if isinstance(tx, dict) and parse_int(tx['gasPrice'])]
+        self.blocks[block_number] = prices
+        for price in prices:
+            bisect.insort(self.prices, price)
+        while self.blocks and next(iter(self.blocks)) <= block_number - self.window:
+            _, old_prices = self.blocks.popitem(last=False)
+            self._remove_prices(old_prices)
+
+    def remove_blocks_from(self, block_number):
+        """Removes the block with the given number and any after it (e.g.
+        when they've been replaced by a reorg)"""
+
+        while self.blocks:
+            last_block_number = next(reversed(self.blocks))
+            if last_block_number < block_number:
+                break
+            self._remove_prices(self.blocks.pop(last_block_number))
+
+    def _remove_prices(self, prices):
+        for price in prices:
+            del self.prices[bisect.bisect_left(self.prices, price)]
+
+    def estimate(self):
+        """Returns a dict of the names in `GAS_PRICE_PERCENTILES` to gas
+        prices (int), or None if there aren't enough transactions in the
+        window"""
+
+        if len(self.prices) < MIN_ESTIMATE_TRANSACTIONS:
+            return None
+        return {name: self.prices[min(len(self.prices) - 1, len(self.prices) * percentile // 100)]
+                for name, percentile in GAS_PRICE_PERCENTILES.items()}
+
+def combine_gas_prices(estimate, external):
+    """Raises each of the estimated prices to the matching external price,
+    as the estimates lag behind sudden price rises by up to the estimator's
+    window. Both are dicts of name -> gas price (int) with missing or None
+    values ignored. Returns a dict of name -> hex string for the names with
+    a price"""
+
+    prices = {}
+    for name in GAS_PRICE_PERCENTILES:
+        values = [value for value in (estimate.get(name), external.get(name)) if value is not None]
+        if values:
+            prices[name] = hex(max(values))
+    return prices
+
+class GasPriceOracle:
+    """Caches the gas station's safelow, standard and fast gas prices and the
+    node's gas price.
+
+    Changes are listened for on a connection of it's own, as a subscribed
+    connection can't be used for anything else. `close` should be called
+    when the oracle is no longer needed"""
+
+    def __init__(self, redis):
+        self.redis = redis
+        # name -> gas price (int) or None if not set
+        self.prices = {}
+        self._expires = 0
+        self._listener = None
+        self._subscriber = None
+
+    async def get(self, name):
+        """Returns the named gas price as an int, or None if it isn't set"""
+
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.get_event_loop().create_task(self._listen())
+        if asyncio.get_event_loop().time() >= self._expires:
+            await self.refresh()
+        return self.prices.get(name)
+
+    async def refresh(self):
+        names = list(GAS_PRICE_KEYS)
+        values = await self.redis.mget(*[GAS_PRICE_KEYS[name] for name in names])
+        self.prices = {name: parse_int(value) for name, value in zip(names, values)}
+        self._expires = asyncio.get_event_loop().time() + GAS_PRICE_CACHE_TTL
+
+    def invalidate(self):
+        self._expires = 0
+
+    def close(self):
+        """Stops listening for changes and closes the subscription connection"""
+
+        if self._listener is not None:
+            self._listener.cancel()
+            self._listener = None
+        self._close_subscriber()
+
+    def _close_subscriber(self):
+        if self._subscriber is not None:
+            self._subscriber.close()
+            self._subscriber = None
+
+    async def _listen(self):
+        try:
+            self._subscriber = await aioredis.create_redis(config['redis']['url'])
+            channel, = await self._subscriber.subscribe(GAS_PRICE_CHANNEL)
+            while await channel.wait_message():
+                await channel.get()
+                self.invalidate()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("Error listening for gas price changes")
+        finally:
+            self._close_subscriber()
+        # changes may have been missed
+        self.invalidate()
+
+_oracle = None
+
+def get_gas_price_oracle():
+    """Returns the gas price oracle for the current redis connection"""
+
+    global _oracle
+    redis = get_redis_connection()
+    if _oracle is None or _oracle.redis is not redis:
+        if _oracle is not None:
+            _oracle.close()
+        _oracle = GasPriceOracle(redis)
+    return _oracle
+
+def close_gas_price_oracle():
+    """Closes the current gas price oracle, for when the process is shutting
+    down"""
+
+    global _oracle
+    if _oracle is not None:
+        _oracle.close()
+        _oracle = None
+
+async def set_gas_prices(redis, *, expire=0, **prices):
+    """Stores the given gas prices (hex strings, keyed by the names in
+    `GAS_PRICE_KEYS`), expiring after `expire` seconds if given, and lets
+    every process's oracle know they've changed"""
+
+    tr = redis.multi_exec()
+    for name, value in prices.items():
+        tr.set(GAS_PRICE_KEYS[name], value, expire=expire)
+    tr.publish(GAS_PRICE_CHANNEL, "changed")
+    await tr.execute()
+    if _oracle is not None:
+        _oracle.invalidate()
@@ -6,6 +6,7 @@ from toshi.database import DatabaseMixin
 from toshi.jsonrpc.errors import JsonRPCError
 from toshi.redis import RedisMixin
 from toshi.analytics import AnalyticsMixin
+from toshi.ethereum.mixin import EthereumMixin
 
 from toshi.sofa import SofaPayment
 from toshi.handlers import RequestVerificationMixin, SimpleFileHandler
@@ -13,6 +14,7 @@ from toshi.utils import validate_address, parse_int
 from toshi.log import log, log_headers_on_error
 
 from toshi.config import config
+from toshieth.gasprice import get_gas_price_oracle
 from toshieth.mixins import BalanceMixin
 from toshieth.jsonrpc import ToshiEthJsonRPC
 from toshieth.utils import database_transaction_to_rlp_transaction
@@ -376,7 +378,7 @@ class AddressHandler(DatabaseMixin, BaseHandler):
             resp['status'] = "&".join(status)
         self.write(resp)
 
-class GasPriceHandler(RedisMixin, BaseHandler):
+class GasPriceHandler(EthereumMixin, RedisMixin, BaseHandler):
 
     async def get(self):
 
@@ -384,7 +386,7 @@ class GasPriceHandler(RedisMixin, BaseHandler):
         self.set_header("Access-Control-Allow-Headers", "x-requested-with")
         self.set_header('Access-Control-Allow-Methods', 'GET')
 
-        gas_station_gas_price = await self.redis.get('gas_station_fast_gas_price')
+        gas_station_gas_price = await get_gas_price_oracle().get('fast')
         if gas_station_gas_price is None:
             gas_station_gas_price = await self.eth.eth_gasPrice()
             if gas_station_gas_price:
@@ -392,7 +394,7 @@ class GasPriceHandler(RedisMixin, BaseHandler):
             else:
                 gas_station_gas_price = hex(config['ethereum'].getint('default_gasprice', DEFAULT_GASPRICE))
         else:
-            gas_station_gas_price = gas_station_gas_price.decode('utf-8')
+            gas_station_gas_price = hex(gas_station_gas_price)
         self.write({
             "gas_price": gas_station_gas_price
         })
@@ -4,7 +4,6 @@ from toshi.jsonrpc.handlers import JsonRPCBase, map_jsonrpc_arguments
 from toshi.jsonrpc.errors import JsonRPCInvalidParamsError, JsonRPCError
 from toshi.analytics import AnalyticsMixin
 from toshi.database import DatabaseMixin
-from toshi.jsonrpc.client import JsonRPCClient
 from toshi.redis import RedisMixin
 from toshi.ethereum.utils import data_decoder, data_encoder, checksum_validate_address
 from ethereum.exceptions import InvalidTransaction
@@ -24,7 +23,9 @@ from toshi.ethereum.utils import personal_ecrecover
 from toshi.log import log
 
 from toshi.config import config
+from toshieth.gasprice import get_gas_price_oracle
 from toshieth.mixins import BalanceMixin
+from toshieth.nodepool import create_jsonrpc_client
 from toshieth.utils import RedisLock, RedisLockException, database_transaction_to_rlp_transaction, unwrap_or
 from toshieth.tasks import manager_dispatcher, erc20_dispatcher
 
@@ -70,8 +71,8 @@ class ToshiEthJsonRPC(JsonRPCBase, BalanceMixin, DatabaseMixin, AnalyticsMixin,
     @property
     def eth(self):
         if not hasattr(self, '_eth_jsonrpc_client'):
-            self._eth_jsonrpc_client = JsonRPCClient(
-                config['ethereum']['url'],
+            self._eth_jsonrpc_client = create_jsonrpc_client(
+                'ethereum',
                 connect_timeout=5.0, request_timeout=5.0)
         return self._eth_jsonrpc_client
 
@@ -169,9 +170,7 @@ class ToshiEthJsonRPC(JsonRPCBase, BalanceMixin, DatabaseMixin, AnalyticsMixin,
 
         if gas_price is None:
             # try and use cached gas station gas price
-            gas_station_gas_price = await self.redis.get('gas_station_fast_gas_price')
-            if gas_station_gas_price:
-                gas_price = parse_int(gas_station_gas_price)
+            gas_price = await get_gas_price_oracle().get('fast')
             if gas_price is None:
                 gas_price = await self.eth.eth_gasPrice()
                 if gas_price is None:
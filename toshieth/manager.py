@@ -6,13 +6,16 @@ import time
 from tornado.httpclient import AsyncHTTPClient
 from tornado.escape import json_decode, json_encode
 
+from toshieth.account_state import get_account_state, set_account_state, invalidate_account_state
+from toshieth.gasprice import get_gas_price_oracle, set_gas_prices, close_gas_price_oracle, EXTERNAL_GAS_PRICE_EXPIRY
 from toshieth.mixins import BalanceMixin
+from toshieth.nodepool import create_jsonrpc_client
+from toshieth.utils import unwrap_or
 from toshieth.tasks import (
     BaseEthServiceWorker, BaseTaskHandler,
     manager_dispatcher, erc20_dispatcher, eth_dispatcher, push_dispatcher
 )
 from toshi.ethereum.mixin import EthereumMixin
-from toshi.jsonrpc.client import JsonRPCClient
 from toshi.jsonrpc.errors import JsonRPCError
 from toshi.log import configure_logger, log_unhandled_exceptions
 from toshi.utils import parse_int
@@ -20,18 +23,34 @@ from toshi.sofa import SofaPayment
 from toshi.ethereum.tx import (
     create_transaction, encode_transaction, calculate_transaction_hash
 )
-from toshi.ethereum.utils import data_decoder, data_encoder, decode_single_address
-from ethereum.abi import decode_abi
+from toshi.ethereum.utils import data_decoder, data_encoder
 
 from toshieth.constants import TRANSFER_TOPIC, DEPOSIT_TOPIC, WITHDRAWAL_TOPIC, WETH_CONTRACT_ADDRESS
+from toshieth.events import decode_transfer_log, decode_address
 from toshi.config import config
 
 log = logging.getLogger("toshieth.manager")
 
 TRANSACTION_PROCESSING_TIMEOUT = 120
+# how long to keep retrying confirmations the node can't back up yet (e.g.
+# when it's behind the block monitor's node), and the backoff between the
+# retries of a batch of confirmations
+CONFIRMATION_RETRY_TIMEOUT = 60
+CONFIRMATION_RETRY_MIN_DELAY = 0.5
+CONFIRMATION_RETRY_MAX_DELAY = 8
 
 class TransactionQueueHandler(EthereumMixin, BalanceMixin, BaseTaskHandler):
 
+    @property
+    def eth(self):
+        if not hasattr(self, '_eth_jsonrpc_client'):
+            # use all the nodes if more than one is configured
+            if 'urls' in config['ethereum']:
+                self._eth_jsonrpc_client = create_jsonrpc_client('ethereum')
+            else:
+                self._eth_jsonrpc_client = super().eth
+        return self._eth_jsonrpc_client
+
     @log_unhandled_exceptions(logger=log)
     async def process_transaction_queue(self, ethereum_address):
         should_run = False
@@ -90,27 +109,44 @@ class TransactionQueueHandler(EthereumMixin, BalanceMixin, BaseTaskHandler):
             # TODO: make sure the block number isn't too far apart from the current
             # if this is the case then we should just come back later!
 
-            # get the current network balance for this address
-            balance = await self.eth.eth_getBalance(ethereum_address, block=last_blocknumber or "latest")
+            # use the state from the last time the queue was processed if
+            # nothing has changed since
+            if last_blocknumber:
+                account_state, account_state_version = await get_account_state(
+                    self.redis, ethereum_address, last_blocknumber)
+            else:
+                account_state = None
 
-            # get the unconfirmed_txs
-            async with self.db:
-                unconfirmed_txs = await self.db.fetch(
-                    "SELECT nonce, value, gas, gas_price FROM transactions "
-                    "WHERE from_address = $1 "
-                    "AND (status = 'unconfirmed' "
-                    "OR (status = 'confirmed' AND blocknumber > $2)) "
-                    "ORDER BY nonce",
-                    ethereum_address, last_blocknumber or 0)
+            if account_state:
+                balance = account_state['balance']
+                nonce = account_state['nonce']
+                network_nonce = account_state['network_nonce']
+            else:
+                # get the current network balance for this address
+                balance = await self.eth.eth_getBalance(ethereum_address, block=last_blocknumber or "latest")
 
-            network_nonce = await self.eth.eth_getTransactionCount(ethereum_address, block=last_blocknumber or "latest")
+                # get the unconfirmed_txs
+                async with self.db:
+                    unconfirmed_txs = await self.db.fetch(
+                        "SELECT nonce, value, gas, gas_price FROM transactions "
+                        "WHERE from_address = $1 "
+                        "AND (status = 'unconfirmed' "
+                        "OR (status = 'confirmed' AND blocknumber > $2)) "
+                        "ORDER BY nonce",
+                        ethereum_address, last_blocknumber or 0)
+
+                network_nonce = await self.eth.eth_getTransactionCount(ethereum_address, block=last_blocknumber or "latest")
+
+                if unconfirmed_txs:
+                    nonce = unconfirmed_txs[-1]['nonce'] + 1
+                    balance -= sum(parse_int(tx['value']) + (parse_int(tx['gas']) * parse_int(tx['gas_price'])) for tx in unconfirmed_txs)
+                else:
+                    # use the nonce from the network
+                    nonce = network_nonce
 
-            if unconfirmed_txs:
-                nonce = unconfirmed_txs[-1]['nonce'] + 1
-                balance -= sum(parse_int(tx['value']) + (parse_int(tx['gas']) * parse_int(tx['gas_price'])) for tx in unconfirmed_txs)
-            else:
-                # use the nonce from the network
-                nonce = network_nonce
+            # set to False if anything happens that the balance and nonce
+            # don't account for
+            cache_account_state = bool(last_blocknumber)
 
             # marker for whether a previous transaction had an error (signaling
             # that all the following should also be an error
@@ -203,7 +239,7 @@ class TransactionQueueHandler(EthereumMixin, BalanceMixin, BaseTaskHandler):
                 if balance >= cost:
 
                     # check if gas price is high enough that it makes sense to send the transaction
-                    safe_gas_price = parse_int(await self.redis.get('gas_station_safelow_gas_price'))
+                    safe_gas_price = await get_gas_price_oracle().get('safelow')
                     if safe_gas_price and safe_gas_price > gas_price:
                         log.debug("Not queuing tx '{}' as current gas price would not support it".format(transaction['hash']))
                         # retry this address in a minute
@@ -245,6 +281,7 @@ class TransactionQueueHandler(EthereumMixin, BalanceMixin, BaseTaskHandler):
                         if e.message and (e.message.startswith("Transaction nonce is too low") or
                                           e.message.startswith("Transaction with the same hash was already imported")):
                             existing_tx = await self.eth.eth_getTransactionByHash(transaction['hash'])
+                            cache_account_state = False
                             if existing_tx:
                                 if existing_tx['blockNumber']:
                                     await self.update_transaction(transaction['transaction_id'], 'confirmed')
@@ -299,6 +336,10 @@ class TransactionQueueHandler(EthereumMixin, BalanceMixin, BaseTaskHandler):
                             transaction = transactions_out.pop() if transactions_out else None
                         break
 
+            if cache_account_state:
+                await set_account_state(self.redis, ethereum_address, last_blocknumber, account_state_version,
+                                        balance=balance, nonce=nonce, network_nonce=network_nonce)
+
         for address in addresses_to_check:
             # make sure we don't try process any contract deployments
             if address != "0x":
@@ -308,7 +349,12 @@ class TransactionQueueHandler(EthereumMixin, BalanceMixin, BaseTaskHandler):
             manager_dispatcher.process_transaction_queue(ethereum_address)
 
     @log_unhandled_exceptions(logger=log)
-    async def update_transaction(self, transaction_id, status, retry_start_time=0):
+    async def update_transaction(self, transaction_id, status, retry_start_time=0, receipt=None):
+        """Updates the status of the transaction and sends notifications about it.
+
+        When confirming a transaction, the monitor may pass along the
+        transaction's `receipt` (with at least the blockNumber and logs) so it
+        doesn't have to be fetched from the node again"""
 
         async with self.db:
             tx = await self.db.fetchrow("SELECT * FROM transactions WHERE transaction_id = $1", transaction_id)
@@ -332,69 +378,27 @@ class TransactionQueueHandler(EthereumMixin, BalanceMixin, BaseTaskHandler):
                 log.info("Updating status of tx {} to {} (previously: {})".format(tx['hash'], status, tx['status']))
 
         if status == 'confirmed':
-            try:
-                bulk = self.eth.bulk()
-                transaction = bulk.eth_getTransactionByHash(tx['hash'])
-                tx_receipt = bulk.eth_getTransactionReceipt(tx['hash'])
-                await bulk.execute()
-                transaction = transaction.result()
-                tx_receipt = tx_receipt.result()
-            except:
-                log.exception("Error getting transaction: {}".format(tx['hash']))
-                transaction = None
-                tx_receipt = None
+            if receipt is not None and receipt['transactionHash'] == tx['hash']:
+                transaction = {'blockNumber': receipt['blockNumber']}
+                tx_receipt = receipt
+            else:
+                try:
+                    bulk = self.eth.bulk()
+                    transaction = bulk.eth_getTransactionByHash(tx['hash'])
+                    tx_receipt = bulk.eth_getTransactionReceipt(tx['hash'])
+                    await bulk.execute()
+                    transaction = transaction.result()
+                    tx_receipt = tx_receipt.result()
+                except:
+                    log.exception("Error getting transaction: {}".format(tx['hash']))
+                    transaction = None
+                    tx_receipt = None
             if transaction and 'blockNumber' in transaction and transaction['blockNumber'] is not None:
                 if retry_start_time > 0:
                     log.info("successfully confirmed tx {} after {} seconds".format(tx['hash'], round(time.time() - retry_start_time, 2)))
 
-                token_tx_updates = []
-                updated_token_txs = []
-                for token_tx in token_txs:
-                    from_address = token_tx['from_address']
-                    to_address = token_tx['to_address']
-                    # check transaction receipt to make sure the transfer was successful
-                    has_transfer_event = False
-                    token_tx_status = 'confirmed'
-                    if tx_receipt['logs'] is not None:  # should always be [], but checking just incase
-                        for _log in tx_receipt['logs']:
-                            if len(_log['topics']) > 0 and _log['topics'][0] == TRANSFER_TOPIC:
-                                if len(_log['topics']) == 3 and len(_log['data']) == 66 and \
-                                   decode_single_address(_log['topics'][1]) == from_address and \
-                                   decode_single_address(_log['topics'][2]) == to_address:
-                                    has_transfer_event = True
-                                    break
-                                elif len(_log['topics']) == 1 and len(_log['data']) == 194:
-                                    erc20_from_address, erc20_to_address, erc20_value = decode_abi(
-                                        ['address', 'address', 'uint256'], data_decoder(_log['data']))
-                                    if erc20_from_address == from_address and \
-                                       erc20_to_address == to_address:
-                                        has_transfer_event = True
-                                        break
-                            elif _log['address'] == WETH_CONTRACT_ADDRESS:
-                                if _log['topics'][0] == DEPOSIT_TOPIC and decode_single_address(_log['topics'][1]) == to_address:
-                                    has_transfer_event = True
-                                    break
-                                elif _log['topics'][0] == WITHDRAWAL_TOPIC and decode_single_address(_log['topics'][1]) == from_address:
-                                    has_transfer_event = True
-                                    break
-                        if not has_transfer_event:
-                            # there was no Transfer event matching this transaction, this means something went wrong
-                            token_tx_status = 'error'
-                        else:
-                            erc20_dispatcher.update_token_cache(token_tx['contract_address'],
-                                                                from_address,
-                                                                to_address,
-                                                                blocknumber=parse_int(transaction['blockNumber']))
-                    else:
-                        log.error("Unexpectedly got null for tx receipt logs for tx: {}".format(tx['hash']))
-                        token_tx_status = 'error'
-                    token_tx_updates.append((token_tx_status, tx['transaction_id'], token_tx['transaction_log_index']))
-                    token_tx = dict(token_tx)
-                    token_tx['status'] = token_tx_status
-                    updated_token_txs.append(token_tx)
-
-                token_txs = updated_token_txs
                 blocknumber = parse_int(transaction['blockNumber'])
+                token_tx_updates, token_txs = self._check_token_transactions(tx, token_txs, tx_receipt, blocknumber)
                 async with self.db:
                     await self.db.execute("UPDATE transactions SET status = $1, blocknumber = $2, updated = (now() AT TIME ZONE 'utc') "
                                           "WHERE transaction_id = $3",
@@ -407,7 +411,7 @@ class TransactionQueueHandler(EthereumMixin, BalanceMixin, BaseTaskHandler):
                     await self.db.commit()
             else:
                 # this is probably because the node hasn't caught up with the latest block yet, retry in a "bit" (but only retry up to 60 seconds)
-                if retry_start_time > 0 and time.time() - retry_start_time >= 60:
+                if retry_start_time > 0 and time.time() - retry_start_time >= CONFIRMATION_RETRY_TIMEOUT:
                     if transaction is None:
                         log.error("requested transaction {}'s status to be set to confirmed, but cannot find the transaction".format(tx['hash']))
                     else:
@@ -422,6 +426,201 @@ class TransactionQueueHandler(EthereumMixin, BalanceMixin, BaseTaskHandler):
                                       status, transaction_id)
                 await self.db.commit()
 
+        await self._transaction_updated(tx, status, token_txs)
+
+    @log_unhandled_exceptions(logger=log)
+    async def update_transactions(self, updates, retry_start_time=0, attempt=0):
+        """Does the same as `update_transaction` for a list of (transaction_id,
+        status, receipt) updates, using a fixed number of queries for the whole
+        list. `receipt` can be None.
+
+        Confirmations that can't be completed yet (e.g. the node hasn't seen the
+        block yet) are retried together, backing off between each attempt"""
+
+        transaction_ids = [transaction_id for transaction_id, _, _ in updates]
+        async with self.db:
+            rows = await self.db.fetch("SELECT * FROM transactions WHERE transaction_id = ANY($1)", transaction_ids)
+            token_rows = await self.db.fetch(
+                "SELECT tok.symbol, tok.name, tok.decimals, tx.transaction_id, tx.contract_address, tx.value, tx.from_address, tx.to_address, tx.transaction_log_index, tx.status "
+                "FROM token_transactions tx "
+                "JOIN tokens tok "
+                "ON tok.contract_address = tx.contract_address "
+                "WHERE tx.transaction_id = ANY($1)", transaction_ids)
+        txs = {row['transaction_id']: row for row in rows}
+        token_txs = {}
+        for row in token_rows:
+            token_txs.setdefault(row['transaction_id'], []).append(row)
+
+        # (tx, status, receipt)
+        changes = []
+        # updates for transactions already in the list, which depend on the
+        # result of the earlier update so are sent once it's been written
+        deferred = []
+        seen = set()
+        for transaction_id, status, receipt in updates:
+            if transaction_id in seen:
+                deferred.append((transaction_id, status))
+                continue
+            seen.add(transaction_id)
+            tx = txs.get(transaction_id)
+            if tx is None or tx['status'] == status:
+                continue
+            # check if we're trying to update the state of a tx that is already confirmed, we have an issue
+            if tx['status'] == 'confirmed':
+                log.warning("Trying to update status of tx {} to {}, but tx is already confirmed".format(tx['hash'], status))
+                continue
+            # only log if the transaction is internal
+            if tx['v'] is not None:
+                log.info("Updating status of tx {} to {} (previously: {})".format(tx['hash'], status, tx['status']))
+            changes.append((tx, status, receipt))
+
+        # fetch the details needed for any confirmations the monitor didn't pass a receipt for
+        bulk = self.eth.bulk()
+        futures = {}
+        for tx, status, receipt in changes:
+            if status == 'confirmed' and (receipt is None or receipt['transactionHash'] != tx['hash']):
+                futures[tx['transaction_id']] = (bulk.eth_getTransactionByHash(tx['hash']),
+                                                 bulk.eth_getTransactionReceipt(tx['hash']))
+        if futures:
+            try:
+                await bulk.execute()
+            except:
+                log.exception("Error getting {} transactions".format(len(futures)))
+
+        # confirmations to try again later
+        retries = []
+        # (transaction_id, status, blocknumber)
+        status_updates = []
+        token_tx_updates = []
+        # (tx, status, token_txs)
+        updated = []
+        for tx, status, receipt in changes:
+            transaction_id = tx['transaction_id']
+            tx_token_txs = [dict(token_tx) for token_tx in token_txs.get(transaction_id, [])]
+            if status == 'confirmed':
+                if transaction_id in futures:
+                    transaction_future, receipt_future = futures[transaction_id]
+                    if transaction_future.done() and receipt_future.done():
+                        transaction = unwrap_or(transaction_future, None)
+                        receipt = unwrap_or(receipt_future, None)
+                    else:
+                        transaction = receipt = None
+                    blocknumber = parse_int(transaction['blockNumber']) if transaction else None
+                else:
+                    blocknumber = parse_int(receipt['blockNumber'])
+                if blocknumber is None or receipt is None:
+                    # probably because the node hasn't caught up with the latest block yet
+                    retries.append(tx)
+                    continue
+                if retry_start_time > 0:
+                    log.info("successfully confirmed tx {} after {} seconds".format(tx['hash'], round(time.time() - retry_start_time, 2)))
+                tx_token_tx_updates, tx_token_txs = self._check_token_transactions(tx, tx_token_txs, receipt, blocknumber)
+                token_tx_updates.extend(tx_token_tx_updates)
+            else:
+                blocknumber = None
+            status_updates.append((transaction_id, status, blocknumber))
+            updated.append((tx, status, tx_token_txs))
+
+        if status_updates:
+            async with self.db:
+                await self.db.execute(
+                    "UPDATE transactions SET status = u.status::transaction_status, "
+                    "blocknumber = COALESCE(u.blocknumber, transactions.blocknumber), "
+                    "updated = (now() AT TIME ZONE 'utc') "
+                    "FROM unnest($1::bigint[], $2::varchar[], $3::bigint[]) AS u (transaction_id, status, blocknumber) "
+                    "WHERE transactions.transaction_id = u.transaction_id",
+                    [transaction_id for transaction_id, _, _ in status_updates],
+                    [status for _, status, _ in status_updates],
+                    [blocknumber for _, _, blocknumber in status_updates])
+                if token_tx_updates:
+                    await self.db.execute(
+                        "UPDATE token_transactions SET status = u.status "
+                        "FROM unnest($1::varchar[], $2::bigint[], $3::integer[]) AS u (status, transaction_id, transaction_log_index) "
+                        "WHERE token_transactions.transaction_id = u.transaction_id "
+                        "AND token_transactions.transaction_log_index = u.transaction_log_index",
+                        [token_tx_status for token_tx_status, _, _ in token_tx_updates],
+                        [transaction_id for _, transaction_id, _ in token_tx_updates],
+                        [transaction_log_index for _, _, transaction_log_index in token_tx_updates])
+                await self.db.commit()
+
+        for tx, status, tx_token_txs in updated:
+            await self._transaction_updated(tx, status, tx_token_txs)
+
+        for transaction_id, status in deferred:
+            manager_dispatcher.update_transaction(transaction_id, status)
+
+        if retries:
+            if retry_start_time > 0 and time.time() - retry_start_time >= CONFIRMATION_RETRY_TIMEOUT:
+                for tx in retries:
+                    log.error("requested transaction {}'s status to be set to confirmed, but transaction is not confirmed on the node".format(tx['hash']))
+                return
+            delay = min(CONFIRMATION_RETRY_MIN_DELAY * 2 ** attempt, CONFIRMATION_RETRY_MAX_DELAY)
+            manager_dispatcher.update_transactions(
+                [(tx['transaction_id'], 'confirmed', None) for tx in retries],
+                retry_start_time=retry_start_time or time.time(),
+                attempt=attempt + 1).delay(delay)
+
+    def _check_token_transactions(self, tx, token_txs, tx_receipt, blocknumber):
+        """Checks the transaction receipt has the events for each of the
+        transaction's token transfers, to make sure the transfers were successful.
+
+        Returns a tuple of (token_tx_updates, token_txs), where token_tx_updates
+        are the (status, transaction_id, transaction_log_index) updates for the
+        token_transactions table and token_txs has the updated statuses"""
+
+        token_tx_updates = []
+        updated_token_txs = []
+        for token_tx in token_txs:
+            from_address = token_tx['from_address']
+            to_address = token_tx['to_address']
+            # check transaction receipt to make sure the transfer was successful
+            has_transfer_event = False
+            token_tx_status = 'confirmed'
+            if tx_receipt['logs'] is not None:  # should always be [], but checking just incase
+                for _log in tx_receipt['logs']:
+                    if len(_log['topics']) > 0 and _log['topics'][0] == TRANSFER_TOPIC:
+                        transfer = decode_transfer_log(_log)
+                        if transfer is not None and \
+                           transfer[0] == from_address and \
+                           transfer[1] == to_address:
+                            has_transfer_event = True
+                            break
+                    elif _log['address'] == WETH_CONTRACT_ADDRESS:
+                        if _log['topics'][0] == DEPOSIT_TOPIC and decode_address(_log['topics'][1]) == to_address:
+                            has_transfer_event = True
+                            break
+                        elif _log['topics'][0] == WITHDRAWAL_TOPIC and decode_address(_log['topics'][1]) == from_address:
+                            has_transfer_event = True
+                            break
+                if not has_transfer_event:
+                    # there was no Transfer event matching this transaction, this means something went wrong
+                    token_tx_status = 'error'
+                else:
+                    erc20_dispatcher.update_token_cache(token_tx['contract_address'],
+                                                        from_address,
+                                                        to_address,
+                                                        blocknumber=blocknumber)
+            else:
+                log.error("Unexpectedly got null for tx receipt logs for tx: {}".format(tx['hash']))
+                token_tx_status = 'error'
+            token_tx_updates.append((token_tx_status, tx['transaction_id'], token_tx['transaction_log_index']))
+            token_tx = dict(token_tx)
+            token_tx['status'] = token_tx_status
+            updated_token_txs.append(token_tx)
+
+        return token_tx_updates, updated_token_txs
+
+    async def _transaction_updated(self, tx, status, token_txs):
+        """Handles the transaction's status having been updated from the status
+        in `tx`, once the change has been written. Sends the notifications and
+        triggers processing of the receiving address's queue"""
+
+        # the transaction queue's cached account state only accounts for the
+        # transactions the queue sent itself, so anything else sent from the
+        # address or any of the queue's transactions failing makes it stale
+        if tx['v'] is None or (tx['status'] == 'unconfirmed' and status == 'error'):
+            await invalidate_account_state(self.redis, tx['from_address'])
+
         # render notification
 
         # don't send "queued"
@@ -639,7 +838,8 @@ class TransactionQueueHandler(EthereumMixin, BalanceMixin, BaseTaskHandler):
 
     @log_unhandled_exceptions(logger=log)
     async def update_default_gas_price(self, blocknumber):
-
+        """Refreshes the gas prices from EthGasStation and the node. This is
+        dispatched by the block monitor every few minutes"""
 
         client = AsyncHTTPClient()
         fast_wei = None
@@ -687,35 +887,38 @@ class TransactionQueueHandler(EthereumMixin, BalanceMixin, BaseTaskHandler):
                 standard_wei = hex(standard_wei)
                 fast_wei = hex(fast_wei)
 
-                await self.redis.mset(
-                    'gas_station_safelow_gas_price', safelow_wei,
-                    'gas_station_standard_gas_price', standard_wei,
-                    'gas_station_fast_gas_price', fast_wei)
-
             except:
                 log.exception("Error updating default gas price from EthGasStation")
+                fast_wei = None
+                standard_wei = None
+                safelow_wei = None
 
         try:
             # use the monitor url if available
             if 'monitor' in config:
-                node_url = config['monitor']['url']
+                node_section = 'monitor'
             else:
                 log.warning("monitor using config['ethereum'] node")
-                node_url = config['ethereum']['url']
-            eth = JsonRPCClient(node_url,
-                                connect_timeout=5.0,
-                                request_timeout=10.0)
+                node_section = 'ethereum'
+            eth = create_jsonrpc_client(node_section,
+                                        connect_timeout=5.0,
+                                        request_timeout=10.0)
             eth_gasprice = await eth.eth_gasPrice()
             eth_gasprice = hex(eth_gasprice)
         except:
             log.exception("Error updating default gas price from eth node")
 
-        # in case the eth gas station check failed, fall back on node gas price
-        # if the node gas price is higher than the previous eth gas station fast gas price
-        if fast_wei is None and eth_gasprice is not None:
-            old_fast_wei = parse_int(await self.redis.get('gas_station_fast_gas_price'))
-            if old_fast_wei is None or parse_int(eth_gasprice) > old_fast_wei:
-                await self.redis.set('gas_station_fast_gas_price', eth_gasprice)
+        # the monitor combines these with it's own estimates from the recent blocks
+        prices = {}
+        if fast_wei is not None:
+            prices.update(external_safelow=safelow_wei, external_standard=standard_wei, external_fast=fast_wei)
+        elif eth_gasprice is not None:
+            # in case the eth gas station check failed, fall back on node gas price
+            prices['external_fast'] = eth_gasprice
+        if eth_gasprice is not None:
+            prices['node'] = eth_gasprice
+        if prices:
+            await set_gas_prices(self.redis, expire=EXTERNAL_GAS_PRICE_EXPIRY, **prices)
 
         async with self.db:
             await self.db.execute("INSERT INTO gas_price_history "
@@ -739,6 +942,10 @@ class TaskManager(BaseEthServiceWorker):
         await super()._work()
         self.start_interval_services()
 
+    async def shutdown(self):
+        await super().shutdown()
+        close_gas_price_oracle()
+
 if __name__ == "__main__":
     from toshieth.app import extra_service_config
     extra_service_config()
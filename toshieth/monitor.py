@@ -1,20 +1,33 @@
 import asyncio
 import logging
 import time
-from ethereum.abi import decode_abi, decode_single
+import uuid
+import zlib
+from collections import OrderedDict
+from tornado.escape import json_decode
 from toshi.jsonrpc.client import JsonRPCClient
 from toshi.jsonrpc.errors import JsonRPCError, HTTPError
 from toshi.log import configure_logger, log_unhandled_exceptions
 from toshi.database import prepare_database
 from toshi.redis import prepare_redis, get_redis_connection
 from toshi.config import config
-from toshieth.tasks import manager_dispatcher, erc20_dispatcher, eth_dispatcher, collectibles_dispatcher
+from toshieth.tasks import manager_dispatcher, erc20_dispatcher, eth_dispatcher, collectibles_dispatcher, monitor_shard_dispatcher
 
 from toshi.utils import parse_int
-from toshi.ethereum.utils import data_decoder
 
+from .account_state import invalidate_all_account_states
+from .block_events import build_block_event, build_retract_event, publish_block_events
+from .bloom import parse_logs_bloom, bloom_contains
 from .constants import TRANSFER_TOPIC, DEPOSIT_TOPIC, WITHDRAWAL_TOPIC, WETH_CONTRACT_ADDRESS
-from .utils import get_transaction_log_index
+from .events import decode_token_logs
+from .gasprice import (
+    GasPriceEstimator, combine_gas_prices, get_gas_price_oracle, set_gas_prices, close_gas_price_oracle,
+    DEFAULT_GAS_PRICE_WINDOW
+)
+from .nodepool import create_jsonrpc_client
+from .registrations import RegistrationCache
+from .subscriptions import NodeSubscription
+from .utils import LimitedPool, unwrap_or
 
 DEFAULT_BLOCK_CHECK_DELAY = 0
 DEFAULT_POLL_DELAY = 1
@@ -25,8 +38,57 @@ FILTER_TIMEOUT = 120
 SANITY_CHECK_CALLBACK_TIME = 10
 # 5 minutes delay until reporting errors when no new blocks are seen
 NEW_BLOCK_TIMEOUT = 300
+# number of blocks (and their logs) to keep in flight while catching up
+DEFAULT_BLOCK_PREFETCH_WINDOW = 10
+# how many times to refetch a block that changes while fetching it's logs,
+# waiting a little longer each time for the node to settle
+FETCH_BLOCK_RETRIES = 3
+FETCH_BLOCK_RETRY_DELAY = 0.5
+# when the monitor is more than this many blocks behind the head of the
+# chain, blocks are processed in ranges of CATCH_UP_RANGE_SIZE blocks
+CATCH_UP_THRESHOLD = 200
+CATCH_UP_RANGE_SIZE = 50
+# size of the database pool to assume if it can't be read from the pool
+DEFAULT_DB_POOL_SIZE = 10
+# number of the most recent rows from the blocks table to keep in memory
+# for checking parent hashes and finding fork points
+RECENT_BLOCKS_SIZE = 256
+# number of (transaction hash, is pending) results of processing transactions
+# to remember, so repeat sightings of a transaction can skip the lookups
+PROCESSED_TRANSACTIONS_CACHE_SIZE = 10000
+
+# number of eth_getTransactionByHash calls sent in a single bulk request
+# and the number of bulk requests to have in flight at once
+UNCONFIRMED_TRANSACTIONS_BATCH_SIZE = 100
+UNCONFIRMED_TRANSACTIONS_CONCURRENCY = 4
+# how long to wait for a pending tx hash to be found before giving up on it
+UNCONFIRMED_TRANSACTION_TIMEOUT = 60
+
+FILTER_NOTIFICATION_BATCH_SIZE = 1000
+# max number of status updates sent to the manager in a single task
+# when `batch_status_updates` is enabled
+STATUS_UPDATE_BATCH_SIZE = 500
+# how often (in seconds) the manager is asked to refresh the external gas prices
+DEFAULT_GAS_STATION_REFRESH_INTERVAL = 300
+EMPTY_LOGS_BLOOM = "0x" + ("0" * 512)
+
+# the stages block processing is broken into for timing
+BLOCK_PROCESSING_STAGES = ['fetch', 'reorg_check', 'transactions', 'commit', 'dispatch']
 
 UNCONFIRMED_TRANSACTIONS_REDIS_KEY = "toshieth.monitor:unconfirmed_txs"
+# namespace for the advisory locks held on transaction hashes while writing
+# new transactions (see `TransactionProcessor.write_transactions`)
+TRANSACTION_HASH_LOCK_ID = 0x7478
+
+# when transaction processing is sharded across workers, the number of
+# shards still processing a block's transactions is kept in this key, and
+# the status updates they leave for the monitor to send in this one
+TRANSACTION_SHARD_BARRIER_KEY = "toshieth.monitor:shard_barrier:{}"
+TRANSACTION_SHARD_STATUS_UPDATES_KEY = "{}:status_updates"
+TRANSACTION_SHARD_BARRIER_EXPIRY = 3600
+TRANSACTION_SHARD_POLL_INTERVAL = 0.01
+# how long to wait for the workers before giving up on the block
+TRANSACTION_SHARD_TIMEOUT = 120
 
 log = logging.getLogger("toshieth.monitor")
 
@@ -34,22 +96,630 @@ JSONRPC_ERRORS = (HTTPError,
                   ConnectionRefusedError,  # Server isn't running
                   OSError,  # No route to host
                   JsonRPCError,  #
+                  asyncio.TimeoutError,  # Node pool request timed out
                  )
 
-class BlockMonitor:
+def decode_erc20_transfers(transaction, known_tokens):
+    """Finds the erc20 token transfers in the transaction. For confirmed transactions
+    these come from the transaction's logs (only for tokens in `known_tokens`), for
+    pending transactions this is a guess based off the transaction's input.
+
+    Returns a list of tuples in the form:
+      (contract_address, transaction_log_index, from_address, to_address, value, status)
+    """
+
+    erc20_transfers = []
+    if transaction['blockNumber'] is not None and \
+       'logs' in transaction and \
+       len(transaction['logs']) > 0:
+
+        transfers, invalid_logs = decode_token_logs(transaction['logs'], known_tokens)
+        for _log in invalid_logs:
+            log.warning('Got invalid erc20 Transfer event in tx: {}'.format(transaction['hash']))
+        for _, contract_address, transaction_log_index, erc20_from_address, erc20_to_address, erc20_value in transfers:
+            erc20_transfers.append((contract_address, transaction_log_index, erc20_from_address, erc20_to_address, hex(erc20_value), 'confirmed'))
+
+    elif transaction['blockNumber'] is None:
+        # transaction is pending, attempt to guess if this is a token
+        # transaction based off it's input
+        if transaction['input']:
+            data = transaction['input']
+            to_address = transaction['to'] or "0x"
+            if (data.startswith("0xa9059cbb") and len(data) == 138) or (data.startswith("0x23b872dd") and len(data) == 202):
+                token_value = hex(int(data[-64:], 16))
+                if data.startswith("0x23b872dd"):
+                    erc20_from_address = "0x" + data[34:74]
+                    erc20_to_address = "0x" + data[98:138]
+                else:
+                    erc20_from_address = transaction['from']
+                    erc20_to_address = "0x" + data[34:74]
+                erc20_transfers.append((to_address, 0, erc20_from_address, erc20_to_address, token_value, 'unconfirmed'))
+            # special WETH handling
+            elif data == '0xd0e30db0' and transaction['to'] == WETH_CONTRACT_ADDRESS:
+                erc20_transfers.append((WETH_CONTRACT_ADDRESS, 0, "0x0000000000000000000000000000000000000000", transaction['from'], transaction['value'], 'unconfirmed'))
+            elif data.startswith('0x2e1a7d4d') and len(data) == 74:
+                token_value = hex(int(data[-64:], 16))
+                erc20_transfers.append((WETH_CONTRACT_ADDRESS, 0, transaction['from'], "0x0000000000000000000000000000000000000000", token_value, 'unconfirmed'))
+
+    return erc20_transfers
+
+def decode_block_erc20_transfers(transactions, known_tokens):
+    """Does the same as `decode_erc20_transfers` for all the given transactions,
+    decoding the logs for all the confirmed transactions in a single pass.
+
+    Returns a dict of transaction hash -> list of erc20 transfers"""
+
+    erc20_transfers = {}
+    logs_list = []
+    for transaction in transactions:
+        if transaction['blockNumber'] is not None:
+            erc20_transfers[transaction['hash']] = []
+            logs_list.extend(transaction.get('logs', []))
+        else:
+            erc20_transfers[transaction['hash']] = decode_erc20_transfers(transaction, known_tokens)
+
+    transfers, invalid_logs = decode_token_logs(logs_list, known_tokens)
+    for _log in invalid_logs:
+        log.warning('Got invalid erc20 Transfer event in tx: {}'.format(_log['transactionHash']))
+    for transaction_hash, contract_address, transaction_log_index, erc20_from_address, erc20_to_address, erc20_value in transfers:
+        erc20_transfers.setdefault(transaction_hash, []).append(
+            (contract_address, transaction_log_index, erc20_from_address, erc20_to_address, hex(erc20_value), 'confirmed'))
+    return erc20_transfers
+
+def attach_logs(transactions, logs_list):
+    """Adds the logs from the list to the transactions they belong to"""
+
+    logs = {}
+    for _log in logs_list:
+        if _log['transactionHash'] not in logs:
+            logs[_log['transactionHash']] = [_log]
+        else:
+            logs[_log['transactionHash']].append(_log)
+
+    for tx in transactions:
+        if tx['hash'] in logs:
+            tx['logs'] = logs[tx['hash']]
+
+def transaction_shard(from_address, shards):
+    """Returns which of the transaction processing shards handles transactions
+    from the given address"""
+    return zlib.crc32(from_address.encode('utf-8')) % shards
+
+class TransactionContext:
+    """The results of the database lookups needed to process a set of
+    transactions (see `BlockMonitor.prefetch_transaction_context`)"""
+
+    def __init__(self):
+        # the subset of the transactions' addresses with registrations
+        self.registered_addresses = set()
+        self.token_registered_addresses = set()
+        # the subset of the Transfer log addresses that are known tokens
+        self.known_tokens = set()
+        # (from_address, nonce) -> [transactions rows]
+        self.db_transactions = {}
+        # transaction hash -> decode_erc20_transfers result
+        self.erc20_transfers = {}
+        # transaction hash -> transaction_id (or False) for the transactions
+        # found in the processed transactions cache
+        self.processed = {}
+
+    def is_registered(self, *addresses):
+        return any(address in self.registered_addresses for address in addresses)
+
+    def is_token_registered(self, *addresses):
+        return any(address in self.token_registered_addresses for address in addresses)
+
+    def get_db_transactions(self, from_address, nonce):
+        return self.db_transactions.get((from_address, nonce), [])
+
+    def get_erc20_transfers(self, transaction):
+        if transaction['hash'] not in self.erc20_transfers:
+            self.erc20_transfers[transaction['hash']] = decode_erc20_transfers(transaction, self.known_tokens)
+        return self.erc20_transfers[transaction['hash']]
+
+class TransactionWrites:
+    """The database writes and status updates resulting from processing a set
+    of transactions, collected so they can be written using a single database
+    transaction (see `BlockMonitor.write_transactions`)"""
+
+    def __init__(self):
+        # [(blocknumber, transaction_id)] for confirmed transactions moved by a reorg
+        self.blocknumber_updates = []
+        # [(transaction, from_address, to_address, erc20_transfers, status)]
+        self.new_transactions = []
+        # [(transaction_id, transaction_log_index, contract_address, from_address, to_address, value, status)]
+        self.token_transactions = []
+        # [(transaction_id, status, transaction_hash)] to send to the manager once the writes are committed
+        self.status_updates = []
+        # [(transaction_hash, is_pending, transaction_id or False, registrations generation)]
+        # to add to the processed transactions cache once the writes are committed
+        self.processed = []
+
+class RecentBlocks:
+    """In memory copy of the most recent rows of the blocks table, used to
+    check parent hashes and find fork points without querying the database.
+
+    Blocks below `lowest` have been dropped from the buffer and have to be
+    looked up in the database.
+    """
+
+    def __init__(self, size=RECENT_BLOCKS_SIZE):
+        self.size = size
+        # blocknumber -> {'hash', 'parent_hash', 'stale'}
+        self.blocks = {}
+        self.lowest = 0
+
+    async def load(self, con):
+        rows = await con.fetch("SELECT blocknumber, hash, parent_hash, stale FROM blocks "
+                               "ORDER BY blocknumber DESC LIMIT $1",
+                               self.size)
+        self.blocks = {row['blocknumber']: {'hash': row['hash'], 'parent_hash': row['parent_hash'], 'stale': row['stale']}
+                       for row in rows}
+        # if the table had fewer rows than the size of the buffer, the
+        # buffer has everything
+        self.lowest = min(self.blocks) if len(rows) >= self.size else 0
+
+    def covers(self, block_number):
+        return block_number >= self.lowest
+
+    def get(self, block_number):
+        return self.blocks.get(block_number)
+
+    def add(self, block_number, block_hash, parent_hash):
+        self.blocks[block_number] = {'hash': block_hash, 'parent_hash': parent_hash, 'stale': False}
+        if len(self.blocks) > self.size:
+            for old_block_number in sorted(self.blocks)[:len(self.blocks) - self.size]:
+                del self.blocks[old_block_number]
+                self.lowest = old_block_number + 1
+
+    def mark_stale(self, after_block_number):
+        for block_number, block in self.blocks.items():
+            if block_number > after_block_number:
+                block['stale'] = True
+
+class ProcessedTransactions:
+    """LRU cache of the outcome of processing transactions, keyed by the
+    transaction's hash and whether it was pending, so that seeing the same
+    transaction again (e.g. from both the pending transaction filter and the
+    unconfirmed transaction check) can skip straight to the status update.
+
+    The outcome is the transaction_id of the transaction's row, or False if
+    no one was interested in the transaction. As the latter depends on the
+    registrations at the time, it's stored with the registrations' generation
+    and ignored once they've changed.
+    """
+
+    def __init__(self, size=PROCESSED_TRANSACTIONS_CACHE_SIZE):
+        self.size = size
+        # (transaction_hash, is_pending) -> (transaction_id or False, generation)
+        self.transactions = OrderedDict()
+
+    def get(self, transaction_hash, is_pending, generation):
+        """Returns the transaction_id (or False) for the transaction, or None if
+        the transaction hasn't been processed (or the outcome is out of date)"""
+
+        key = (transaction_hash, is_pending)
+        entry = self.transactions.get(key)
+        if entry is None:
+            return None
+        transaction_id, entry_generation = entry
+        if transaction_id is False and (generation is None or entry_generation != generation):
+            del self.transactions[key]
+            return None
+        self.transactions.move_to_end(key)
+        return transaction_id
+
+    def add(self, transaction_hash, is_pending, transaction_id, generation=None):
+        if transaction_id is False and generation is None:
+            return
+        key = (transaction_hash, is_pending)
+        self.transactions[key] = (transaction_id, generation)
+        self.transactions.move_to_end(key)
+        while len(self.transactions) > self.size:
+            self.transactions.popitem(last=False)
+
+    def discard(self, transaction_hash):
+        self.transactions.pop((transaction_hash, True), None)
+        self.transactions.pop((transaction_hash, False), None)
+
+class TransactionProcessor:
+    """Works out and writes the database changes for transactions seen by the
+    block monitor. Needs `db_pool`, `registrations`, `processed_transactions`,
+    `eth`, `_fetch_receipts` and `_batch_status_updates` to be set up by the
+    subclass"""
+
+    async def process_transactions(self, transactions, reorg_block_numbers):
+        """Processes the given transactions and writes the changes in a single
+        database transaction. `reorg_block_numbers` are the blocks that are
+        replacing blocks that were already processed.
+
+        Returns the status updates for the manager rather than sending them,
+        as the block the transactions are from may not have been written yet
+        (see `BlockMonitor.process_transaction_shards`)"""
+
+        context = await self.prefetch_transaction_context(transactions, reorg_block_numbers)
+        writes = TransactionWrites()
+        for tx in transactions:
+            await self.process_transaction(tx, is_reorg=parse_int(tx['blockNumber']) in reorg_block_numbers,
+                                           context=context, writes=writes)
+        async with self.db_pool.acquire() as con:
+            async with con.transaction():
+                await self.write_transactions(con, writes)
+        self.remember_processed(writes)
+        return writes.status_updates
+
+    async def prefetch_transaction_context(self, transactions, reorg_block_numbers=()):
+        """Resolves everything `process_transaction` needs from the database
+        for the given transactions using a fixed number of queries, rather
+        than a handful of queries per transaction.
+
+        Transactions in the processed transactions cache are left out, unless
+        they're in one of the `reorg_block_numbers`"""
+
+        context = TransactionContext()
+        generation = self.registrations.generation if self.registrations.ready else None
+        unprocessed_transactions = []
+        for transaction in transactions:
+            transaction_id = None
+            if transaction['blockNumber'] is None or parse_int(transaction['blockNumber']) not in reorg_block_numbers:
+                transaction_id = self.processed_transactions.get(
+                    transaction['hash'], transaction['blockNumber'] is None, generation)
+            if transaction_id is None:
+                unprocessed_transactions.append(transaction)
+            else:
+                context.processed[transaction['hash']] = transaction_id
+        transactions = unprocessed_transactions
+        if not transactions:
+            return context
+
+        token_addresses = set()
+        for transaction in transactions:
+            if transaction['blockNumber'] is not None:
+                for _log in transaction.get('logs', []):
+                    if len(_log['topics']) > 0 and _log['topics'][0] == TRANSFER_TOPIC:
+                        token_addresses.add(_log['address'])
+
+        async with self.db_pool.acquire() as con:
+            if token_addresses:
+                if self.registrations.ready:
+                    context.known_tokens = token_addresses & self.registrations.known_tokens
+                else:
+                    rows = await con.fetch("SELECT contract_address FROM tokens WHERE contract_address = ANY($1)",
+                                           list(token_addresses))
+                    context.known_tokens = set(row['contract_address'] for row in rows)
+
+            rows = await con.fetch(
+                "SELECT tx.* FROM transactions tx "
+                "JOIN unnest($1::varchar[], $2::bigint[]) AS k (from_address, nonce) "
+                "ON tx.from_address = k.from_address AND tx.nonce = k.nonce",
+                [transaction['from'] for transaction in transactions],
+                [parse_int(transaction['nonce']) for transaction in transactions])
+            for row in rows:
+                context.db_transactions.setdefault((row['from_address'], row['nonce']), []).append(row)
+
+            context.erc20_transfers = decode_block_erc20_transfers(transactions, context.known_tokens)
+            addresses = set()
+            for transaction in transactions:
+                addresses.add(transaction['from'])
+                addresses.add(transaction['to'] or "0x")
+            for erc20_transfers in context.erc20_transfers.values():
+                for _, _, erc20_from_address, erc20_to_address, _, _ in erc20_transfers:
+                    addresses.add(erc20_from_address)
+                    addresses.add(erc20_to_address)
+
+            if self.registrations.ready:
+                context.registered_addresses = set(
+                    address for address in addresses if self.registrations.is_registered(address))
+                context.token_registered_addresses = set(
+                    address for address in addresses if self.registrations.is_token_registered(address))
+            else:
+                rows = await con.fetch("SELECT DISTINCT eth_address FROM notification_registrations "
+                                       "WHERE eth_address = ANY($1)",
+                                       list(addresses))
+                context.registered_addresses = set(row['eth_address'] for row in rows)
+                rows = await con.fetch("SELECT eth_address FROM token_registrations "
+                                       "WHERE eth_address = ANY($1)",
+                                       list(addresses))
+                context.token_registered_addresses = set(row['eth_address'] for row in rows)
+
+        return context
+
+    @log_unhandled_exceptions(logger=log)
+    async def process_transaction(self, transaction, is_reorg=False, context=None, writes=None):
+        """Works out what needs to be written to the database for the transaction.
+
+        If `writes` is given the changes are added to it, and it's up to the caller
+        to write them out using `write_transactions` and then `send_status_updates`,
+        otherwise they are written straight away"""
+
+        if context is None:
+            context = await self.prefetch_transaction_context(
+                [transaction], [parse_int(transaction['blockNumber'])] if is_reorg else ())
+
+        if writes is not None:
+            self.collect_transaction_writes(transaction, is_reorg, context, writes)
+            return
+
+        writes = TransactionWrites()
+        self.collect_transaction_writes(transaction, is_reorg, context, writes)
+        async with self.db_pool.acquire() as con:
+            async with con.transaction():
+                await self.write_transactions(con, writes)
+        self.send_status_updates(writes)
+
+    def collect_transaction_writes(self, transaction, is_reorg, context, writes):
+
+        is_pending = transaction['blockNumber'] is None
+        if transaction['hash'] in context.processed:
+            # already been through here, only the status update is needed
+            transaction_id = context.processed[transaction['hash']]
+            if transaction_id is not False:
+                writes.status_updates.append((transaction_id, 'unconfirmed' if is_pending else 'confirmed',
+                                              transaction['hash']))
+            return
+
+        to_address = transaction['to']
+        # make sure we use a valid encoding of "empty" for contract deployments
+        if to_address is None:
+            to_address = "0x"
+        from_address = transaction['from']
+
+        # find if we have a record of this tx by checking the from address and nonce
+        db_txs = context.get_db_transactions(from_address, parse_int(transaction['nonce']))
+        if len(db_txs) > 1:
+            # see if one has the same hash
+            db_tx = next((tx for tx in db_txs if tx['hash'] == transaction['hash'] and tx['status'] != 'error'), None)
+            if db_tx is None:
+                # find if there are any that aren't marked as error
+                no_error = [tx for tx in db_txs if tx['hash'] != transaction['hash'] and tx['status'] != 'error']
+                if len(no_error) == 1:
+                    db_tx = no_error[0]
+                elif len(no_error) != 0:
+                    log.warning("Multiple transactions from '{}' exist with nonce '{}' in unknown state")
+
+        elif len(db_txs) == 1:
+            db_tx = db_txs[0]
+        else:
+            db_tx = None
+
+        # if we have a previous transaction, do some checking to see what's going on
+        # see if this is an overwritten transaction
+        # if the status of the old tx was previously an error, we don't care about it
+        # otherwise, we have to notify the interested parties of the overwrite
+
+        if db_tx and db_tx['hash'] != transaction['hash'] and db_tx['status'] != 'error':
+
+            if db_tx['v'] is not None:
+                log.warning("found overwritten transaction!")
+                log.warning("tx from: {}".format(from_address))
+                log.warning("nonce: {}".format(parse_int(transaction['nonce'])))
+                log.warning("old tx hash: {}".format(db_tx['hash']))
+                log.warning("new tx hash: {}".format(transaction['hash']))
+
+            writes.status_updates.append((db_tx['transaction_id'], 'error', db_tx['hash']))
+            db_tx = None
+
+        # if reorg, and the transaction is confirmed, just update which block it was included in
+        if is_reorg and db_tx and db_tx['hash'] == transaction['hash'] and db_tx['status'] == 'confirmed':
+            if transaction['blockNumber'] is None:
+                log.error("Unexpectedly got unconfirmed transaction again after reorg. hash: {}".format(db_tx['hash']))
+                # this shouldn't really happen. going to log and abort
+                return
+            new_blocknumber = parse_int(transaction['blockNumber'])
+            if new_blocknumber != db_tx['blocknumber']:
+                writes.blocknumber_updates.append((new_blocknumber, db_tx['transaction_id']))
+            return
+
+        # check for erc20 transfers
+        erc20_transfers = []
+        if transaction['blockNumber'] is not None:
+            # only keep the transfers for addresses we're tracking tokens for
+            for erc20_transfer in context.get_erc20_transfers(transaction):
+                _, _, erc20_from_address, erc20_to_address, _, _ = erc20_transfer
+                if context.is_token_registered(erc20_from_address, erc20_to_address):
+                    erc20_transfers.append(erc20_transfer)
+        elif db_tx is None:
+            # transaction is pending, use the guesses based off the input
+            erc20_transfers = context.get_erc20_transfers(transaction)
+
+        if db_tx:
+            is_interesting = True
+        else:
+            # find out if there is anyone interested in this transaction
+            is_interesting = context.is_registered(to_address, from_address)
+        if not is_interesting and len(erc20_transfers) > 0:
+            for _, _, erc20_from_address, erc20_to_address, _, _ in erc20_transfers:
+                is_interesting = context.is_registered(erc20_to_address, erc20_from_address) or \
+                    context.is_token_registered(erc20_to_address, erc20_from_address)
+                if is_interesting:
+                    break
+
+        if not is_interesting:
+            if self.registrations.ready:
+                writes.processed.append((transaction['hash'], is_pending, False, self.registrations.generation))
+            return
+
+        status = 'confirmed' if transaction['blockNumber'] is not None else 'unconfirmed'
+        # only keep the transfers that someone is interested in
+        interesting_erc20_transfers = []
+        for erc20_transfer in erc20_transfers:
+            _, _, erc20_from_address, erc20_to_address, _, _ = erc20_transfer
+            if context.is_registered(erc20_to_address, erc20_from_address) or \
+               context.is_token_registered(erc20_to_address, erc20_from_address):
+                interesting_erc20_transfers.append(erc20_transfer)
+        erc20_transfers = interesting_erc20_transfers
+
+        if db_tx is None:
+            # add it to the database and trigger an update once it's been written
+            writes.new_transactions.append((transaction, from_address, to_address, erc20_transfers, status))
+        else:
+            for erc20_contract_address, transaction_log_index, erc20_from_address, erc20_to_address, erc20_value, erc20_status in erc20_transfers:
+                writes.token_transactions.append((
+                    db_tx['transaction_id'], transaction_log_index, erc20_contract_address,
+                    erc20_from_address, erc20_to_address, erc20_value, erc20_status))
+            writes.status_updates.append((db_tx['transaction_id'], status, db_tx['hash']))
+            if db_tx['hash'] == transaction['hash']:
+                writes.processed.append((transaction['hash'], is_pending, db_tx['transaction_id'], None))
+
+    async def write_transactions(self, con, writes):
+        """Writes the changes collected by `process_transaction` using the given
+        connection. Should be called inside a database transaction"""
+
+        if writes.blocknumber_updates:
+            await con.executemany(
+                "UPDATE transactions SET blocknumber = $1 "
+                "WHERE transaction_id = $2",
+                writes.blocknumber_updates)
+
+        if writes.new_transactions:
+            # the same transaction can be written by the pending transaction
+            # processing and by block processing at the same time, so hold a
+            # lock on each hash until the database transaction ends and use
+            # the rows that were written by the other side in the meantime
+            await con.execute(
+                "SELECT pg_advisory_xact_lock($1, hashtext(k.hash)) FROM unnest($2::varchar[]) AS k (hash)",
+                TRANSACTION_HASH_LOCK_ID,
+                sorted(set(transaction['hash'] for transaction, _, _, _, _ in writes.new_transactions)))
+            rows = await con.fetch(
+                "SELECT hash, MAX(transaction_id) AS transaction_id FROM transactions "
+                "WHERE hash = ANY($1) AND status != 'error' GROUP BY hash",
+                [transaction['hash'] for transaction, _, _, _, _ in writes.new_transactions])
+            transaction_ids = {row['hash']: row['transaction_id'] for row in rows}
+            new_transactions = [new_transaction for new_transaction in writes.new_transactions
+                                if new_transaction[0]['hash'] not in transaction_ids]
+            transactions = [transaction for transaction, _, _, _, _ in new_transactions]
+            rows = await con.fetch(
+                "INSERT INTO transactions "
+                "(hash, from_address, to_address, nonce, "
+                "value, gas, gas_price, "
+                "data) "
+                "SELECT * FROM unnest($1::varchar[], $2::varchar[], $3::varchar[], $4::bigint[], "
+                "$5::varchar[], $6::varchar[], $7::varchar[], $8::varchar[]) "
+                "RETURNING transaction_id, hash",
+                [transaction['hash'] for transaction in transactions],
+                [from_address for _, from_address, _, _, _ in new_transactions],
+                [to_address for _, _, to_address, _, _ in new_transactions],
+                [parse_int(transaction['nonce']) for transaction in transactions],
+                [hex(parse_int(transaction['value'])) for transaction in transactions],
+                [hex(parse_int(transaction['gas'])) for transaction in transactions],
+                [hex(parse_int(transaction['gasPrice'])) for transaction in transactions],
+                [transaction['input'] for transaction in transactions])
+            transaction_ids.update((row['hash'], row['transaction_id']) for row in rows)
+
+            for transaction, _, _, erc20_transfers, status in writes.new_transactions:
+                transaction_id = transaction_ids[transaction['hash']]
+                for erc20_contract_address, transaction_log_index, erc20_from_address, erc20_to_address, erc20_value, erc20_status in erc20_transfers:
+                    writes.token_transactions.append((
+                        transaction_id, transaction_log_index, erc20_contract_address,
+                        erc20_from_address, erc20_to_address, erc20_value, erc20_status))
+                writes.status_updates.append((transaction_id, status, transaction['hash']))
+                writes.processed.append((transaction['hash'], status == 'unconfirmed', transaction_id, None))
+            writes.new_transactions = []
+
+        if writes.token_transactions:
+            await con.executemany(
+                "INSERT INTO token_transactions "
+                "(transaction_id, transaction_log_index, contract_address, from_address, to_address, value, status) "
+                "VALUES ($1, $2, $3, $4, $5, $6, $7) "
+                "ON CONFLICT (transaction_id, transaction_log_index) DO UPDATE "
+                "SET from_address = EXCLUDED.from_address, to_address = EXCLUDED.to_address, value = EXCLUDED.value",
+                writes.token_transactions)
+
+    async def fetch_confirmed_receipts(self, writes):
+        """If `fetch_receipts` is enabled, fetches the receipts for the transactions
+        the writes confirm in a single bulk request, so they can be sent to the
+        manager with the status update rather than the manager fetching each
+        of them again.
+
+        Returns a dict of transaction hash -> receipt (with only the fields the
+        manager needs)"""
+
+        if not self._fetch_receipts:
+            return {}
+        tx_hashes = [tx_hash for _, status, tx_hash in writes.status_updates if status == 'confirmed']
+        if not tx_hashes:
+            return {}
+
+        bulk = self.eth.bulk()
+        futures = [bulk.eth_getTransactionReceipt(tx_hash) for tx_hash in tx_hashes]
+        try:
+            await bulk.execute()
+        except:
+            # the manager will fetch them itself
+            log.exception("Error fetching transaction receipts")
+            return {}
+
+        receipts = {}
+        for tx_hash, future in zip(tx_hashes, futures):
+            receipt = unwrap_or(future, None)
+            if receipt is None or receipt['blockNumber'] is None:
+                continue
+            receipts[tx_hash] = {
+                'transactionHash': receipt['transactionHash'],
+                'blockNumber': receipt['blockNumber'],
+                'logs': None if receipt['logs'] is None else [
+                    {'address': _log['address'], 'topics': _log['topics'], 'data': _log['data']}
+                    for _log in receipt['logs']]
+            }
+        return receipts
+
+    def remember_processed(self, writes):
+        """Adds the transactions from the committed writes to the processed
+        transactions cache"""
+
+        for transaction_hash, is_pending, transaction_id, generation in writes.processed:
+            self.processed_transactions.add(transaction_hash, is_pending, transaction_id, generation)
+        for _, status, tx_hash in writes.status_updates:
+            if status == 'error':
+                # the transaction has been overwritten
+                self.processed_transactions.discard(tx_hash)
+
+    def send_status_updates(self, writes, receipts=None):
+        """Sends the status updates for the committed writes to the manager and
+        remembers the processed transactions"""
+
+        self.remember_processed(writes)
+        updates = []
+        for transaction_id, status, tx_hash in writes.status_updates:
+            receipt = receipts.get(tx_hash) if receipts and status == 'confirmed' else None
+            updates.append((transaction_id, status, receipt))
+
+        if not self._batch_status_updates:
+            # confirmations are always sent together, so the manager can fetch
+            # everything it needs from the node for them in one go, and retry
+            # them together if the node is behind
+            confirmations = [update for update in updates if update[1] == 'confirmed']
+            if len(confirmations) > 1:
+                updates = [update for update in updates if update[1] != 'confirmed']
+                for i in range(0, len(confirmations), STATUS_UPDATE_BATCH_SIZE):
+                    manager_dispatcher.update_transactions(confirmations[i:i + STATUS_UPDATE_BATCH_SIZE])
+        elif len(updates) > 1:
+            for i in range(0, len(updates), STATUS_UPDATE_BATCH_SIZE):
+                manager_dispatcher.update_transactions(updates[i:i + STATUS_UPDATE_BATCH_SIZE])
+            return
+        for transaction_id, status, receipt in updates:
+            if receipt is not None:
+                manager_dispatcher.update_transaction(transaction_id, status, receipt=receipt)
+            else:
+                manager_dispatcher.update_transaction(transaction_id, status)
+
+class BlockMonitor(TransactionProcessor):
 
     def __init__(self):
         configure_logger(log)
 
         if 'monitor' in config:
-            node_url = config['monitor']['url']
+            node_section = 'monitor'
         else:
             log.warning("monitor using config['ethereum'] node")
-            node_url = config['ethereum']['url']
-
-        self.eth = JsonRPCClient(node_url,
-                                 connect_timeout=5.0,
-                                 request_timeout=10.0)
+            node_section = 'ethereum'
+        node_url = config[node_section]['url']
+
+        # if multiple nodes are configured, stick to one at a time so that
+        # blocks and their logs come from the same node
+        self.eth = create_jsonrpc_client(node_section, sticky=True, hedge=False,
+                                         connect_timeout=5.0,
+                                         request_timeout=10.0)
         # filter health processes depend on some of the calls failing on the first time
         # so we have a separate client to handle those
         self.filter_eth = JsonRPCClient(node_url,
@@ -65,12 +735,56 @@ class BlockMonitor:
         self._sanity_check_process = None
         self._process_unconfirmed_transactions_process = None
 
+        if 'monitor' in config:
+            self._block_prefetch_window = config['monitor'].getint('block_prefetch_window', DEFAULT_BLOCK_PREFETCH_WINDOW)
+            self._db_concurrency = config['monitor'].getint('db_concurrency', 0)
+            self._transaction_shards = config['monitor'].getint('transaction_shards', 0)
+            self._fetch_receipts = config['monitor'].getboolean('fetch_receipts', False)
+            self._block_events_maxlen = config['monitor'].getint('block_events_maxlen', 0)
+            self._batch_status_updates = config['monitor'].getboolean('batch_status_updates', False)
+            gas_price_window = config['monitor'].getint('gas_price_window', DEFAULT_GAS_PRICE_WINDOW)
+            self._gas_station_refresh_interval = config['monitor'].getint(
+                'gas_station_refresh_interval', DEFAULT_GAS_STATION_REFRESH_INTERVAL)
+        else:
+            self._block_prefetch_window = DEFAULT_BLOCK_PREFETCH_WINDOW
+            self._db_concurrency = 0
+            self._transaction_shards = 0
+            self._fetch_receipts = False
+            self._block_events_maxlen = 0
+            self._batch_status_updates = False
+            gas_price_window = DEFAULT_GAS_PRICE_WINDOW
+            self._gas_station_refresh_interval = DEFAULT_GAS_STATION_REFRESH_INTERVAL
+        # blocknumber -> task fetching the block and it's logs
+        self._prefetched_blocks = {}
+        self._head_block_number = None
+        self.recent_blocks = RecentBlocks()
+
+        self.registrations = RegistrationCache()
+        self.processed_transactions = ProcessedTransactions()
+        self.gas_price_estimator = GasPriceEstimator(gas_price_window)
+        self._last_gas_station_refresh = None
+
+        # if the node has a websocket interface, use it to get new heads and
+        # pending transactions pushed to us instead of polling for them
+        if 'monitor' in config and config['monitor'].get('ws_url'):
+            self.subscription = NodeSubscription(config['monitor']['ws_url'],
+                                                 self.on_new_head,
+                                                 self.on_new_pending_transaction,
+                                                 on_connection_lost=self.on_subscription_lost,
+                                                 head_timeout=FILTER_TIMEOUT)
+        else:
+            self.subscription = None
+        self._subscribed_pending_transactions = []
+        self._store_pending_transactions_process = None
+
         self._new_pending_transaction_filter_id = None
         self._last_saw_new_block = asyncio.get_event_loop().time()
         self._shutdown = False
 
         self._lastlog = 0
         self._blocktimes = []
+        # stage -> total time spent in the stage since the last reset
+        self.stage_times = dict.fromkeys(BLOCK_PROCESSING_STAGES, 0.0)
 
     def start(self):
         if not hasattr(self, '_startup_future'):
@@ -85,6 +799,12 @@ class BlockMonitor:
         self.pool = await prepare_database(handle_migration=False)
         await prepare_redis()
 
+        # the pool is shared with everything else running in the process, so
+        # by default only let block processing use half of it at once
+        db_concurrency = self._db_concurrency or \
+            max(1, getattr(self.pool, '_maxsize', DEFAULT_DB_POOL_SIZE) // 2)
+        self.db_pool = LimitedPool(self.pool, db_concurrency)
+
         async with self.pool.acquire() as con:
             # check for the last non stale block processed
             row = await con.fetchrow("SELECT blocknumber FROM blocks WHERE stale = FALSE ORDER BY blocknumber DESC LIMIT 1")
@@ -100,11 +820,19 @@ class BlockMonitor:
         else:
             last_block_number = row['blocknumber']
 
+        async with self.pool.acquire() as con:
+            await self.recent_blocks.load(con)
+
         self.last_block_number = last_block_number
         self._shutdown = False
 
+        await self.registrations.start(self.pool)
+
         await self.register_filters()
 
+        if self.subscription is not None:
+            self.subscription.start()
+
         self.schedule_filter_poll()
 
         self._startup_future.set_result(True)
@@ -166,122 +894,546 @@ class BlockMonitor:
 
         self._process_unconfirmed_transactions_process = asyncio.get_event_loop().create_task(self.process_unconfirmed_transactions())
 
+    @property
+    def receiving_new_heads(self):
+        """True if new blocks are being pushed from the node's websocket
+        subscription, so there is no need to poll for them"""
+        return self.subscription is not None and self.subscription.heads_subscribed and \
+            asyncio.get_event_loop().time() - self.subscription.last_head_time < FILTER_TIMEOUT
+
+    @property
+    def receiving_new_pending_transactions(self):
+        return self.subscription is not None and self.subscription.pending_transactions_subscribed
+
+    def on_new_head(self, header):
+        block_number = parse_int(header['number'])
+        if self._head_block_number is None or block_number > self._head_block_number:
+            self._head_block_number = block_number
+        if block_number > self.last_block_number:
+            self.run_block_check()
+
+    def on_new_pending_transaction(self, tx_hash):
+        self._subscribed_pending_transactions.append(tx_hash)
+        if self._shutdown:
+            return
+        if self._store_pending_transactions_process is None or self._store_pending_transactions_process.done():
+            self._store_pending_transactions_process = asyncio.get_event_loop().create_task(
+                self.store_subscribed_pending_transactions())
+
+    def on_subscription_lost(self):
+        # the pending transaction filter will have timed out if it wasn't
+        # polled while the subscription was active, so get a new one before
+        # falling back on polling
+        if not self._shutdown:
+            self._new_pending_transaction_filter_id = None
+            asyncio.get_event_loop().create_task(self.register_new_pending_transaction_filter())
+
     @log_unhandled_exceptions(logger=log)
-    async def block_check(self):
-        while not self._shutdown:
-            try:
-                block = await self.eth.eth_getBlockByNumber(self.last_block_number + 1)
-            except:
-                log.exception("Failed eth_getBlockByNumber call")
-                break
-            if block:
-                manager_dispatcher.update_default_gas_price(self.last_block_number + 1)
-                self._last_saw_new_block = asyncio.get_event_loop().time()
-                processing_start_time = asyncio.get_event_loop().time()
-                if self._lastlog + 300 < asyncio.get_event_loop().time():
-                    self._lastlog = asyncio.get_event_loop().time()
-                    log.info("Processing block {}".format(block['number']))
-                    if len(self._blocktimes) > 0:
-                        log.info("Average processing time per last {} blocks: {}".format(len(self._blocktimes), sum(self._blocktimes) / len(self._blocktimes)))
-
-                # check for reorg
-
-                async with self.pool.acquire() as con:
-                    last_block = await con.fetchrow("SELECT * FROM blocks WHERE blocknumber = $1", self.last_block_number)
-                # if we don't have the previous block, do a quick sanity check to see if there's any blocks lower
-                if last_block is None:
-                    async with self.pool.acquire() as con:
-                        last_block_number = await con.fetchval(
-                            "SELECT blocknumber FROM blocks "
-                            "WHERE blocknumber < $1 "
-                            "ORDER BY blocknumber DESC LIMIT 1",
-                            self.last_block_number)
-                    if last_block_number:
-                        log.warning("found gap in blocks @ block number: #{}".format(last_block_number + 1))
-                        # roll back to the last block number and sync up
-                        self.last_block_number = last_block_number
-                        continue
-                else:
-                    # make sure hash of the last block is the same as the current hash's parent block
-                    if last_block['hash'] != block['parentHash']:
-                        # we have a reorg!
-                        success = await self.handle_reorg()
-                        if success:
-                            continue
-                        # if we didn't find a reorg point, continue on as normal to avoid
-                        # preventing the system from operating as a whole
+    async def store_subscribed_pending_transactions(self):
+        # everything received while the previous write was in flight
+        # gets written out together
+        while self._subscribed_pending_transactions and not self._shutdown:
+            tx_hashes, self._subscribed_pending_transactions = self._subscribed_pending_transactions, []
+            await self.add_unconfirmed_transactions(tx_hashes)
+            self.run_process_unconfirmed_transactions()
+
+    async def add_unconfirmed_transactions(self, tx_hashes):
+        """Adds the transaction hashes to the list of unprocessed transactions"""
+        if not tx_hashes:
+            return
+        created = int(asyncio.get_event_loop().time())
+        pipe = self.redis.pipeline()
+        for tx_hash in tx_hashes:
+            pipe.hsetnx(UNCONFIRMED_TRANSACTIONS_REDIS_KEY, tx_hash, created)
+        await pipe.execute()
 
-                # check if we're reorging
-                async with self.pool.acquire() as con:
-                    is_reorg = await con.fetchval("SELECT 1 FROM blocks WHERE blocknumber = $1", self.last_block_number + 1)
+    async def fetch_block(self, block_number):
+        """Fetches the block and the logs for the block from the node.
+        Returns a tuple of (block, logs_list), or (None, None) if the
+        block doesn't exist yet"""
 
-                if block['logsBloom'] != "0x" + ("0" * 512):
+        backoff = 0
+        while True:
+            block = await self.eth.eth_getBlockByNumber(block_number)
+            if block is None:
+                return None, None
+            if block['logsBloom'] == EMPTY_LOGS_BLOOM:
+                return block, []
+            # only ask for the logs from contracts that might have something we're interested in
+            addresses = await self.get_watched_log_addresses(block['logsBloom'])
+            if not addresses:
+                return block, []
+            logs_list = await self.eth.eth_getLogs(fromBlock=block['number'],
+                                                   toBlock=block['number'],
+                                                   address=sorted(addresses))
+            # if the block was replaced between the two calls the logs will be
+            # for a different block, start again to get a consistent result
+            if all(_log.get('blockHash') in (None, block['hash']) for _log in logs_list):
+                return block, logs_list
+            if backoff >= FETCH_BLOCK_RETRIES:
+                raise Exception("block #{} kept changing while fetching logs".format(block_number))
+            log.warning("block #{} changed while fetching logs, refetching".format(block_number))
+            backoff += 1
+            await asyncio.sleep(backoff * FETCH_BLOCK_RETRY_DELAY)
+
+    async def get_watched_log_addresses(self, logs_bloom):
+        """Returns the set of contract addresses that could have emitted logs the
+        monitor needs to process (token transfers, WETH deposits/withdrawals and
+        websocket filter registrations) according to the given logs bloom"""
+
+        logs_bloom = parse_logs_bloom(logs_bloom)
+        addresses = set()
+
+        if self.registrations.ready:
+            tokens = self.registrations.known_tokens
+            filters = [(contract_address, topic_id)
+                       for contract_address, topic_id in self.registrations.filters
+                       if contract_address is not None]
+        else:
+            async with self.db_pool.acquire() as con:
+                tokens = [row['contract_address'] for row in await con.fetch("SELECT contract_address FROM tokens")]
+                filters = [(row['contract_address'], row['topic_id']) for row in await con.fetch(
+                    "SELECT DISTINCT contract_address, topic_id FROM filter_registrations "
+                    "WHERE contract_address IS NOT NULL")]
+
+        if bloom_contains(logs_bloom, TRANSFER_TOPIC):
+            for token_address in tokens:
+                if bloom_contains(logs_bloom, token_address):
+                    addresses.add(token_address)
+        if bloom_contains(logs_bloom, WETH_CONTRACT_ADDRESS) and \
+           (bloom_contains(logs_bloom, DEPOSIT_TOPIC) or bloom_contains(logs_bloom, WITHDRAWAL_TOPIC)):
+            addresses.add(WETH_CONTRACT_ADDRESS)
+        for contract_address, topic_id in filters:
+            if contract_address not in addresses and \
+               bloom_contains(logs_bloom, contract_address, topic_id):
+                addresses.add(contract_address)
+
+        return addresses
+
+    async def match_filter_notifications(self, logs_list):
+        """Returns a list of (filter_id, topic, data) for every websocket filter
+        registration matching the given logs"""
+
+        if self.registrations.ready:
+            get_filters = self.registrations.get_filters
+        else:
+            async with self.db_pool.acquire() as con:
+                rows = await con.fetch(
+                    "SELECT filter_id, contract_address, topic_id, topic FROM filter_registrations "
+                    "WHERE contract_address = ANY($1)",
+                    list(set(event['address'] for event in logs_list)))
+            filters = {}
+            for row in rows:
+                filters.setdefault((row['contract_address'], row['topic_id']), []).append(
+                    (row['filter_id'], row['topic']))
+
+            def get_filters(contract_address, topic_id):
+                return filters.get((contract_address, topic_id), [])
+
+        notifications = []
+        for event in logs_list:
+            for topic in event['topics']:
+                for filter_id, filter_topic in get_filters(event['address'], topic):
+                    notifications.append((filter_id, filter_topic, event['data']))
+        return notifications
+
+    def prefetch_blocks(self, block_number):
+        """Makes sure the fetches for the blocks from `block_number` up to the
+        prefetch window (limited by the last known head of the chain) are in
+        flight"""
+
+        for prefetched_number in list(self._prefetched_blocks.keys()):
+            if prefetched_number < block_number:
+                self._discard_prefetched_block(prefetched_number)
+
+        last_prefetch_number = block_number
+        if self._head_block_number is not None:
+            last_prefetch_number = max(block_number, min(self._head_block_number,
+                                                         block_number + self._block_prefetch_window - 1))
+        for prefetch_number in range(block_number, last_prefetch_number + 1):
+            if prefetch_number not in self._prefetched_blocks:
+                self._prefetched_blocks[prefetch_number] = asyncio.get_event_loop().create_task(
+                    self.fetch_block(prefetch_number))
+
+    def clear_prefetched_blocks(self):
+        for prefetched_number in list(self._prefetched_blocks.keys()):
+            self._discard_prefetched_block(prefetched_number)
+
+    def _discard_prefetched_block(self, block_number):
+        task = self._prefetched_blocks.pop(block_number)
+        if task.done():
+            # make sure any exceptions are retrieved so they aren't
+            # reported as unhandled
+            if not task.cancelled():
+                task.exception()
+        else:
+            task.cancel()
+
+    @log_unhandled_exceptions(logger=log)
+    async def block_check(self):
+        try:
+            while not self._shutdown:
+                # if we're far behind process blocks in ranges until we're
+                # close enough to the head to go block by block
+                if self._head_block_number is not None and \
+                   self._head_block_number - self.last_block_number > CATCH_UP_THRESHOLD:
+                    self.clear_prefetched_blocks()
                     try:
-                        logs_list = await self.eth.eth_getLogs(fromBlock=block['number'],
-                                                               toBlock=block['number'])
+                        if await self.process_block_range(
+                                self.last_block_number + 1,
+                                min(self.last_block_number + CATCH_UP_RANGE_SIZE, self._head_block_number)):
+                            continue
                     except:
-                        log.exception("failed eth_getLogs call")
-                        break
-                    logs = {}
-                    for _log in logs_list:
-                        if _log['transactionHash'] not in logs:
-                            logs[_log['transactionHash']] = [_log]
-                        else:
-                            logs[_log['transactionHash']].append(_log)
+                        log.exception("Failed processing blocks from #{}".format(self.last_block_number + 1))
+                    # process the next block on it's own, this also takes care
+                    # of gaps and reorgs
+
+                self.prefetch_blocks(self.last_block_number + 1)
+                stage_start_time = asyncio.get_event_loop().time()
+                try:
+                    block, logs_list = await self._prefetched_blocks.pop(self.last_block_number + 1)
+                except:
+                    log.exception("Failed fetching block #{}".format(self.last_block_number + 1))
+                    break
+                stage_start_time = self.record_stage_time('fetch', stage_start_time)
+                if block:
+                    self._last_saw_new_block = asyncio.get_event_loop().time()
+                    processing_start_time = asyncio.get_event_loop().time()
+                    if self._lastlog + 300 < asyncio.get_event_loop().time():
+                        self._lastlog = asyncio.get_event_loop().time()
+                        log.info("Processing block {}".format(block['number']))
+                        if len(self._blocktimes) > 0:
+                            log.info("Average processing time per last {} blocks: {}".format(len(self._blocktimes), sum(self._blocktimes) / len(self._blocktimes)))
+                        db_metrics = self.db_pool.metrics()
+                        self.db_pool.reset_metrics()
+                        log.info("Database connections: limit {limit}, waiting {waiting} (max {max_waiting}), "
+                                 "acquired {acquired}, average wait {average_wait_time:.3f}s (max {max_wait_time:.3f}s)".format(
+                                     **db_metrics))
+                        log.info("Time spent per stage: {}".format(", ".join(
+                            "{} {:.3f}s".format(stage, self.stage_times[stage]) for stage in BLOCK_PROCESSING_STAGES)))
+                        self.reset_stage_times()
+
+                    # check for reorg
+
+                    if self.recent_blocks.covers(self.last_block_number):
+                        last_block = self.recent_blocks.get(self.last_block_number)
+                    else:
+                        async with self.db_pool.acquire() as con:
+                            last_block = await con.fetchrow("SELECT * FROM blocks WHERE blocknumber = $1", self.last_block_number)
+                    # if we don't have the previous block, do a quick sanity check to see if there's any blocks lower
+                    if last_block is None:
+                        async with self.db_pool.acquire() as con:
+                            last_block_number = await con.fetchval(
+                                "SELECT blocknumber FROM blocks "
+                                "WHERE blocknumber < $1 "
+                                "ORDER BY blocknumber DESC LIMIT 1",
+                                self.last_block_number)
+                        if last_block_number:
+                            log.warning("found gap in blocks @ block number: #{}".format(last_block_number + 1))
+                            # roll back to the last block number and sync up
+                            self.last_block_number = last_block_number
+                            self.clear_prefetched_blocks()
+                            continue
+                    else:
+                        # make sure hash of the last block is the same as the current hash's parent block
+                        if last_block['hash'] != block['parentHash']:
+                            # we have a reorg!
+                            success = await self.handle_reorg()
+                            if success:
+                                # anything prefetched may be from the old chain
+                                self.clear_prefetched_blocks()
+                                continue
+                            # if we didn't find a reorg point, continue on as normal to avoid
+                            # preventing the system from operating as a whole
+
+                    # check if we're reorging
+                    if self.recent_blocks.covers(self.last_block_number + 1):
+                        is_reorg = self.recent_blocks.get(self.last_block_number + 1) is not None
+                    else:
+                        async with self.db_pool.acquire() as con:
+                            is_reorg = await con.fetchval("SELECT 1 FROM blocks WHERE blocknumber = $1", self.last_block_number + 1)
+                    stage_start_time = self.record_stage_time('reorg_check', stage_start_time)
+
+                    attach_logs(block['transactions'], logs_list)
+                    block_number = parse_int(block['number'])
+
+                    writes = TransactionWrites()
+                    if self._transaction_shards:
+                        try:
+                            await self.process_transaction_shards(block['hash'], block['transactions'],
+                                                                  [block_number] if is_reorg else [])
+                        except:
+                            log.exception("Failed processing transactions for block #{}".format(block_number))
+                            break
+                    else:
+                        # resolve everything needed from the database for the whole block at once
+                        context = await self.prefetch_transaction_context(block['transactions'],
+                                                                          [block_number] if is_reorg else ())
+
+                        for tx in block['transactions']:
+                            await self.process_transaction(tx, is_reorg=is_reorg, context=context, writes=writes)
+                    stage_start_time = self.record_stage_time('transactions', stage_start_time)
+
+                    # write everything for the block in a single transaction so
+                    # nothing is left half done if processing is interrupted
+                    await self.write_blocks([block], writes)
+                    stage_start_time = self.record_stage_time('commit', stage_start_time)
+
+                    # update the latest block number, only if it is larger than the
+                    # current block number.
+                    if self.last_block_number < block_number:
+                        self.last_block_number = block_number
+
+                    # send notifications to sender and reciever
+                    receipts = await self.fetch_confirmed_receipts(writes)
+                    self.send_status_updates(writes, receipts)
+
+                    if logs_list:
+                        # send notifications for anyone registered
+                        notifications = await self.match_filter_notifications(logs_list)
+                        for i in range(0, len(notifications), FILTER_NOTIFICATION_BATCH_SIZE):
+                            eth_dispatcher.send_filter_notifications(
+                                notifications[i:i + FILTER_NOTIFICATION_BATCH_SIZE])
+
+                    if self._block_events_maxlen:
+                        await self.publish_block_events([block], logs_list)
+
+                    await self.update_gas_prices([block])
+
+                    collectibles_dispatcher.notify_new_block(block_number)
+                    self.record_stage_time('dispatch', stage_start_time)
+                    processing_end_time = asyncio.get_event_loop().time()
+                    self._blocktimes.append(processing_end_time - processing_start_time)
+                    if len(self._blocktimes) > 100:
+                        self._blocktimes = self._blocktimes[-100:]
+
                 else:
-                    logs_list = []
-                    logs = {}
 
-                process_tx_tasks = []
+                    break
+        finally:
+            # whatever is left is either past the head of the chain
+            # or will be fetched again on the next check
+            self.clear_prefetched_blocks()
+            self._block_checking_process = None
+
+    async def process_block_range(self, start_block_number, end_block_number):
+        """Processes all the blocks from start_block_number to end_block_number
+        (inclusive) as a single unit, fetching the blocks in a single bulk request
+        and the logs for the whole range in a single eth_getLogs call.
+
+        Returns False without processing anything if the range can't be handled
+        this way (i.e. a block is missing, or the blocks don't form a chain with
+        the last processed block), so the blocks should be processed one by one.
+        """
+
+        if not self.recent_blocks.covers(start_block_number - 1):
+            return False
+        last_block = self.recent_blocks.get(start_block_number - 1)
+        if last_block is None:
+            return False
+
+        stage_start_time = asyncio.get_event_loop().time()
+        bulk = self.eth.bulk()
+        for block_number in range(start_block_number, end_block_number + 1):
+            bulk.eth_getBlockByNumber(block_number, with_transactions=True)
+        blocks = await bulk.execute()
+        if any(block is None for block in blocks):
+            return False
+
+        parent_hash = last_block['hash']
+        logs_bloom = 0
+        for block in blocks:
+            if block['parentHash'] != parent_hash:
+                return False
+            parent_hash = block['hash']
+            logs_bloom |= parse_logs_bloom(block['logsBloom'])
+
+        logs_list = []
+        if logs_bloom:
+            addresses = await self.get_watched_log_addresses(logs_bloom)
+            if addresses:
+                logs_list = await self.eth.eth_getLogs(fromBlock=blocks[0]['number'],
+                                                       toBlock=blocks[-1]['number'],
+                                                       address=sorted(addresses))
+                # make sure the blocks weren't replaced between the two calls
+                block_hashes = set(block['hash'] for block in blocks)
+                if any(_log.get('blockHash') not in block_hashes for _log in logs_list if _log.get('blockHash') is not None):
+                    return False
+        stage_start_time = self.record_stage_time('fetch', stage_start_time)
+
+        self._last_saw_new_block = asyncio.get_event_loop().time()
+        log.info("Processing blocks #{} to #{}".format(start_block_number, end_block_number))
+
+        transactions = []
+        for block in blocks:
+            transactions.extend(block['transactions'])
+        attach_logs(transactions, logs_list)
+
+        writes = TransactionWrites()
+        reorg_block_numbers = {parse_int(block['number']) for block in blocks
+                               if self.recent_blocks.get(parse_int(block['number'])) is not None}
+        if self._transaction_shards:
+            writes.status_updates.extend(
+                await self.process_transaction_shards(blocks[-1]['hash'], transactions, reorg_block_numbers))
+        else:
+            context = await self.prefetch_transaction_context(transactions, reorg_block_numbers)
+
+            for block in blocks:
+                is_reorg = parse_int(block['number']) in reorg_block_numbers
                 for tx in block['transactions']:
-                    # send notifications to sender and reciever
-                    if tx['hash'] in logs:
-                        tx['logs'] = logs[tx['hash']]
-                    process_tx_tasks.append(
-                        asyncio.get_event_loop().create_task(self.process_transaction(tx, is_reorg=is_reorg)))
-                await asyncio.gather(*process_tx_tasks)
-
-                if logs_list:
-                    # send notifications for anyone registered
-                    async with self.pool.acquire() as con:
-                        for event in logs_list:
-                            for topic in event['topics']:
-                                filters = await con.fetch(
-                                    "SELECT * FROM filter_registrations WHERE contract_address = $1 AND topic_id = $2",
-                                    event['address'], topic)
-                                for filter in filters:
-                                    eth_dispatcher.send_filter_notification(
-                                        filter['filter_id'], filter['topic'], event['data'])
-
-                # update the latest block number, only if it is larger than the
-                # current block number.
-                block_number = parse_int(block['number'])
-                if self.last_block_number < block_number:
-                    self.last_block_number = block_number
-
-                async with self.pool.acquire() as con:
-                    await con.execute("UPDATE last_blocknumber SET blocknumber = $1 "
-                                      "WHERE blocknumber < $1",
-                                      block_number)
-                    await con.execute("INSERT INTO blocks (blocknumber, timestamp, hash, parent_hash) "
-                                      "VALUES ($1, $2, $3, $4) "
-                                      "ON CONFLICT (blocknumber) DO UPDATE "
-                                      "SET timestamp = EXCLUDED.timestamp, hash = EXCLUDED.hash, "
-                                      "parent_hash = EXCLUDED.parent_hash, stale = FALSE",
-                                      block_number, parse_int(block['timestamp']) or int(time.time()),
-                                      block['hash'], block['parentHash'])
+                    await self.process_transaction(tx, is_reorg=is_reorg, context=context, writes=writes)
+        stage_start_time = self.record_stage_time('transactions', stage_start_time)
 
-                collectibles_dispatcher.notify_new_block(block_number)
-                processing_end_time = asyncio.get_event_loop().time()
-                self._blocktimes.append(processing_end_time - processing_start_time)
-                if len(self._blocktimes) > 100:
-                    self._blocktimes = self._blocktimes[-100:]
+        await self.write_blocks(blocks, writes)
+        stage_start_time = self.record_stage_time('commit', stage_start_time)
 
-            else:
+        if self.last_block_number < end_block_number:
+            self.last_block_number = end_block_number
 
-                break
+        receipts = await self.fetch_confirmed_receipts(writes)
+        self.send_status_updates(writes, receipts)
 
-        self._block_checking_process = None
+        if logs_list:
+            notifications = await self.match_filter_notifications(logs_list)
+            for i in range(0, len(notifications), FILTER_NOTIFICATION_BATCH_SIZE):
+                eth_dispatcher.send_filter_notifications(
+                    notifications[i:i + FILTER_NOTIFICATION_BATCH_SIZE])
+
+        if self._block_events_maxlen:
+            await self.publish_block_events(blocks, logs_list)
+
+        await self.update_gas_prices(blocks)
+
+        collectibles_dispatcher.notify_new_block(end_block_number)
+        self.record_stage_time('dispatch', stage_start_time)
+        return True
+
+    async def publish_block_events(self, blocks, logs_list):
+        """Adds the blocks and their logs to the block events stream (see
+        `toshieth.block_events`)"""
+
+        logs_by_block = {}
+        for _log in logs_list:
+            logs_by_block.setdefault(parse_int(_log['blockNumber']), []).append(_log)
+        events = [build_block_event(block, logs_by_block.get(parse_int(block['number']), []), self.registrations)
+                  for block in blocks]
+        try:
+            await publish_block_events(self.redis, events, self._block_events_maxlen)
+        except:
+            log.exception("Error publishing block events")
+
+    async def update_gas_prices(self, blocks):
+        """Adds the blocks to the gas price estimator and stores the new
+        estimates, combined with the external gas prices (see
+        `toshieth.gasprice`). The manager is asked to refresh the external gas
+        prices every `gas_station_refresh_interval` seconds"""
+
+        now = asyncio.get_event_loop().time()
+        if self._gas_station_refresh_interval and (
+                self._last_gas_station_refresh is None or
+                now - self._last_gas_station_refresh >= self._gas_station_refresh_interval):
+            self._last_gas_station_refresh = now
+            manager_dispatcher.update_default_gas_price(parse_int(blocks[-1]['number']))
+
+        for block in blocks:
+            self.gas_price_estimator.add_block(block)
+        estimate = self.gas_price_estimator.estimate() or {}
+        try:
+            oracle = get_gas_price_oracle()
+            external = {name: await oracle.get('external_' + name) for name in ('safelow', 'standard', 'fast')}
+            prices = combine_gas_prices(estimate, external)
+            if prices:
+                await set_gas_prices(self.redis, **prices)
+        except:
+            log.exception("Error updating gas prices")
+
+    def record_stage_time(self, stage, start_time):
+        """Adds the time since `start_time` to the total for the given block
+        processing stage. Returns the current time, to be used as the start
+        time of the next stage"""
+
+        now = asyncio.get_event_loop().time()
+        self.stage_times[stage] += now - start_time
+        return now
+
+    def reset_stage_times(self):
+        self.stage_times = dict.fromkeys(BLOCK_PROCESSING_STAGES, 0.0)
+
+    async def process_transaction_shards(self, barrier_id, transactions, reorg_block_numbers):
+        """Sends the transactions to the transaction processing workers (see
+        `toshieth.monitor_worker`), split by from address so that all the
+        transactions from an address are processed in order by the same worker,
+        and waits until every worker has written it's changes.
+
+        Returns the workers' status updates, which are left for the monitor to
+        send once the block has been written so they aren't sent again if the
+        block is retried. The workers' own writes are committed separately from
+        the block though, so a retried block goes through it's transactions
+        again, finding the rows already written and only collecting their
+        status updates.
+
+        Raises an exception if any of the workers failed, or they don't finish
+        within `TRANSACTION_SHARD_TIMEOUT` seconds"""
+
+        shards = {}
+        for tx in transactions:
+            shards.setdefault(transaction_shard(tx['from'], self._transaction_shards), []).append(tx)
+        if not shards:
+            return []
+
+        # make the key unique so workers still running from a previous
+        # attempt at the same block can't affect this one
+        barrier_key = TRANSACTION_SHARD_BARRIER_KEY.format("{}:{}".format(barrier_id, uuid.uuid4().hex))
+        errors_key = "{}:errors".format(barrier_key)
+        status_updates_key = TRANSACTION_SHARD_STATUS_UPDATES_KEY.format(barrier_key)
+        tr = self.redis.multi_exec()
+        tr.set(barrier_key, len(shards), expire=TRANSACTION_SHARD_BARRIER_EXPIRY)
+        tr.delete(errors_key, status_updates_key)
+        await tr.execute()
+
+        for shard, shard_transactions in shards.items():
+            monitor_shard_dispatcher(shard).process_transactions(barrier_key, shard_transactions,
+                                                                  sorted(reorg_block_numbers))
+
+        timeout = asyncio.get_event_loop().time() + TRANSACTION_SHARD_TIMEOUT
+        try:
+            while True:
+                pipe = self.redis.pipeline()
+                pipe.get(barrier_key)
+                pipe.get(errors_key)
+                pipe.lrange(status_updates_key, 0, -1)
+                remaining, errors, shard_status_updates = await pipe.execute()
+                if parse_int(errors):
+                    raise Exception("{} transaction processing shards failed".format(parse_int(errors)))
+                if not parse_int(remaining):
+                    return [tuple(update) for updates in shard_status_updates
+                            for update in json_decode(updates)]
+                if asyncio.get_event_loop().time() > timeout:
+                    raise Exception("Timed out waiting for {} transaction processing shards".format(parse_int(remaining)))
+                await asyncio.sleep(TRANSACTION_SHARD_POLL_INTERVAL)
+        finally:
+            await self.redis.delete(barrier_key, errors_key, status_updates_key)
+
+    async def write_blocks(self, blocks, writes):
+        """Writes the transaction changes for the blocks along with the blocks
+        themselves in a single database transaction"""
+
+        async with self.db_pool.acquire() as con:
+            async with con.transaction():
+                await self.write_transactions(con, writes)
+                await con.execute("UPDATE last_blocknumber SET blocknumber = $1 "
+                                  "WHERE blocknumber < $1",
+                                  parse_int(blocks[-1]['number']))
+                await con.executemany("INSERT INTO blocks (blocknumber, timestamp, hash, parent_hash) "
+                                      "VALUES ($1, $2, $3, $4) "
+                                      "ON CONFLICT (blocknumber) DO UPDATE "
+                                      "SET timestamp = EXCLUDED.timestamp, hash = EXCLUDED.hash, "
+                                      "parent_hash = EXCLUDED.parent_hash, stale = FALSE",
+                                      [(parse_int(block['number']), parse_int(block['timestamp']) or int(time.time()),
+                                        block['hash'], block['parentHash'])
+                                       for block in blocks])
+        for block in blocks:
+            self.recent_blocks.add(parse_int(block['number']), block['hash'], block['parentHash'])
 
     @log_unhandled_exceptions(logger=log)
     async def filter_poll(self):
@@ -289,7 +1441,7 @@ class BlockMonitor:
         # check for newly added erc20 tokens
         if not self._shutdown:
 
-            async with self.pool.acquire() as con:
+            async with self.db_pool.acquire() as con:
                 rows = await con.fetch("SELECT contract_address FROM tokens WHERE ready = FALSE AND custom = FALSE")
                 if len(rows) > 0:
                     total_registrations = await con.fetchval("SELECT COUNT(*) FROM token_registrations")
@@ -303,7 +1455,7 @@ class BlockMonitor:
             if len(rows) > 0:
                 limit = 1000
                 for offset in range(0, total_registrations, limit):
-                    async with self.pool.acquire() as con:
+                    async with self.db_pool.acquire() as con:
                         registrations = await con.fetch(
                             "SELECT eth_address FROM token_registrations OFFSET $1 LIMIT $2",
                             offset, limit)
@@ -311,21 +1463,29 @@ class BlockMonitor:
                         erc20_dispatcher.update_token_cache(
                             row['contract_address'],
                             *[r['eth_address'] for r in registrations])
-                async with self.pool.acquire() as con:
+                async with self.db_pool.acquire() as con:
                     await con.executemany("UPDATE tokens SET ready = true WHERE contract_address = $1",
                                           [(r['contract_address'],) for r in rows])
+                # make sure the new tokens are recognised even if the
+                # notification of their insert was missed
+                self.registrations.add_known_tokens(*[r['contract_address'] for r in rows])
+
+        unconfirmed_transactions_count = None
 
         if not self._shutdown:
 
-            if self._new_pending_transaction_filter_id is not None:
+            if self.receiving_new_pending_transactions:
+                # new pending transactions are being pushed from the node
+                unconfirmed_transactions_count = await self.redis.hlen(UNCONFIRMED_TRANSACTIONS_REDIS_KEY)
+                if unconfirmed_transactions_count > 0:
+                    self.run_process_unconfirmed_transactions()
+
+            elif self._new_pending_transaction_filter_id is not None:
                 # get the list of new pending transactions
                 try:
                     new_pending_transactions = await self.filter_eth.eth_getFilterChanges(self._new_pending_transaction_filter_id)
                     # add any to the list of unprocessed transactions
-                    for tx_hash in new_pending_transactions:
-                        await self.redis.hsetnx(
-                            UNCONFIRMED_TRANSACTIONS_REDIS_KEY,
-                            tx_hash, int(asyncio.get_event_loop().time()))
+                    await self.add_unconfirmed_transactions(new_pending_transactions)
                 except JSONRPC_ERRORS:
                     log.exception("WARNING: unable to connect to server")
                     new_pending_transactions = None
@@ -341,25 +1501,35 @@ class BlockMonitor:
                         log.warning("Haven't seen any new pending transactions for {} seconds".format(time_since_last_pending_transaction))
                         await self.register_new_pending_transaction_filter()
 
-                if await self.redis.hlen(UNCONFIRMED_TRANSACTIONS_REDIS_KEY) > 0:
+                unconfirmed_transactions_count = await self.redis.hlen(UNCONFIRMED_TRANSACTIONS_REDIS_KEY)
+                if unconfirmed_transactions_count > 0:
                     self.run_process_unconfirmed_transactions()
 
         if not self._shutdown:
 
             # no need to run this if the block checking process is still running
             if self._block_checking_process is None or self._block_checking_process.done():
-                try:
-                    block_number = await self.filter_eth.eth_blockNumber()
-                except JSONRPC_ERRORS:
-                    log.exception("Error getting current block number")
-                    block_number = 0
+                if self.receiving_new_heads:
+                    # new blocks are being pushed from the node, only make sure
+                    # a head that arrived during the last block check isn't missed
+                    block_number = self._head_block_number or 0
+                else:
+                    try:
+                        block_number = await self.filter_eth.eth_blockNumber()
+                    except JSONRPC_ERRORS:
+                        log.exception("Error getting current block number")
+                        block_number = 0
+                    if block_number:
+                        self._head_block_number = block_number
                 if block_number > self.last_block_number and not self._shutdown:
                     self.schedule_block_check()
 
         self._filter_poll_process = None
 
         if not self._shutdown:
-            self.schedule_filter_poll(1 if (await self.redis.hlen(UNCONFIRMED_TRANSACTIONS_REDIS_KEY) > 0) else DEFAULT_POLL_DELAY)
+            if unconfirmed_transactions_count is None:
+                unconfirmed_transactions_count = await self.redis.hlen(UNCONFIRMED_TRANSACTIONS_REDIS_KEY)
+            self.schedule_filter_poll(1 if unconfirmed_transactions_count > 0 else DEFAULT_POLL_DELAY)
 
     @log_unhandled_exceptions(logger=log)
     async def process_unconfirmed_transactions(self):
@@ -369,20 +1539,59 @@ class BlockMonitor:
 
         # go through all the unmatched transactions that have no match
         unmatched_transactions = await self.redis.hgetall(UNCONFIRMED_TRANSACTIONS_REDIS_KEY, encoding="utf-8")
-        for tx_hash, created in unmatched_transactions.items():
-            age = asyncio.get_event_loop().time() - int(created)
-            try:
-                tx = await self.eth.eth_getTransactionByHash(tx_hash)
-            except JSONRPC_ERRORS:
-                log.exception("Error getting transaction")
-                tx = None
+        unmatched_transactions = list(unmatched_transactions.items())
+
+        if unmatched_transactions:
+            now = asyncio.get_event_loop().time()
+            oldest = max(now - int(created) for _, created in unmatched_transactions)
+            if len(unmatched_transactions) > UNCONFIRMED_TRANSACTIONS_BATCH_SIZE or oldest > UNCONFIRMED_TRANSACTION_TIMEOUT:
+                log.info("Unconfirmed transaction backlog: {} transactions, oldest seen {} seconds ago".format(
+                    len(unmatched_transactions), int(oldest)))
+
+        batches = [unmatched_transactions[i:i + UNCONFIRMED_TRANSACTIONS_BATCH_SIZE]
+                   for i in range(0, len(unmatched_transactions), UNCONFIRMED_TRANSACTIONS_BATCH_SIZE)]
+        for i in range(0, len(batches), UNCONFIRMED_TRANSACTIONS_CONCURRENCY):
+            if self._shutdown:
+                break
+            results = await asyncio.gather(*[self._process_unconfirmed_transaction_batch(batch)
+                                             for batch in batches[i:i + UNCONFIRMED_TRANSACTIONS_CONCURRENCY]],
+                                           return_exceptions=True)
+            # one bad batch shouldn't stop the rest from being processed
+            for result in results:
+                if isinstance(result, Exception):
+                    log.error("Error processing unconfirmed transactions batch", exc_info=result)
+
+        self._process_unconfirmed_transactions_process = None
+
+    async def _process_unconfirmed_transaction_batch(self, batch):
+        """Looks up a batch of (tx_hash, created) pairs from the unconfirmed
+        transactions set in a single bulk request and processes the ones that
+        are still pending"""
+
+        bulk = self.eth.bulk()
+        futures = [(tx_hash, created, bulk.eth_getTransactionByHash(tx_hash)) for tx_hash, created in batch]
+        try:
+            await bulk.execute()
+        except JSONRPC_ERRORS:
+            log.exception("Error getting transactions")
+
+        now = asyncio.get_event_loop().time()
+        completed = []
+        pending = []
+        for tx_hash, created, f in futures:
+            tx = None
+            if f.done():
+                try:
+                    tx = f.result()
+                except JSONRPC_ERRORS:
+                    log.exception("Error getting transaction")
             if tx is None:
                 # if the tx has existed for 60 seconds and not found, assume it was
                 # removed from the network before being accepted into a block
-                if age >= 60:
-                    await self.redis.hdel(UNCONFIRMED_TRANSACTIONS_REDIS_KEY, tx_hash)
+                if now - int(created) >= UNCONFIRMED_TRANSACTION_TIMEOUT:
+                    completed.append(tx_hash)
             else:
-                await self.redis.hdel(UNCONFIRMED_TRANSACTIONS_REDIS_KEY, tx_hash)
+                completed.append(tx_hash)
 
                 # check if the transaction has already been included in a block
                 # and if so, ignore this notification as it will be picked up by
@@ -391,253 +1600,78 @@ class BlockMonitor:
                 if tx['blockNumber'] is not None:
                     continue
 
-                await self.process_transaction(tx)
-
-            if self._shutdown:
-                break
+                pending.append(tx)
 
-        self._process_unconfirmed_transactions_process = None
-
-    @log_unhandled_exceptions(logger=log)
-    async def process_transaction(self, transaction, is_reorg=False):
-
-        to_address = transaction['to']
-        # make sure we use a valid encoding of "empty" for contract deployments
-        if to_address is None:
-            to_address = "0x"
-        from_address = transaction['from']
-
-        async with self.pool.acquire() as con:
-            # find if we have a record of this tx by checking the from address and nonce
-            db_txs = await con.fetch("SELECT * FROM transactions WHERE "
-                                     "from_address = $1 AND nonce = $2",
-                                     from_address, parse_int(transaction['nonce']))
-            if len(db_txs) > 1:
-                # see if one has the same hash
-                db_tx = await con.fetchrow("SELECT * FROM transactions WHERE "
-                                           "from_address = $1 AND nonce = $2 AND hash = $3 AND (status != 'error' OR status = 'new')",
-                                           from_address, parse_int(transaction['nonce']), transaction['hash'])
-                if db_tx is None:
-                    # find if there are any that aren't marked as error
-                    no_error = await con.fetch("SELECT * FROM transactions WHERE "
-                                               "from_address = $1 AND nonce = $2 AND hash != $3 AND (status != 'error' OR status = 'new')",
-                                               from_address, parse_int(transaction['nonce']), transaction['hash'])
-                    if len(no_error) == 1:
-                        db_tx = no_error[0]
-                    elif len(no_error) != 0:
-                        log.warning("Multiple transactions from '{}' exist with nonce '{}' in unknown state")
-
-            elif len(db_txs) == 1:
-                db_tx = db_txs[0]
-            else:
-                db_tx = None
-
-            # if we have a previous transaction, do some checking to see what's going on
-            # see if this is an overwritten transaction
-            # if the status of the old tx was previously an error, we don't care about it
-            # otherwise, we have to notify the interested parties of the overwrite
-
-            if db_tx and db_tx['hash'] != transaction['hash'] and db_tx['status'] != 'error':
-
-                if db_tx['v'] is not None:
-                    log.warning("found overwritten transaction!")
-                    log.warning("tx from: {}".format(from_address))
-                    log.warning("nonce: {}".format(parse_int(transaction['nonce'])))
-                    log.warning("old tx hash: {}".format(db_tx['hash']))
-                    log.warning("new tx hash: {}".format(transaction['hash']))
-
-                manager_dispatcher.update_transaction(db_tx['transaction_id'], 'error')
-                db_tx = None
-
-            # if reorg, and the transaction is confirmed, just update which block it was included in
-            if is_reorg and db_tx and db_tx['hash'] == transaction['hash'] and db_tx['status'] == 'confirmed':
-                if transaction['blockNumber'] is None:
-                    log.error("Unexpectedly got unconfirmed transaction again after reorg. hash: {}".format(db_tx['hash']))
-                    # this shouldn't really happen. going to log and abort
-                    return db_tx['transaction_id']
-                new_blocknumber = parse_int(transaction['blockNumber'])
-                if new_blocknumber != db_tx['blocknumber']:
-                    async with self.pool.acquire() as con:
-                        await con.execute(
-                            "UPDATE transactions SET blocknumber = $1 "
-                            "WHERE transaction_id = $2",
-                            new_blocknumber, db_tx['transaction_id'])
-                return db_tx['transaction_id']
-
-            # check for erc20 transfers
-            erc20_transfers = []
-            if transaction['blockNumber'] is not None and \
-               'logs' in transaction and \
-               len(transaction['logs']) > 0:
-
-                # find any logs with erc20 token related topics
-                for _log in transaction['logs']:
-                    if len(_log['topics']) > 0:
-                        # Transfer(address,address,uint256)
-                        if _log['topics'][0] == TRANSFER_TOPIC:
-                            # make sure the log address is for one we're interested in
-                            is_known_token = await con.fetchval("SELECT 1 FROM tokens WHERE contract_address = $1", _log['address'])
-                            if not is_known_token:
-                                continue
-                            if len(_log['topics']) == 3 and len(_log['data']) == 66:
-                                # standard erc20 structure
-                                erc20_from_address = decode_single(('address', '', []), data_decoder(_log['topics'][1]))
-                                erc20_to_address = decode_single(('address', '', []), data_decoder(_log['topics'][2]))
-                                erc20_value = decode_abi(['uint256'], data_decoder(_log['data']))[0]
-                            elif len(_log['topics']) == 1 and len(_log['data']) == 194:
-                                # non-indexed style Transfer events
-                                erc20_from_address, erc20_to_address, erc20_value = decode_abi(
-                                    ['address', 'address', 'uint256'], data_decoder(_log['data']))
-                            else:
-                                log.warning('Got invalid erc20 Transfer event in tx: {}'.format(transaction['hash']))
-                                continue
-                            erc20_is_interesting = await con.fetchval(
-                                "SELECT 1 FROM token_registrations "
-                                "WHERE eth_address = $1 OR eth_address = $2",
-                                erc20_from_address, erc20_to_address)
-                            if erc20_is_interesting:
-                                erc20_transfers.append((_log['address'], get_transaction_log_index(_log), erc20_from_address, erc20_to_address, hex(erc20_value), 'confirmed'))
-
-                        # special checks for WETH, since it's rarely 'Transfer'ed, but we
-                        # still need to update it
-                        elif (_log['topics'][0] == DEPOSIT_TOPIC or _log['topics'][0] == WITHDRAWAL_TOPIC) and _log['address'] == WETH_CONTRACT_ADDRESS:
-                            eth_address = decode_single(('address', '', []), data_decoder(_log['topics'][1]))
-                            erc20_is_interesting = await con.fetchval(
-                                "SELECT 1 FROM token_registrations "
-                                "WHERE eth_address = $1",
-                                eth_address)
-                            if erc20_is_interesting:
-                                erc20_value = decode_abi(['uint256'], data_decoder(_log['data']))[0]
-                                if _log['topics'][0] == DEPOSIT_TOPIC:
-                                    erc20_to_address = eth_address
-                                    erc20_from_address = "0x0000000000000000000000000000000000000000"
-                                else:
-                                    erc20_to_address = "0x0000000000000000000000000000000000000000"
-                                    erc20_from_address = eth_address
-                                erc20_transfers.append((WETH_CONTRACT_ADDRESS, get_transaction_log_index(_log), erc20_from_address, erc20_to_address, hex(erc20_value), 'confirmed'))
-
-            elif transaction['blockNumber'] is None and db_tx is None:
-                # transaction is pending, attempt to guess if this is a token
-                # transaction based off it's input
-                if transaction['input']:
-                    data = transaction['input']
-                    if (data.startswith("0xa9059cbb") and len(data) == 138) or (data.startswith("0x23b872dd") and len(data) == 202):
-                        token_value = hex(int(data[-64:], 16))
-                        if data.startswith("0x23b872dd"):
-                            erc20_from_address = "0x" + data[34:74]
-                            erc20_to_address = "0x" + data[98:138]
-                        else:
-                            erc20_from_address = from_address
-                            erc20_to_address = "0x" + data[34:74]
-                        erc20_transfers.append((to_address, 0, erc20_from_address, erc20_to_address, token_value, 'unconfirmed'))
-                    # special WETH handling
-                    elif data == '0xd0e30db0' and transaction['to'] == WETH_CONTRACT_ADDRESS:
-                        erc20_transfers.append((WETH_CONTRACT_ADDRESS, 0, "0x0000000000000000000000000000000000000000", transaction['from'], transaction['value'], 'unconfirmed'))
-                    elif data.startswith('0x2e1a7d4d') and len(data) == 74:
-                        token_value = hex(int(data[-64:], 16))
-                        erc20_transfers.append((WETH_CONTRACT_ADDRESS, 0, transaction['from'], "0x0000000000000000000000000000000000000000", token_value, 'unconfirmed'))
-
-            if db_tx:
-                is_interesting = True
+        processed = False
+        if pending and not self._shutdown:
+            try:
+                context = await self.prefetch_transaction_context(pending)
+                writes = TransactionWrites()
+                for tx in pending:
+                    await self.process_transaction(tx, context=context, writes=writes)
+                async with self.db_pool.acquire() as con:
+                    async with con.transaction():
+                        await self.write_transactions(con, writes)
+                processed = True
+            except:
+                log.exception("Error processing unconfirmed transactions")
             else:
-                # find out if there is anyone interested in this transaction
-                is_interesting = await con.fetchval("SELECT 1 FROM notification_registrations "
-                                                    "WHERE eth_address = $1 OR eth_address = $2",
-                                                    to_address, from_address)
-            if not is_interesting and len(erc20_transfers) > 0:
-                for _, _, erc20_from_address, erc20_to_address, _, _ in erc20_transfers:
-                    is_interesting = await con.fetchval("SELECT 1 FROM notification_registrations "
-                                                        "WHERE eth_address = $1 OR eth_address = $2",
-                                                        erc20_to_address, erc20_from_address)
-                    if is_interesting:
-                        break
-                    is_interesting = await con.fetchval("SELECT 1 FROM token_registrations "
-                                                        "WHERE eth_address = $1 OR eth_address = $2",
-                                                        erc20_to_address, erc20_from_address)
-                    if is_interesting:
-                        break
-
-            if not is_interesting:
-                return
-
-            if db_tx is None:
-                # if so, add it to the database and trigger an update
-                # add tx to database
-                db_tx = await con.fetchrow(
-                    "INSERT INTO transactions "
-                    "(hash, from_address, to_address, nonce, "
-                    "value, gas, gas_price, "
-                    "data) "
-                    "VALUES ($1, $2, $3, $4, $5, $6, $7, $8) "
-                    "RETURNING transaction_id",
-                    transaction['hash'], from_address, to_address, parse_int(transaction['nonce']),
-                    hex(parse_int(transaction['value'])), hex(parse_int(transaction['gas'])), hex(parse_int(transaction['gasPrice'])),
-                    transaction['input'])
-
-            for erc20_contract_address, transaction_log_index, erc20_from_address, erc20_to_address, erc20_value, erc20_status in erc20_transfers:
-                is_interesting = await con.fetchval("SELECT 1 FROM notification_registrations "
-                                                    "WHERE eth_address = $1 OR eth_address = $2",
-                                                    erc20_to_address, erc20_from_address)
-                if not is_interesting:
-                    is_interesting = await con.fetchrow("SELECT 1 FROM token_registrations "
-                                                        "WHERE eth_address = $1 OR eth_address = $2",
-                                                        erc20_to_address, erc20_from_address)
+                self.send_status_updates(writes)
 
-                if is_interesting:
-                    await con.execute(
-                        "INSERT INTO token_transactions "
-                        "(transaction_id, transaction_log_index, contract_address, from_address, to_address, value, status) "
-                        "VALUES ($1, $2, $3, $4, $5, $6, $7) "
-                        "ON CONFLICT (transaction_id, transaction_log_index) DO UPDATE "
-                        "SET from_address = EXCLUDED.from_address, to_address = EXCLUDED.to_address, value = EXCLUDED.value",
-                        db_tx['transaction_id'], transaction_log_index, erc20_contract_address,
-                        erc20_from_address, erc20_to_address, erc20_value, erc20_status)
-
-            manager_dispatcher.update_transaction(
-                db_tx['transaction_id'],
-                'confirmed' if transaction['blockNumber'] is not None else 'unconfirmed')
-            return db_tx['transaction_id']
+        if not processed:
+            # keep the pending transactions so they are tried again next time
+            pending_hashes = set(tx['hash'] for tx in pending)
+            completed = [tx_hash for tx_hash in completed if tx_hash not in pending_hashes]
+        if completed:
+            await self.redis.hdel(UNCONFIRMED_TRANSACTIONS_REDIS_KEY, *completed)
 
     @log_unhandled_exceptions(logger=log)
     async def handle_reorg(self):
         log.info("REORG encounterd at block #{}".format(self.last_block_number))
         blocknumber = self.last_block_number
         forked_at_blocknumber = None
+        # (blocknumber, hash) of the blocks being replaced
+        replaced_blocks = []
         BLOCKS_PER_ITERATION = 10
         while True:
+            block_numbers = [blocknumber - i for i in range(BLOCKS_PER_ITERATION) if blocknumber - i >= 0]
+            # only the hashes are needed, so skip the transactions
             bulk = self.eth.bulk()
-            for i in range(BLOCKS_PER_ITERATION):
-                if blocknumber - i >= 0:
-                    bulk.eth_getBlockByNumber(blocknumber - i, with_transactions=True)
+            for block_number in block_numbers:
+                bulk.eth_getBlockByNumber(block_number, with_transactions=False)
             node_results = await bulk.execute()
-            async with self.pool.acquire() as con:
-                db_results = await con.fetch("SELECT * FROM blocks WHERE blocknumber <= $1 ORDER BY blocknumber DESC LIMIT $2",
-                                             blocknumber, BLOCKS_PER_ITERATION)
-            while node_results:
-                node_block = node_results[0]
-                db_block = None
-                while db_results:
-                    db_block = db_results[0]
-                    if parse_int(node_block['number']) != db_block['blocknumber']:
-                        log.error("Got out of order blocks when handling reorg: expected: {}, got: {}".format(
-                            parse_int(node_block['number']), db_block['blocknumber']))
-                        db_results = db_results[1:]
-                    else:
-                        break
-                if db_block is None:
-                    # we don't know about any more blocks, so we can just reorg the whole thing!
-                    break
 
-                if node_block['hash'] == db_block['hash']:
-                    log.info("FORK found at block #{}".format(db_block['blocknumber']))
-                    forked_at_blocknumber = db_block['blocknumber']
+            known_hashes = {}
+            uncovered_block_numbers = []
+            for block_number in block_numbers:
+                if self.recent_blocks.covers(block_number):
+                    known_block = self.recent_blocks.get(block_number)
+                    if known_block is not None:
+                        known_hashes[block_number] = known_block['hash']
+                else:
+                    uncovered_block_numbers.append(block_number)
+            if uncovered_block_numbers:
+                async with self.db_pool.acquire() as con:
+                    rows = await con.fetch("SELECT blocknumber, hash FROM blocks WHERE blocknumber = ANY($1)",
+                                           uncovered_block_numbers)
+                known_hashes.update((row['blocknumber'], row['hash']) for row in rows)
+
+            for node_block in node_results:
+                if node_block is None:
+                    continue
+                node_blocknumber = parse_int(node_block['number'])
+                if node_blocknumber not in known_hashes:
+                    # we don't know about this block, so there's nothing to compare
+                    continue
+
+                if node_block['hash'] == known_hashes[node_blocknumber]:
+                    log.info("FORK found at block #{}".format(node_blocknumber))
+                    forked_at_blocknumber = node_blocknumber
                     break
 
                 log.info("Mismatched block #{}. old: {}, new: {}".format(
-                    db_block['blocknumber'], db_block['hash'], node_block['hash']))
-
-                node_results = node_results[1:]
-                db_results = db_results[1:]
+                    node_blocknumber, known_hashes[node_blocknumber], node_block['hash']))
+                replaced_blocks.append((node_blocknumber, known_hashes[node_blocknumber]))
 
             if forked_at_blocknumber is not None:
                 break
@@ -652,13 +1686,26 @@ class BlockMonitor:
             log.error("Error: unexpectedly broke from reorg point finding loop")
             return False
 
-        async with self.pool.acquire() as con:
+        async with self.db_pool.acquire() as con:
             # mark blocks as stale
             await con.execute("UPDATE blocks SET stale = TRUE WHERE blocknumber > $1",
                               forked_at_blocknumber)
             # revert collectible's last block numbers
             await con.execute("UPDATE collectibles SET last_block = $1 WHERE last_block > $1",
                               forked_at_blocknumber - 1)
+        self.recent_blocks.mark_stale(forked_at_blocknumber)
+        # the transaction queue's account states may be for the replaced blocks
+        await invalidate_all_account_states(self.redis)
+        self.gas_price_estimator.remove_blocks_from(forked_at_blocknumber + 1)
+
+        if self._block_events_maxlen and replaced_blocks:
+            try:
+                await publish_block_events(
+                    self.redis,
+                    [build_retract_event(blocknumber, block_hash) for blocknumber, block_hash in sorted(replaced_blocks)],
+                    self._block_events_maxlen)
+            except:
+                log.exception("Error publishing retracted blocks")
 
         self.last_block_number = forked_at_blocknumber
         return True
@@ -673,6 +1720,8 @@ class BlockMonitor:
         # check that filter ids are set to something
         if self._new_pending_transaction_filter_id is None:
             await self.register_new_pending_transaction_filter()
+        # make sure the registration cache is still receiving updates
+        await self.registrations.check()
         # check that poll callback is set and not in the past
         if self._poll_schedule is None:
             log.warning("Filter poll schedule is None!")
@@ -707,6 +1756,9 @@ class BlockMonitor:
         except:
             pass
 
+        if self.subscription is not None:
+            await self.subscription.stop()
+
         if self._check_schedule:
             self._check_schedule.cancel()
         if self._poll_schedule:
@@ -717,13 +1769,19 @@ class BlockMonitor:
         # let the current iteration of each process finish if running
         if self._block_checking_process:
             await self._block_checking_process
+        self.clear_prefetched_blocks()
         if self._filter_poll_process:
             await self._filter_poll_process
         if self._sanity_check_process:
             await self._sanity_check_process
+        if self._store_pending_transactions_process:
+            await self._store_pending_transactions_process
         if self._process_unconfirmed_transactions_process:
             await self._process_unconfirmed_transactions_process
 
+        await self.registrations.stop()
+        close_gas_price_oracle()
+
         self._startup_future = None
 
 
@@ -0,0 +1,86 @@
+import asyncio
+import logging
+
+from tornado.escape import json_encode
+
+from toshi.config import config
+from toshi.database import prepare_database
+from toshi.log import configure_logger, log_unhandled_exceptions
+
+from toshieth.monitor import (
+    TransactionProcessor, ProcessedTransactions,
+    TRANSACTION_SHARD_BARRIER_EXPIRY, TRANSACTION_SHARD_STATUS_UPDATES_KEY
+)
+from toshieth.nodepool import create_jsonrpc_client
+from toshieth.registrations import RegistrationCache
+from toshieth.tasks import BaseEthServiceWorker, BaseTaskHandler, monitor_shard_queue_name
+
+log = logging.getLogger("toshieth.monitor_worker")
+
+class ShardTransactionProcessor(TransactionProcessor):
+
+    def __init__(self):
+        self.db_pool = None
+        self.registrations = RegistrationCache()
+        self.processed_transactions = ProcessedTransactions()
+        node_section = 'monitor' if 'monitor' in config else 'ethereum'
+        self.eth = create_jsonrpc_client(node_section, connect_timeout=5.0, request_timeout=10.0)
+        self._fetch_receipts = 'monitor' in config and config['monitor'].getboolean('fetch_receipts', False)
+        self._batch_status_updates = 'monitor' in config and config['monitor'].getboolean('batch_status_updates', False)
+
+    async def start(self):
+        self.db_pool = await prepare_database(handle_migration=False)
+        await self.registrations.start(self.db_pool)
+
+class TransactionShardHandler(BaseTaskHandler):
+
+    def initialize(self, processor):
+        self.processor = processor
+
+    @log_unhandled_exceptions(logger=log)
+    async def process_transactions(self, barrier_key, transactions, reorg_block_numbers):
+        """Processes a block's (or range of blocks') transactions for this shard,
+        then lets the monitor know it's done by decrementing the barrier key.
+
+        The status updates are left for the monitor to send once it has
+        written the block"""
+
+        status_updates = []
+        try:
+            status_updates = await self.processor.process_transactions(transactions, set(reorg_block_numbers))
+        except:
+            log.exception("Error processing {} transactions for {}".format(len(transactions), barrier_key))
+            await self.redis.incr("{}:errors".format(barrier_key))
+        finally:
+            tr = self.redis.multi_exec()
+            if status_updates:
+                status_updates_key = TRANSACTION_SHARD_STATUS_UPDATES_KEY.format(barrier_key)
+                tr.rpush(status_updates_key, json_encode(status_updates))
+                tr.expire(status_updates_key, TRANSACTION_SHARD_BARRIER_EXPIRY)
+            tr.decr(barrier_key)
+            # in case the monitor has already given up on the block
+            tr.expire(barrier_key, TRANSACTION_SHARD_BARRIER_EXPIRY)
+            await tr.execute()
+
+class MonitorWorker(BaseEthServiceWorker):
+    """Processes transactions for a single shard when the block monitor is
+    configured with `transaction_shards`. One worker should be run for each
+    shard, with `shard` set from 0 to `transaction_shards - 1`"""
+
+    def __init__(self, shard):
+        self.processor = ShardTransactionProcessor()
+        super().__init__([(TransactionShardHandler, [self.processor], {})],
+                         queue_name=monitor_shard_queue_name(shard))
+        configure_logger(log)
+        log.info("Processing transactions for shard {}".format(shard))
+
+    async def _work(self):
+        await self.processor.start()
+        await super()._work()
+
+if __name__ == "__main__":
+    from toshieth.app import extra_service_config
+    extra_service_config()
+    app = MonitorWorker(config['monitor_worker'].getint('shard'))
+    app.work()
+    asyncio.get_event_loop().run_forever()
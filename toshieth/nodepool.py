@@ -0,0 +1,313 @@
+import asyncio
+import logging
+import random
+from collections import deque
+
+from toshi.config import config
+from toshi.jsonrpc.client import JsonRPCClient
+from toshi.jsonrpc.errors import HTTPError
+from toshi.log import configure_logger
+
+log = logging.getLogger("toshieth.nodepool")
+
+# methods that change the state of the node, which are sent to every node
+# rather than just the fastest one
+WRITE_METHODS = {'eth_sendRawTransaction'}
+
+# errors that mean there is a problem with the node itself, rather than
+# the request, so the request should be tried on another node
+NODE_ERRORS = (HTTPError,
+               ConnectionRefusedError,
+               OSError,
+               asyncio.TimeoutError)
+
+# number of latency samples kept for each node
+LATENCY_SAMPLES = 100
+# minimum number of samples needed before hedging requests to a node
+MIN_HEDGE_SAMPLES = 20
+# how many consecutive errors before a node is taken out of rotation
+# and how long it's taken out for
+MAX_CONSECUTIVE_ERRORS = 3
+NODE_DOWN_TIME = 10
+# nodes that fail more than this fraction of their requests in the last
+# ERROR_RATE_WINDOW seconds are also taken out of rotation, once there are
+# at least MIN_ERROR_RATE_SAMPLES requests to go on
+MAX_ERROR_RATE = 0.25
+ERROR_RATE_WINDOW = 60
+MIN_ERROR_RATE_SAMPLES = 10
+
+class NodeStats:
+    """Latency and error tracking for a single node"""
+
+    def __init__(self, url):
+        self.url = url
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        # (time, True if the request failed) for the most recent requests
+        self.outcomes = deque(maxlen=LATENCY_SAMPLES)
+        self.consecutive_errors = 0
+        self.down_until = 0
+
+    @property
+    def healthy(self):
+        return asyncio.get_event_loop().time() >= self.down_until and \
+            self.error_rate <= MAX_ERROR_RATE
+
+    @property
+    def average_latency(self):
+        if not self.latencies:
+            return 0.0
+        return sum(self.latencies) / len(self.latencies)
+
+    @property
+    def p95_latency(self):
+        if len(self.latencies) < MIN_HEDGE_SAMPLES:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[int(len(latencies) * 0.95)]
+
+    @property
+    def error_rate(self):
+        """The fraction of the requests in the last `ERROR_RATE_WINDOW`
+        seconds that failed. As the old requests drop out of the window a
+        node that was taken out of rotation gets another chance"""
+        cutoff = asyncio.get_event_loop().time() - ERROR_RATE_WINDOW
+        while self.outcomes and self.outcomes[0][0] < cutoff:
+            self.outcomes.popleft()
+        if len(self.outcomes) < MIN_ERROR_RATE_SAMPLES:
+            return 0.0
+        return sum(1 for _, failed in self.outcomes if failed) / len(self.outcomes)
+
+    def record_success(self, latency):
+        self.outcomes.append((asyncio.get_event_loop().time(), False))
+        self.latencies.append(latency)
+        self.consecutive_errors = 0
+
+    def record_error(self):
+        self.outcomes.append((asyncio.get_event_loop().time(), True))
+        self.consecutive_errors += 1
+        if self.consecutive_errors >= MAX_CONSECUTIVE_ERRORS:
+            log.warning("Taking node {} out of rotation for {} seconds after {} errors".format(
+                self.url, NODE_DOWN_TIME, self.consecutive_errors))
+            self.down_until = asyncio.get_event_loop().time() + NODE_DOWN_TIME
+            self.consecutive_errors = 0
+
+class JsonRPCClientPool:
+    """Sends JSON-RPC requests to the best of a set of ethereum nodes.
+
+    Nodes are healthy unless they've had too many errors in a row or fail too
+    many of their recent requests (see `NodeStats`).
+
+    Reads go to the healthy node with the lowest average latency, falling back
+    on the other nodes if it fails. With `hedge` set, if a read hasn't finished
+    by the node's p95 latency a duplicate request is sent to the next best node
+    and whichever finishes first is used. With `sticky` set the same node is
+    used until it fails, for callers that need consistent results between
+    requests (e.g. fetching a block and then it's logs).
+
+    Writes (see `WRITE_METHODS`) are sent to every node.
+
+    Bulk requests are sent to the best node, and sent again to the next best
+    node if it fails (see `BulkPool`).
+
+    Accepts anything with the same interface as `JsonRPCClient` as clients.
+    """
+
+    def __init__(self, clients, urls=None, *, hedge=False, sticky=False):
+        configure_logger(log)
+        self.clients = list(clients)
+        self.stats = [NodeStats(url) for url in (urls or [str(i) for i in range(len(self.clients))])]
+        self.hedge = hedge
+        self.sticky = sticky
+        self._current = 0
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name in WRITE_METHODS:
+            return lambda *args, **kwargs: self._write(name, args, kwargs)
+        return lambda *args, **kwargs: self._read(name, args, kwargs)
+
+    def ranked_nodes(self):
+        """Returns the node indexes ordered by preference"""
+        nodes = list(range(len(self.clients)))
+        if self.sticky:
+            nodes = nodes[self._current:] + nodes[:self._current]
+            return sorted(nodes, key=lambda i: not self.stats[i].healthy)
+        # nodes that haven't been used yet sort first so they get some latency
+        # samples, and ties are broken randomly to spread the load
+        random.shuffle(nodes)
+        return sorted(nodes, key=lambda i: (not self.stats[i].healthy,
+                                            self.stats[i].average_latency if self.stats[i].latencies else 0.0))
+
+    async def _call(self, index, name, args, kwargs):
+        start_time = asyncio.get_event_loop().time()
+        try:
+            result = await getattr(self.clients[index], name)(*args, **kwargs)
+        except NODE_ERRORS:
+            self._record_error(index)
+            raise
+        self.stats[index].record_success(asyncio.get_event_loop().time() - start_time)
+        return result
+
+    def _record_error(self, index):
+        self.stats[index].record_error()
+        if self.sticky and index == self._current:
+            self._current = (index + 1) % len(self.clients)
+
+    async def _read(self, name, args, kwargs):
+        nodes = self.ranked_nodes()
+        error = None
+        while nodes:
+            index = nodes.pop(0)
+            p95 = self.stats[index].p95_latency
+            if not self.hedge or not nodes or p95 is None:
+                try:
+                    return await self._call(index, name, args, kwargs)
+                except NODE_ERRORS as e:
+                    log.warning("Error calling {} on {}: {}".format(name, self.stats[index].url, e))
+                    error = error or e
+                    continue
+
+            # send a second request to the next best node if the first
+            # takes longer than it usually does
+            first = asyncio.ensure_future(self._call(index, name, args, kwargs))
+            done, _ = await asyncio.wait([first], timeout=p95)
+            if done:
+                try:
+                    return first.result()
+                except NODE_ERRORS as e:
+                    error = error or e
+                    continue
+            hedge_index = nodes.pop(0)
+            second = asyncio.ensure_future(self._call(hedge_index, name, args, kwargs))
+            done, pending = set(), {first, second}
+            try:
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for f in done:
+                        try:
+                            result = f.result()
+                        except NODE_ERRORS as e:
+                            error = error or e
+                            continue
+                        return result
+            finally:
+                # whether this returns or raises, let the other request finish
+                # in the background so it's latency is still recorded, and
+                # make sure any errors it has aren't reported as unhandled
+                for f in done | pending:
+                    f.add_done_callback(_consume_result)
+        raise error
+
+    async def _write(self, name, args, kwargs):
+        nodes = self.ranked_nodes()
+        futures = [asyncio.ensure_future(self._call(index, name, args, kwargs)) for index in nodes]
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        for result in results:
+            if not isinstance(result, Exception):
+                return result
+        # if every node failed, report the error from the best node
+        raise results[0]
+
+    def bulk(self, *args, **kwargs):
+        return BulkPool(self, args, kwargs)
+
+    async def close(self):
+        for client in self.clients:
+            try:
+                await client.close()
+            except:
+                pass
+
+class BulkPool:
+    """Wraps the bulk client of the best node, recording it's latency.
+
+    The calls are also kept so that if the node fails (see `NODE_ERRORS`) they
+    can be sent again to the next best node. The futures returned for each
+    call are resolved with the results from whichever node answered."""
+
+    def __init__(self, pool, args, kwargs):
+        self._pool = pool
+        self._args = args
+        self._kwargs = kwargs
+        self._nodes = pool.ranked_nodes()
+        self._bulk = pool.clients[self._nodes[0]].bulk(*args, **kwargs)
+        # (name, args, kwargs, future returned by the wrapped bulk client,
+        #  future returned to the caller)
+        self._calls = []
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            node_future = getattr(self._bulk, name)(*args, **kwargs)
+            future = asyncio.get_event_loop().create_future()
+            self._calls.append((name, args, kwargs, node_future, future))
+            return future
+        return call
+
+    async def execute(self):
+        error = None
+        for attempt, index in enumerate(self._nodes):
+            if attempt > 0:
+                # queue the calls up again on the next node
+                self._bulk = self._pool.clients[index].bulk(*self._args, **self._kwargs)
+                self._calls = [(name, args, kwargs, getattr(self._bulk, name)(*args, **kwargs), future)
+                               for name, args, kwargs, _, future in self._calls]
+            start_time = asyncio.get_event_loop().time()
+            try:
+                results = await self._bulk.execute()
+            except NODE_ERRORS as e:
+                log.warning("Error executing bulk request on {}: {}".format(self._pool.stats[index].url, e))
+                self._pool._record_error(index)
+                for _, _, _, node_future, _ in self._calls:
+                    node_future.add_done_callback(_consume_result)
+                error = error or e
+                continue
+            except:
+                self._resolve_futures()
+                raise
+            self._pool.stats[index].record_success(asyncio.get_event_loop().time() - start_time)
+            self._resolve_futures()
+            return results
+        raise error
+
+    def _resolve_futures(self):
+        for _, _, _, node_future, future in self._calls:
+            if not node_future.done() or future.done():
+                continue
+            if node_future.cancelled():
+                future.cancel()
+            elif node_future.exception() is not None:
+                future.set_exception(node_future.exception())
+            else:
+                future.set_result(node_future.result())
+
+def _consume_result(future):
+    if not future.cancelled():
+        future.exception()
+
+# (section, hedge, sticky, client arguments) -> JsonRPCClientPool
+_client_pools = {}
+
+def create_jsonrpc_client(section, *, hedge=None, sticky=False, **kwargs):
+    """Creates a client for the nodes listed in `urls` in the given config
+    section (separated by commas), or a regular JsonRPCClient for `url` if
+    there is only one node configured.
+
+    Pools are shared between callers using the same settings so the node
+    stats are kept in one place."""
+
+    urls = [url.strip() for url in config[section].get('urls', '').split(',') if url.strip()]
+    if len(urls) <= 1:
+        url = urls[0] if urls else config[section]['url']
+        return JsonRPCClient(url, **kwargs)
+    if hedge is None:
+        hedge = config[section].getboolean('hedge_requests', False)
+    key = (section, hedge, sticky, tuple(sorted(kwargs.items())))
+    if key not in _client_pools:
+        kwargs['force_instance'] = True
+        _client_pools[key] = JsonRPCClientPool([JsonRPCClient(url, **kwargs) for url in urls],
+                                               urls, hedge=hedge, sticky=sticky)
+    return _client_pools[key]
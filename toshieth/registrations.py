@@ -0,0 +1,169 @@
+import logging
+
+from tornado.escape import json_decode
+from toshi.log import configure_logger
+
+log = logging.getLogger("toshieth.registrations")
+
+NOTIFICATION_REGISTRATIONS_CHANNEL = "notification_registrations"
+TOKEN_REGISTRATIONS_CHANNEL = "token_registrations"
+FILTER_REGISTRATIONS_CHANNEL = "filter_registrations"
+TOKENS_CHANNEL = "tokens"
+
+CHANNELS = [NOTIFICATION_REGISTRATIONS_CHANNEL, TOKEN_REGISTRATIONS_CHANNEL, FILTER_REGISTRATIONS_CHANNEL,
+            TOKENS_CHANNEL]
+
+class RegistrationCache:
+    """Keeps an in memory copy of every address in the notification_registrations
+    and token_registrations tables, so the block monitor can tell if a transaction
+    is interesting without hitting the database, as well as an index of the
+    filter_registrations keyed by (contract_address, topic_id) and the set of
+    known token contract addresses.
+
+    Everything is loaded at startup and kept up to date using the notifications
+    sent by the database triggers on each table (see migrate_00000026.sql,
+    migrate_00000027.sql and migrate_00000028.sql). Until the cache is `ready` callers should fall back on
+    querying the database.
+    """
+
+    def __init__(self):
+        configure_logger(log)
+        self.notification_addresses = set()
+        self.token_addresses = set()
+        # (contract_address, topic_id) -> {filter_id: topic}
+        self.filters = {}
+        self.known_tokens = set()
+        # incremented whenever the registrations change, so that results
+        # based on them can tell if they're out of date
+        self.generation = 0
+        self._con = None
+        self._pool = None
+        self._loading = False
+        self._pending_changes = []
+
+    @property
+    def ready(self):
+        return self._con is not None and not self._con.is_closed() and not self._loading
+
+    def is_registered(self, *addresses):
+        """Returns True if any of the addresses have a notification registration"""
+        return any(address in self.notification_addresses for address in addresses)
+
+    def is_token_registered(self, *addresses):
+        """Returns True if any of the addresses have a token registration"""
+        return any(address in self.token_addresses for address in addresses)
+
+    def is_known_token(self, contract_address):
+        """Returns True if the contract address is in the tokens table"""
+        return contract_address in self.known_tokens
+
+    def add_known_tokens(self, *contract_addresses):
+        self.known_tokens.update(contract_addresses)
+        self.generation += 1
+
+    def get_filters(self, contract_address, topic_id):
+        """Returns a list of (filter_id, topic) tuples registered for the given
+        contract address and topic id"""
+        return list(self.filters.get((contract_address, topic_id), {}).items())
+
+    async def start(self, pool):
+        self._pool = pool
+        self._loading = True
+        self._pending_changes = []
+        try:
+            self._con = await pool.acquire()
+            # start listening before loading so no changes are missed
+            # between loading the tables and the listeners being ready
+            for channel in CHANNELS:
+                await self._con.add_listener(channel, self._on_notification)
+            notification_rows = await self._con.fetch("SELECT DISTINCT eth_address FROM notification_registrations")
+            token_rows = await self._con.fetch("SELECT eth_address FROM token_registrations")
+            filter_rows = await self._con.fetch("SELECT filter_id, contract_address, topic_id, topic FROM filter_registrations")
+            token_contract_rows = await self._con.fetch("SELECT contract_address FROM tokens")
+        except:
+            log.exception("Error loading registration cache")
+            self._loading = False
+            await self.stop()
+            return False
+
+        self.notification_addresses = set(row['eth_address'] for row in notification_rows)
+        self.token_addresses = set(row['eth_address'] for row in token_rows)
+        self.filters = {}
+        for row in filter_rows:
+            self.filters.setdefault((row['contract_address'], row['topic_id']), {})[row['filter_id']] = row['topic']
+        self.known_tokens = set(row['contract_address'] for row in token_contract_rows)
+        self._loading = False
+        self.generation += 1
+        # apply anything that changed while the tables were being loaded
+        for channel, payload in self._pending_changes:
+            self._apply_change(channel, payload)
+        self._pending_changes = []
+        log.info("Loaded {} notification, {} token and {} filter registrations, and {} known tokens".format(
+            len(self.notification_addresses), len(self.token_addresses), len(filter_rows),
+            len(self.known_tokens)))
+        return True
+
+    async def stop(self):
+        con, self._con = self._con, None
+        if con is None:
+            return
+        try:
+            if not con.is_closed():
+                for channel in CHANNELS:
+                    await con.remove_listener(channel, self._on_notification)
+        except:
+            log.exception("Error removing registration listeners")
+        try:
+            await self._pool.release(con)
+        except:
+            log.exception("Error releasing registration cache connection")
+
+    async def check(self):
+        """Reloads the cache if the connection used to listen for changes has been lost"""
+        if self._pool is None or self._loading or self.ready:
+            return
+        log.warning("Registration cache listener isn't running, reloading")
+        await self.stop()
+        await self.start(self._pool)
+
+    def _on_notification(self, connection, pid, channel, payload):
+        if self._loading:
+            self._pending_changes.append((channel, payload))
+        else:
+            self._apply_change(channel, payload)
+
+    def _apply_change(self, channel, payload):
+        self.generation += 1
+        if channel == FILTER_REGISTRATIONS_CHANNEL:
+            self._apply_filter_change(payload)
+            return
+        action, _, address = payload.partition(':')
+        if channel == NOTIFICATION_REGISTRATIONS_CHANNEL:
+            addresses = self.notification_addresses
+        elif channel == TOKEN_REGISTRATIONS_CHANNEL:
+            addresses = self.token_addresses
+        elif channel == TOKENS_CHANNEL:
+            addresses = self.known_tokens
+        else:
+            log.warning("Got registration change on unexpected channel: {}".format(channel))
+            return
+        if action == 'add':
+            addresses.add(address)
+        elif action == 'remove':
+            addresses.discard(address)
+        else:
+            log.warning("Got unexpected registration change: {}".format(payload))
+
+    def _apply_filter_change(self, payload):
+        change = json_decode(payload)
+        key = (change['contract_address'], change['topic_id'])
+        if change['action'] == 'add':
+            self.filters.setdefault(key, {})[change['filter_id']] = change['topic']
+        elif change['action'] == 'remove':
+            filters = self.filters.get(key)
+            if filters is not None:
+                filters.pop(change['filter_id'], None)
+                if not filters:
+                    del self.filters[key]
+        else:
+            log.warning("Got unexpected filter registration change: {}".format(payload))
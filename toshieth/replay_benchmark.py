@@ -0,0 +1,352 @@
+"""Deterministic block replay benchmark for the block monitor.
+
+Blocks (with their transactions) and logs are recorded from a real node into
+fixture files, one file per block:
+
+    python -m toshieth.replay_benchmark record --node-url http://localhost:8545 \\
+        --start-block 5000000 --count 100 fixtures/
+
+and are then replayed through the `BlockMonitor` as fast as it can process
+them, using a stand in JSON-RPC node serving the fixtures:
+
+    DATABASE_URL=... REDIS_URL=... python -m toshieth.replay_benchmark replay fixtures/
+
+The replay needs a scratch postgres database and redis instance, it refuses to
+run against a database that already has blocks in it unless `--reset` is given,
+in which case the tables the monitor writes to are emptied first. The most
+active addresses in the fixtures are registered for notifications (see
+`--registrations`) and every contract emitting Transfer events is added as a
+token, so transaction processing does some work.
+
+With `--fetch-receipts` the monitor fetches the receipts of the transactions
+it confirms (see `MONITOR_FETCH_RECEIPTS` in the README). The stand in node builds the
+receipts from the recorded blocks and logs, so they only have the fields the
+monitor uses, and older fixtures don't need to be recorded again.
+
+The report gives blocks/sec, the time spent in each stage of block processing
+and the number of database queries made per block.
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import os
+import socket
+import sys
+import time
+
+from tornado.escape import json_decode, json_encode
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from tornado.web import Application, RequestHandler
+
+from toshi.config import config
+from toshi.database import prepare_database
+from toshi.jsonrpc.client import JsonRPCClient
+from toshi.log import configure_logger
+from toshi.redis import prepare_redis
+from toshi.utils import parse_int
+
+from .constants import TRANSFER_TOPIC
+
+log = logging.getLogger("toshieth.replay_benchmark")
+
+FIXTURE_FILENAME = "block_{:010d}.json"
+
+# tables the monitor writes to, emptied by --reset
+MONITOR_TABLES = ['blocks', 'last_blocknumber', 'token_transactions', 'transactions',
+                  'notification_registrations', 'tokens']
+
+QUERY_METHODS = {'execute', 'executemany', 'fetch', 'fetchrow', 'fetchval'}
+
+DEFAULT_REGISTRATIONS = 100
+
+def load_fixtures(fixtures_dir):
+    """Returns a dict of block number -> {"block": ..., "logs": [...]} for all
+    the fixture files in the given directory"""
+
+    fixtures = {}
+    for filename in os.listdir(fixtures_dir):
+        if not filename.startswith("block_") or not filename.endswith(".json"):
+            continue
+        with open(os.path.join(fixtures_dir, filename)) as f:
+            fixture = json.load(f)
+        fixtures[parse_int(fixture['block']['number'])] = fixture
+    if not fixtures:
+        raise Exception("No fixtures found in {}".format(fixtures_dir))
+    block_numbers = sorted(fixtures)
+    if block_numbers != list(range(block_numbers[0], block_numbers[-1] + 1)):
+        raise Exception("Fixtures in {} are not a continuous range of blocks".format(fixtures_dir))
+    return fixtures
+
+async def record(node_url, start_block_number, count, fixtures_dir):
+
+    eth = JsonRPCClient(node_url, connect_timeout=10.0, request_timeout=60.0)
+    os.makedirs(fixtures_dir, exist_ok=True)
+    for block_number in range(start_block_number, start_block_number + count):
+        block = await eth.eth_getBlockByNumber(block_number, with_transactions=True)
+        if block is None:
+            log.warning("Block #{} doesn't exist yet, stopping".format(block_number))
+            break
+        logs_list = await eth.eth_getLogs(fromBlock=block_number, toBlock=block_number)
+        if any(_log.get('blockHash') != block['hash'] for _log in logs_list):
+            raise Exception("Block #{} changed while recording".format(block_number))
+        with open(os.path.join(fixtures_dir, FIXTURE_FILENAME.format(block_number)), 'w') as f:
+            json.dump({"block": block, "logs": logs_list}, f)
+        log.info("Recorded block #{} ({} transactions, {} logs)".format(
+            block_number, len(block['transactions']), len(logs_list)))
+
+class StandInNode:
+    """Serves the fixtures as a JSON-RPC node would. `head` is what
+    eth_blockNumber returns, so blocks past it can be held back until the
+    replay is started"""
+
+    def __init__(self, fixtures):
+        self.fixtures = fixtures
+        self.head = min(fixtures) - 1
+        self.transactions = {tx['hash']: tx
+                             for fixture in fixtures.values()
+                             for tx in fixture['block']['transactions']}
+        self.receipts = {}
+        for fixture in fixtures.values():
+            block = fixture['block']
+            for tx in block['transactions']:
+                self.receipts[tx['hash']] = {
+                    'transactionHash': tx['hash'],
+                    'transactionIndex': tx['transactionIndex'],
+                    'blockHash': block['hash'],
+                    'blockNumber': block['number'],
+                    'from': tx['from'],
+                    'to': tx['to'],
+                    'logs': []
+                }
+            for _log in fixture['logs']:
+                if _log['transactionHash'] in self.receipts:
+                    self.receipts[_log['transactionHash']]['logs'].append(_log)
+
+    def eth_blockNumber(self):
+        return hex(self.head)
+
+    def eth_getBlockByNumber(self, block_number, with_transactions=False):
+        block_number = parse_int(block_number)
+        if block_number > self.head or block_number not in self.fixtures:
+            return None
+        block = self.fixtures[block_number]['block']
+        if not with_transactions:
+            block = dict(block, transactions=[tx['hash'] for tx in block['transactions']])
+        return block
+
+    def eth_getLogs(self, filter):
+        from_block = parse_int(filter.get('fromBlock'))
+        to_block = parse_int(filter.get('toBlock'))
+        if to_block is None:
+            to_block = self.head
+        if from_block is None:
+            from_block = to_block
+        addresses = filter.get('address')
+        if isinstance(addresses, str):
+            addresses = [addresses]
+        logs_list = []
+        for block_number in range(from_block, to_block + 1):
+            if block_number > self.head or block_number not in self.fixtures:
+                continue
+            logs_list.extend(_log for _log in self.fixtures[block_number]['logs']
+                             if addresses is None or _log['address'] in addresses)
+        return logs_list
+
+    def eth_getTransactionByHash(self, tx_hash):
+        return self.transactions.get(tx_hash)
+
+    def eth_getTransactionReceipt(self, tx_hash):
+        receipt = self.receipts.get(tx_hash)
+        if receipt is None or parse_int(receipt['blockNumber']) > self.head:
+            return None
+        return receipt
+
+    def eth_newPendingTransactionFilter(self):
+        return "0x1"
+
+    def eth_getFilterChanges(self, filter_id):
+        return []
+
+    def eth_gasPrice(self):
+        return hex(20000000000)
+
+    def handle(self, request):
+        method = getattr(self, request.get('method', ''), None) \
+            if request.get('method', '').startswith('eth_') else None
+        if method is None:
+            return {"jsonrpc": "2.0", "id": request.get('id'),
+                    "error": {"code": -32601, "message": "Method not found"}}
+        return {"jsonrpc": "2.0", "id": request.get('id'),
+                "result": method(*request.get('params', []))}
+
+class StandInNodeHandler(RequestHandler):
+
+    def post(self):
+        node = self.application.settings['node']
+        request = json_decode(self.request.body)
+        if isinstance(request, list):
+            response = [node.handle(r) for r in request]
+        else:
+            response = node.handle(request)
+        self.set_header("Content-Type", "application/json")
+        self.write(json_encode(response))
+
+class QueryCountingPool:
+    """Wraps the monitor's database pool to count the queries made through it"""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.queries = 0
+
+    def acquire(self):
+        return QueryCountingAcquireContext(self)
+
+    def __getattr__(self, name):
+        return getattr(self.pool, name)
+
+class QueryCountingAcquireContext:
+
+    def __init__(self, counter):
+        self.counter = counter
+        self.context = counter.pool.acquire()
+
+    async def __aenter__(self):
+        con = await self.context.__aenter__()
+        return QueryCountingConnection(con, self.counter)
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        return await self.context.__aexit__(exc_type, exc_value, traceback)
+
+class QueryCountingConnection:
+
+    def __init__(self, con, counter):
+        self._con = con
+        self._counter = counter
+
+    def __getattr__(self, name):
+        if name in QUERY_METHODS:
+            self._counter.queries += 1
+        return getattr(self._con, name)
+
+async def prepare_replay_database(fixtures, registrations, reset):
+
+    pool = await prepare_database(handle_migration=True)
+    await prepare_redis()
+
+    first_block = fixtures[min(fixtures)]['block']
+    async with pool.acquire() as con:
+        if await con.fetchval("SELECT COUNT(*) FROM blocks") > 0:
+            if not reset:
+                raise Exception("The database already has blocks in it, use a scratch database "
+                                "or run with --reset to empty the monitor's tables")
+            for table in MONITOR_TABLES:
+                await con.execute("DELETE FROM {}".format(table))
+
+        # start the monitor from just before the first block, with a
+        # parent it will accept
+        await con.execute("DELETE FROM last_blocknumber")
+        await con.execute("INSERT INTO last_blocknumber VALUES ($1)", parse_int(first_block['number']) - 1)
+        await con.execute("INSERT INTO blocks (blocknumber, timestamp, hash, parent_hash) "
+                          "VALUES ($1, $2, $3, $4)",
+                          parse_int(first_block['number']) - 1, parse_int(first_block['timestamp']) - 1,
+                          first_block['parentHash'], "0x" + "0" * 64)
+
+        # register the most active addresses so there is something to process
+        activity = collections.Counter()
+        token_addresses = set()
+        for fixture in fixtures.values():
+            for tx in fixture['block']['transactions']:
+                activity.update(address for address in (tx['from'], tx['to']) if address)
+            for _log in fixture['logs']:
+                if _log['topics'] and _log['topics'][0] == TRANSFER_TOPIC:
+                    token_addresses.add(_log['address'])
+        await con.executemany("INSERT INTO notification_registrations (toshi_id, service, registration_id, eth_address) "
+                              "VALUES ($1, 'ws', $1, $2) ON CONFLICT DO NOTHING",
+                              [("replay{}".format(i), address)
+                               for i, (address, _) in enumerate(activity.most_common(registrations))])
+        await con.executemany("INSERT INTO tokens (contract_address) VALUES ($1) ON CONFLICT DO NOTHING",
+                              [(address,) for address in token_addresses])
+    return pool
+
+async def replay(fixtures_dir, registrations, reset, fetch_receipts=False):
+
+    fixtures = load_fixtures(fixtures_dir)
+    first_block_number, last_block_number = min(fixtures), max(fixtures)
+
+    node = StandInNode(fixtures)
+    sockets = bind_sockets(0, '127.0.0.1', family=socket.AF_INET)
+    server = HTTPServer(Application([(r"/", StandInNodeHandler)], node=node))
+    server.add_sockets(sockets)
+    node_url = "http://127.0.0.1:{}/".format(sockets[0].getsockname()[1])
+
+    config['monitor'] = {'url': node_url, 'fetch_receipts': 'true' if fetch_receipts else 'false'}
+    await prepare_replay_database(fixtures, registrations, reset)
+
+    # imported here so the monitor is created after the config is set up
+    from .monitor import BlockMonitor
+    monitor = BlockMonitor()
+    await monitor.start()
+    monitor.db_pool = QueryCountingPool(monitor.db_pool)
+    monitor.reset_stage_times()
+
+    start_time = time.perf_counter()
+    node.head = last_block_number
+    monitor._head_block_number = last_block_number
+    while monitor.last_block_number < last_block_number:
+        last_processed_block_number = monitor.last_block_number
+        if monitor._block_checking_process is None:
+            monitor.run_block_check()
+        await monitor._block_checking_process
+        if monitor.last_block_number == last_processed_block_number:
+            raise Exception("Replay stopped at block #{}".format(last_processed_block_number + 1))
+    total_time = time.perf_counter() - start_time
+
+    await monitor.shutdown()
+    server.stop()
+
+    block_count = last_block_number - first_block_number + 1
+    print("Replayed {} blocks (#{} to #{}, {} transactions, {} logs) in {:.3f}s: {:.2f} blocks/sec".format(
+        block_count, first_block_number, last_block_number,
+        sum(len(fixture['block']['transactions']) for fixture in fixtures.values()),
+        sum(len(fixture['logs']) for fixture in fixtures.values()),
+        total_time, block_count / total_time))
+    print("{:<14}{:>12}{:>16}".format("stage", "total (s)", "per block (ms)"))
+    for stage, stage_time in monitor.stage_times.items():
+        print("{:<14}{:>12.3f}{:>16.3f}".format(stage, stage_time, stage_time / block_count * 1000))
+    print("Database queries: {} ({:.2f} per block)".format(
+        monitor.db_pool.queries, monitor.db_pool.queries / block_count))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Block monitor replay benchmark")
+    subparsers = parser.add_subparsers(dest='command')
+    record_parser = subparsers.add_parser('record', help="record blocks and logs from a node")
+    record_parser.add_argument('--node-url', required=True)
+    record_parser.add_argument('--start-block', type=int, required=True)
+    record_parser.add_argument('--count', type=int, default=100)
+    record_parser.add_argument('fixtures_dir')
+    replay_parser = subparsers.add_parser('replay', help="replay recorded blocks through the block monitor")
+    replay_parser.add_argument('--registrations', type=int, default=DEFAULT_REGISTRATIONS,
+                               help="number of addresses to register for notifications")
+    replay_parser.add_argument('--reset', action='store_true',
+                               help="empty the monitor's tables before replaying")
+    replay_parser.add_argument('--fetch-receipts', action='store_true',
+                               help="have the monitor fetch the receipts of the transactions it confirms")
+    replay_parser.add_argument('fixtures_dir')
+    args = parser.parse_args(argv)
+
+    configure_logger(log)
+    if args.command == 'record':
+        task = record(args.node_url, args.start_block, args.count, args.fixtures_dir)
+    elif args.command == 'replay':
+        task = replay(args.fixtures_dir, args.registrations, args.reset, args.fetch_receipts)
+    else:
+        parser.print_help()
+        sys.exit(1)
+    asyncio.get_event_loop().run_until_complete(task)
+
+if __name__ == '__main__':
+    main()
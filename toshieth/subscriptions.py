@@ -0,0 +1,156 @@
+import asyncio
+import logging
+
+from tornado.escape import json_encode, json_decode
+from tornado.httpclient import HTTPRequest
+from tornado.websocket import websocket_connect
+from toshi.log import configure_logger
+
+log = logging.getLogger("toshieth.subscriptions")
+
+NEW_HEADS = "newHeads"
+NEW_PENDING_TRANSACTIONS = "newPendingTransactions"
+
+MAX_RECONNECT_DELAY = 10
+
+class NodeSubscription:
+    """Subscribes to `newHeads` and `newPendingTransactions` on an ethereum
+    node's websocket interface using `eth_subscribe`.
+
+    `on_new_head` is called with each new block header, and
+    `on_new_pending_transaction` with the hash of each new pending
+    transaction. The connection is re-established automatically if it drops,
+    `heads_subscribed` and `pending_transactions_subscribed` can be used to
+    check if the subscriptions are currently active, and so whether or not
+    the caller needs to fall back on polling.
+
+    If `head_timeout` is given, the connection is also re-established when
+    no new heads arrive for that many seconds, in case the node has stopped
+    sending notifications without closing the connection.
+    """
+
+    def __init__(self, url, on_new_head, on_new_pending_transaction, *,
+                 on_connection_lost=None, connect_timeout=5.0, head_timeout=None):
+        configure_logger(log)
+        self.url = url
+        self.on_new_head = on_new_head
+        self.on_new_pending_transaction = on_new_pending_transaction
+        self.on_connection_lost = on_connection_lost
+        self.connect_timeout = connect_timeout
+        self.head_timeout = head_timeout
+        # subscription id -> subscription type
+        self.subscriptions = {}
+        self.last_head_time = None
+        self._con = None
+        self._process = None
+        self._stopped = True
+
+    @property
+    def heads_subscribed(self):
+        return NEW_HEADS in self.subscriptions.values()
+
+    @property
+    def pending_transactions_subscribed(self):
+        return NEW_PENDING_TRANSACTIONS in self.subscriptions.values()
+
+    def start(self):
+        if self._process is None or self._process.done():
+            self._stopped = False
+            self._process = asyncio.get_event_loop().create_task(self._run())
+
+    async def stop(self):
+        self._stopped = True
+        if self._con is not None:
+            self._con.close()
+        if self._process is not None:
+            self._process.cancel()
+            try:
+                await self._process
+            except asyncio.CancelledError:
+                pass
+            self._process = None
+
+    async def _run(self):
+        reconnect_delay = 0
+        while not self._stopped:
+            try:
+                await self._connect()
+                reconnect_delay = 0
+                await self._read_messages()
+            except asyncio.CancelledError:
+                raise
+            except:
+                log.exception("Error in node subscription")
+            finally:
+                was_subscribed = bool(self.subscriptions)
+                self.subscriptions = {}
+                if self._con is not None:
+                    self._con.close()
+                    self._con = None
+                if was_subscribed and self.on_connection_lost is not None and not self._stopped:
+                    self.on_connection_lost()
+            if not self._stopped:
+                reconnect_delay = min(reconnect_delay + 1, MAX_RECONNECT_DELAY)
+                log.warning("Lost connection to node subscription, reconnecting in {} seconds".format(reconnect_delay))
+                await asyncio.sleep(reconnect_delay)
+
+    async def _connect(self):
+        self._con = await websocket_connect(HTTPRequest(self.url, connect_timeout=self.connect_timeout))
+        # request id -> subscription type
+        self._requests = {}
+        for request_id, subscription_type in enumerate([NEW_HEADS, NEW_PENDING_TRANSACTIONS], 1):
+            self._requests[request_id] = subscription_type
+            self._con.write_message(json_encode({
+                "jsonrpc": "2.0",
+                "id": request_id,
+                "method": "eth_subscribe",
+                "params": [subscription_type]
+            }))
+
+    async def _read_messages(self):
+        while True:
+            if self.head_timeout is not None and self.heads_subscribed:
+                timeout = self.last_head_time + self.head_timeout - asyncio.get_event_loop().time()
+                try:
+                    message = await asyncio.wait_for(self._con.read_message(), max(timeout, 0))
+                except asyncio.TimeoutError:
+                    log.warning("No new heads from node subscription for {} seconds".format(self.head_timeout))
+                    return
+            else:
+                message = await self._con.read_message()
+            if message is None:
+                return
+            try:
+                message = json_decode(message)
+            except ValueError:
+                log.warning("Got invalid message from node subscription: {}".format(message))
+                continue
+            if 'id' in message:
+                self._handle_response(message)
+            elif message.get('method') == 'eth_subscription':
+                self._handle_notification(message['params'])
+
+    def _handle_response(self, message):
+        subscription_type = self._requests.pop(message['id'], None)
+        if subscription_type is None:
+            return
+        if 'error' in message or message.get('result') is None:
+            # nodes don't all support newPendingTransactions, in which
+            # case polling is still used for pending transactions
+            log.warning("Unable to subscribe to {}: {}".format(subscription_type, message.get('error')))
+            return
+        log.info("Subscribed to {} with subscription id: {}".format(subscription_type, message['result']))
+        self.subscriptions[message['result']] = subscription_type
+        if subscription_type == NEW_HEADS:
+            self.last_head_time = asyncio.get_event_loop().time()
+
+    def _handle_notification(self, params):
+        subscription_type = self.subscriptions.get(params.get('subscription'))
+        try:
+            if subscription_type == NEW_HEADS:
+                self.last_head_time = asyncio.get_event_loop().time()
+                self.on_new_head(params['result'])
+            elif subscription_type == NEW_PENDING_TRANSACTIONS:
+                self.on_new_pending_transaction(params['result'])
+        except:
+            log.exception("Error handling {} notification".format(subscription_type))
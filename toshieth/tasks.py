@@ -50,3 +50,14 @@ push_dispatcher = Dispatcher(queue_name="pushservice")
 eth_dispatcher = Dispatcher(queue_name="ethservice")
 erc20_dispatcher = Dispatcher(queue_name="erc20")
 collectibles_dispatcher = Dispatcher(queue_name="collectibles")
+
+# shard -> dispatcher for the monitor's transaction processing workers
+_monitor_shard_dispatchers = {}
+
+def monitor_shard_queue_name(shard):
+    return "monitor_shard_{}".format(shard)
+
+def monitor_shard_dispatcher(shard):
+    if shard not in _monitor_shard_dispatchers:
+        _monitor_shard_dispatchers[shard] = Dispatcher(queue_name=monitor_shard_queue_name(shard))
+    return _monitor_shard_dispatchers[shard]
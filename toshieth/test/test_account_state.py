@@ -0,0 +1,53 @@
+from tornado.testing import gen_test
+from toshieth.test.base import EthServiceBaseTest
+from toshi.test.redis import requires_redis
+
+from toshieth.account_state import (
+    get_account_state, set_account_state, invalidate_account_state, invalidate_all_account_states
+)
+
+TEST_ADDRESS = "0x056db290f8ba3250ca64a45d16284d04bc6f5fbf"
+TEST_ADDRESS_2 = "0x35351b44e03ec8515664a955146bf9c6e503a381"
+
+class AccountStateTest(EthServiceBaseTest):
+
+    @gen_test(timeout=15)
+    @requires_redis
+    async def test_account_state_cache(self):
+
+        state, version = await get_account_state(self.redis, TEST_ADDRESS, 10)
+        self.assertIsNone(state)
+        await set_account_state(self.redis, TEST_ADDRESS, 10, version,
+                                balance=10 ** 20, nonce=5, network_nonce=3)
+
+        state, version = await get_account_state(self.redis, TEST_ADDRESS, 10)
+        self.assertEqual(state['balance'], 10 ** 20)
+        self.assertEqual(state['nonce'], 5)
+        self.assertEqual(state['network_nonce'], 3)
+
+        # new blocks make the state stale
+        state, _ = await get_account_state(self.redis, TEST_ADDRESS, 11)
+        self.assertIsNone(state)
+
+        # invalidating another address doesn't affect it
+        await invalidate_account_state(self.redis, TEST_ADDRESS_2)
+        state, _ = await get_account_state(self.redis, TEST_ADDRESS, 10)
+        self.assertIsNotNone(state)
+
+        await invalidate_account_state(self.redis, TEST_ADDRESS)
+        state, _ = await get_account_state(self.redis, TEST_ADDRESS, 10)
+        self.assertIsNone(state)
+
+        # states stored after being invalidated using an older version are ignored
+        await set_account_state(self.redis, TEST_ADDRESS, 10, version,
+                                balance=10 ** 20, nonce=5, network_nonce=3)
+        state, version = await get_account_state(self.redis, TEST_ADDRESS, 10)
+        self.assertIsNone(state)
+
+        await set_account_state(self.redis, TEST_ADDRESS, 10, version,
+                                balance=10 ** 20, nonce=5, network_nonce=3)
+        state, _ = await get_account_state(self.redis, TEST_ADDRESS, 10)
+        self.assertIsNotNone(state)
+        await invalidate_all_account_states(self.redis)
+        state, _ = await get_account_state(self.redis, TEST_ADDRESS, 10)
+        self.assertIsNone(state)
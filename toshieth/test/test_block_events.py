@@ -0,0 +1,82 @@
+import unittest
+
+from toshieth.block_events import build_block_event, build_retract_event, group_block_logs, parse_stream_entries
+from toshieth.constants import TRANSFER_TOPIC, DEPOSIT_TOPIC, WETH_CONTRACT_ADDRESS
+from toshieth.test.utils import random_address, random_hash
+
+def make_log(address, topics, log_index, data="0x"):
+    return {"address": address, "topics": topics, "data": data, "logIndex": hex(log_index),
+            "transactionHash": random_hash(), "blockNumber": "0x10"}
+
+class Registrations:
+
+    ready = True
+
+    def __init__(self, filters):
+        self.filters = filters
+
+    def get_filters(self, contract_address, topic_id):
+        return self.filters.get((contract_address, topic_id), [])
+
+def stream_reply(events):
+    """Builds an XREADGROUP reply in the form returned by redis"""
+
+    entries = []
+    for i, event in enumerate(events):
+        fields = []
+        for field, value in event.items():
+            fields.extend((field.encode('utf-8'), value.encode('utf-8')))
+        entries.append(("1-{}".format(i).encode('utf-8'), fields))
+    return [[b"toshieth.monitor:block_events", entries]]
+
+class BlockEventsTest(unittest.TestCase):
+
+    def test_group_block_logs(self):
+
+        token_address = random_address()
+        filter_address = random_address()
+        filter_topic = random_hash()
+        logs_list = [
+            make_log(token_address, [TRANSFER_TOPIC, random_hash(), random_hash()], 0, "0x" + "00" * 32),
+            make_log(WETH_CONTRACT_ADDRESS, [DEPOSIT_TOPIC, random_hash()], 1),
+            make_log(token_address, [TRANSFER_TOPIC, random_hash(), random_hash()], 2),
+            make_log(filter_address, [filter_topic], 3),
+            make_log(random_address(), [random_hash()], 4),
+            make_log(random_address(), [], 5)
+        ]
+
+        logs = group_block_logs(logs_list)
+        self.assertEqual(set(logs), {token_address, WETH_CONTRACT_ADDRESS})
+        self.assertEqual([log_index for _, log_index, _, _ in logs[token_address][TRANSFER_TOPIC]], [0, 2])
+        self.assertEqual(logs[token_address][TRANSFER_TOPIC][0],
+                         [logs_list[0]['transactionHash'], 0, logs_list[0]['topics'][1:], logs_list[0]['data']])
+
+        registrations = Registrations({(filter_address, filter_topic): [("filter-id", filter_topic)]})
+        logs = group_block_logs(logs_list, registrations)
+        self.assertEqual(set(logs), {token_address, WETH_CONTRACT_ADDRESS, filter_address})
+        self.assertEqual(logs[filter_address][filter_topic], [[logs_list[3]['transactionHash'], 3, [], "0x"]])
+
+        registrations.ready = False
+        self.assertNotIn(filter_address, group_block_logs(logs_list, registrations))
+
+    def test_parse_stream_entries(self):
+
+        token_address = random_address()
+        block = {"number": "0x10", "hash": random_hash(), "parentHash": random_hash()}
+        logs_list = [make_log(token_address, [TRANSFER_TOPIC], 0, "0x" + "00" * 96)]
+        reply = stream_reply([build_block_event(block, logs_list), build_retract_event(16, block['hash'])])
+
+        entries = parse_stream_entries(reply)
+        self.assertEqual([entry_id for entry_id, _ in entries], ["1-0", "1-1"])
+
+        event = entries[0][1]
+        self.assertEqual(event['type'], 'block')
+        self.assertEqual(event['number'], 16)
+        self.assertEqual(event['hash'], block['hash'])
+        self.assertEqual(event['parent_hash'], block['parentHash'])
+        self.assertEqual(event['logs'], {token_address: {TRANSFER_TOPIC: [
+            [logs_list[0]['transactionHash'], 0, [], logs_list[0]['data']]]}})
+
+        self.assertEqual(entries[1][1], {'type': 'retract', 'number': 16, 'hash': block['hash']})
+
+        self.assertEqual(parse_stream_entries(None), [])
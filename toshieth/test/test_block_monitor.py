@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+
+from tornado.testing import gen_test
+
+from toshi.test.base import ToshiWebSocketJsonRPCClient
+from toshieth.test.base import EthServiceBaseTest, requires_full_stack
+from toshi.test.ethereum.faucet import FAUCET_PRIVATE_KEY
+from toshi.ethereum.utils import private_key_to_address, data_decoder
+
+TEST_PRIVATE_KEY = data_decoder("0xe8f32e723decf4051aefac8e2c93c9c5b214313817cdb01a1494b917c8436b35")
+TEST_ADDRESS = private_key_to_address(TEST_PRIVATE_KEY)
+
+TEST_APN_ID = "64be4fe95ba967bb533f0c240325942b9e1f881b5cd2982568a305dd4933e0bd"
+
+class BlockMonitorTest(EthServiceBaseTest):
+
+    @gen_test(timeout=60)
+    @requires_full_stack(block_monitor=True)
+    async def test_catch_up_with_prefetch_window(self, *, monitor):
+
+        to_address = "0x{}".format(os.urandom(20).hex())
+        resp = await self.fetch_signed("/apn/register", signing_key=TEST_PRIVATE_KEY, method="POST", body={
+            "registration_id": TEST_APN_ID,
+            "address": to_address
+        })
+        self.assertEqual(resp.code, 204)
+
+        tx_hashes = []
+        for _ in range(5):
+            tx_hash = await self.send_tx(FAUCET_PRIVATE_KEY, to_address, 10 ** 18,
+                                         wait_on_tx_confirmation=True)
+            tx_hashes.append(tx_hash)
+
+        last_block = monitor.last_block_number
+
+        # pretend the monitor was restarted while behind
+        monitor._block_prefetch_window = 3
+        monitor._head_block_number = last_block
+        monitor.last_block_number = last_block - 10
+
+        await monitor.block_check()
+
+        self.assertGreaterEqual(monitor.last_block_number, last_block)
+        self.assertEqual(monitor._prefetched_blocks, {})
+
+        async with self.pool.acquire() as con:
+            confirmed = await con.fetchval(
+                "SELECT COUNT(*) FROM transactions WHERE hash = ANY($1) AND status = 'confirmed'",
+                tx_hashes)
+            stale_blocks = await con.fetchval(
+                "SELECT COUNT(*) FROM blocks WHERE stale = TRUE")
+
+        self.assertEqual(confirmed, len(tx_hashes))
+        self.assertEqual(stale_blocks, 0)
+
+    @gen_test(timeout=60)
+    @requires_full_stack(block_monitor=True)
+    async def test_process_block_range(self, *, monitor):
+
+        to_address = "0x{}".format(os.urandom(20).hex())
+        resp = await self.fetch_signed("/apn/register", signing_key=TEST_PRIVATE_KEY, method="POST", body={
+            "registration_id": TEST_APN_ID,
+            "address": to_address
+        })
+        self.assertEqual(resp.code, 204)
+
+        tx_hashes = []
+        for _ in range(3):
+            tx_hash = await self.send_tx(FAUCET_PRIVATE_KEY, to_address, 10 ** 18,
+                                         wait_on_tx_confirmation=True)
+            tx_hashes.append(tx_hash)
+
+        # stop the monitor from processing any more blocks on it's own
+        await monitor.shutdown()
+        monitor._shutdown = False
+        last_block = monitor.last_block_number
+        start_block = last_block - 5
+
+        # the range must follow on from the last processed block
+        real_hash = monitor.recent_blocks.get(start_block - 1)['hash']
+        monitor.recent_blocks.get(start_block - 1)['hash'] = "0x" + "00" * 32
+        self.assertFalse(await monitor.process_block_range(start_block, last_block))
+        monitor.recent_blocks.get(start_block - 1)['hash'] = real_hash
+
+        async with self.pool.acquire() as con:
+            await con.execute("UPDATE transactions SET status = 'unconfirmed' WHERE hash = ANY($1)", tx_hashes)
+        monitor.last_block_number = start_block - 1
+        self.assertTrue(await monitor.process_block_range(start_block, last_block))
+        self.assertEqual(monitor.last_block_number, last_block)
+
+        async with self.pool.acquire() as con:
+            confirmed = await con.fetchval(
+                "SELECT COUNT(*) FROM transactions WHERE hash = ANY($1) AND status = 'confirmed'",
+                tx_hashes)
+            blocknumber = await con.fetchval("SELECT blocknumber FROM last_blocknumber")
+        self.assertEqual(confirmed, len(tx_hashes))
+        self.assertGreaterEqual(blocknumber, last_block)
+        monitor._shutdown = True
+
+    @gen_test(timeout=60)
+    @requires_full_stack(block_monitor=True)
+    async def test_confirm_with_fetched_receipts(self, *, monitor):
+
+        monitor._fetch_receipts = True
+
+        to_address = "0x{}".format(os.urandom(20).hex())
+        resp = await self.fetch_signed("/apn/register", signing_key=TEST_PRIVATE_KEY, method="POST", body={
+            "registration_id": TEST_APN_ID,
+            "address": to_address
+        })
+        self.assertEqual(resp.code, 204)
+
+        tx_hash = await self.send_tx(FAUCET_PRIVATE_KEY, to_address, 10 ** 18,
+                                     wait_on_tx_confirmation=True)
+
+        async with self.pool.acquire() as con:
+            status = await con.fetchval("SELECT status FROM transactions WHERE hash = $1", tx_hash)
+        self.assertEqual(status, 'confirmed')
+
+    @gen_test(timeout=60)
+    @requires_full_stack(block_monitor=True)
+    async def test_batch_status_updates(self, *, monitor):
+
+        to_address = "0x{}".format(os.urandom(20).hex())
+        resp = await self.fetch_signed("/apn/register", signing_key=TEST_PRIVATE_KEY, method="POST", body={
+            "registration_id": TEST_APN_ID,
+            "address": to_address
+        })
+        self.assertEqual(resp.code, 204)
+
+        tx_hashes = []
+        for _ in range(3):
+            tx_hash = await self.send_tx(FAUCET_PRIVATE_KEY, to_address, 10 ** 18,
+                                         wait_on_tx_confirmation=True)
+            tx_hashes.append(tx_hash)
+
+        await monitor.shutdown()
+        monitor._shutdown = False
+        monitor._batch_status_updates = True
+        last_block = monitor.last_block_number
+
+        async with self.pool.acquire() as con:
+            start_block = await con.fetchval("SELECT MIN(blocknumber) FROM transactions WHERE hash = ANY($1)", tx_hashes)
+            await con.execute("UPDATE transactions SET status = 'unconfirmed' WHERE hash = ANY($1)", tx_hashes)
+        monitor.last_block_number = start_block - 1
+        self.assertTrue(await monitor.process_block_range(start_block, last_block))
+
+        while True:
+            async with self.pool.acquire() as con:
+                confirmed = await con.fetchval(
+                    "SELECT COUNT(*) FROM transactions WHERE hash = ANY($1) AND status = 'confirmed'",
+                    tx_hashes)
+            if confirmed == len(tx_hashes):
+                break
+            await asyncio.sleep(0.1)
+        monitor._shutdown = True
+
+    @gen_test(timeout=60)
+    @requires_full_stack(block_monitor=True)
+    async def test_pending_and_confirmed_written_concurrently(self, *, monitor):
+
+        to_address = "0x{}".format(os.urandom(20).hex())
+        resp = await self.fetch_signed("/apn/register", signing_key=TEST_PRIVATE_KEY, method="POST", body={
+            "registration_id": TEST_APN_ID,
+            "address": to_address
+        })
+        self.assertEqual(resp.code, 204)
+
+        tx_hash = await self.send_tx(FAUCET_PRIVATE_KEY, to_address, 10 ** 18,
+                                     wait_on_tx_confirmation=True)
+
+        await monitor.shutdown()
+        monitor._shutdown = False
+
+        # pretend the transaction is seen as pending while it's block is
+        # being processed, before either has written anything
+        async with self.pool.acquire() as con:
+            await con.execute("DELETE FROM transactions WHERE hash = $1", tx_hash)
+        monitor.processed_transactions.discard(tx_hash)
+        confirmed_tx = await monitor.eth.eth_getTransactionByHash(tx_hash)
+        pending_tx = dict(confirmed_tx, blockNumber=None, blockHash=None, transactionIndex=None)
+
+        await asyncio.gather(
+            monitor.process_transactions([pending_tx], ()),
+            monitor.process_transactions([confirmed_tx], ()))
+
+        async with self.pool.acquire() as con:
+            count = await con.fetchval("SELECT COUNT(*) FROM transactions WHERE hash = $1", tx_hash)
+        self.assertEqual(count, 1)
+        monitor._shutdown = True
+
+    @gen_test(timeout=30)
+    @requires_full_stack(block_monitor=True)
+    async def test_registration_cache_follows_registrations(self, *, monitor):
+
+        address = "0x{}".format(os.urandom(20).hex())
+        self.assertTrue(monitor.registrations.ready)
+        self.assertFalse(monitor.registrations.is_registered(address))
+
+        resp = await self.fetch_signed("/apn/register", signing_key=TEST_PRIVATE_KEY, method="POST", body={
+            "registration_id": TEST_APN_ID,
+            "address": address
+        })
+        self.assertEqual(resp.code, 204)
+
+        while not monitor.registrations.is_registered(address):
+            await asyncio.sleep(0.01)
+
+        resp = await self.fetch("/tokens/{}".format(address))
+        self.assertResponseCodeEqual(resp, 200)
+
+        while not monitor.registrations.is_token_registered(address):
+            await asyncio.sleep(0.01)
+
+        resp = await self.fetch_signed("/apn/deregister", signing_key=TEST_PRIVATE_KEY, method="POST", body={
+            "registration_id": TEST_APN_ID,
+            "address": address
+        })
+        self.assertEqual(resp.code, 204)
+
+        while monitor.registrations.is_registered(address):
+            await asyncio.sleep(0.01)
+
+    @gen_test(timeout=30)
+    @requires_full_stack(block_monitor=True)
+    async def test_registration_cache_follows_filters(self, *, monitor):
+
+        contract_address = "0x{}".format(os.urandom(20).hex())
+        self.assertTrue(monitor.registrations.ready)
+
+        con = ToshiWebSocketJsonRPCClient(self.get_url("/ws"), signing_key=TEST_PRIVATE_KEY)
+        await con.connect()
+        filter_id = await con.call("filter", {"address": contract_address, "topic": "Transfer(address,address,uint256)"})
+
+        def get_filter_ids():
+            return [_filter_id
+                    for (address, topic_id), filters in monitor.registrations.filters.items()
+                    if address == contract_address
+                    for _filter_id in filters]
+
+        while filter_id not in get_filter_ids():
+            await asyncio.sleep(0.01)
+
+        await con.call("remove_filters", [filter_id])
+
+        while get_filter_ids():
+            await asyncio.sleep(0.01)
+        con.con.close()
+
+    @gen_test(timeout=30)
+    @requires_full_stack(block_monitor=True)
+    async def test_registration_cache_follows_tokens(self, *, monitor):
+
+        contract_address = "0x{}".format(os.urandom(20).hex())
+        self.assertTrue(monitor.registrations.ready)
+        self.assertFalse(monitor.registrations.is_known_token(contract_address))
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO tokens (contract_address, name, symbol, decimals, custom, ready) "
+                              "VALUES ($1, $2, $3, $4, $5, $6)",
+                              contract_address, "Test Token", "TST", 18, True, True)
+
+        while not monitor.registrations.is_known_token(contract_address):
+            await asyncio.sleep(0.01)
+
+        async with self.pool.acquire() as con:
+            await con.execute("DELETE FROM tokens WHERE contract_address = $1", contract_address)
+
+        while monitor.registrations.is_known_token(contract_address):
+            await asyncio.sleep(0.01)
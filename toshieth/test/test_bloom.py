@@ -0,0 +1,41 @@
+import os
+import unittest
+
+from toshieth.bloom import bloom_add, bloom_contains, parse_logs_bloom
+from toshieth.constants import TRANSFER_TOPIC, WETH_CONTRACT_ADDRESS
+
+EMPTY_LOGS_BLOOM = "0x" + ("0" * 512)
+
+class BloomTest(unittest.TestCase):
+
+    def test_empty_bloom_contains_nothing(self):
+
+        self.assertFalse(bloom_contains(EMPTY_LOGS_BLOOM, WETH_CONTRACT_ADDRESS))
+        self.assertFalse(bloom_contains(EMPTY_LOGS_BLOOM, TRANSFER_TOPIC))
+
+    def test_bloom_contains_added_values(self):
+
+        addresses = ["0x{}".format(os.urandom(20).hex()) for _ in range(10)]
+        logs_bloom = bloom_add(EMPTY_LOGS_BLOOM, TRANSFER_TOPIC, *addresses)
+
+        self.assertTrue(bloom_contains(logs_bloom, TRANSFER_TOPIC))
+        for address in addresses:
+            self.assertTrue(bloom_contains(logs_bloom, address))
+            # addresses should match regardless of case
+            self.assertTrue(bloom_contains(logs_bloom, address.upper().replace("0X", "0x")))
+        self.assertTrue(bloom_contains(logs_bloom, TRANSFER_TOPIC, *addresses))
+
+    def test_bloom_does_not_contain_other_values(self):
+
+        logs_bloom = bloom_add(EMPTY_LOGS_BLOOM, WETH_CONTRACT_ADDRESS)
+        # with only 3 bits set the chance of a false positive is negligible
+        misses = [bloom_contains(logs_bloom, "0x{}".format(os.urandom(20).hex())) for _ in range(100)]
+        self.assertFalse(any(misses))
+        self.assertFalse(bloom_contains(logs_bloom, WETH_CONTRACT_ADDRESS, TRANSFER_TOPIC))
+
+    def test_parse_logs_bloom(self):
+
+        logs_bloom = bloom_add(EMPTY_LOGS_BLOOM, WETH_CONTRACT_ADDRESS)
+        encoded = "0x{:0512x}".format(logs_bloom)
+        self.assertEqual(parse_logs_bloom(encoded), logs_bloom)
+        self.assertEqual(parse_logs_bloom(logs_bloom), logs_bloom)
@@ -0,0 +1,112 @@
+import random
+import unittest
+
+from ethereum.abi import decode_abi, decode_single
+
+from toshi.ethereum.utils import data_decoder
+
+from toshieth.constants import TRANSFER_TOPIC, DEPOSIT_TOPIC, WITHDRAWAL_TOPIC, WETH_CONTRACT_ADDRESS
+from toshieth.decode_benchmark import generate_logs, generic_decode_token_logs
+from toshieth.events import decode_token_logs, decode_transfer_log, decode_weth_log, ZERO_ADDRESS
+from toshieth.test.utils import random_address, random_hash
+
+def address_topic(address):
+    return "0x" + "0" * 24 + address[2:]
+
+def uint256_word(value):
+    return "{:064x}".format(value)
+
+def random_value():
+    return random.choice([0, 1, 10 ** 18, 2 ** 256 - 1, random.randrange(2 ** 256)])
+
+def transfer_log(contract_address, from_address, to_address, value, indexed=True, log_index=0):
+    if indexed:
+        topics = [TRANSFER_TOPIC, address_topic(from_address), address_topic(to_address)]
+        data = "0x" + uint256_word(value)
+    else:
+        topics = [TRANSFER_TOPIC]
+        data = "0x" + address_topic(from_address)[2:] + address_topic(to_address)[2:] + uint256_word(value)
+    return {"address": contract_address, "topics": topics, "data": data,
+            "transactionHash": random_hash(), "transactionLogIndex": hex(log_index)}
+
+def weth_log(topic, address, value, log_index=0):
+    return {"address": WETH_CONTRACT_ADDRESS, "topics": [topic, address_topic(address)],
+            "data": "0x" + uint256_word(value),
+            "transactionHash": random_hash(), "transactionLogIndex": hex(log_index)}
+
+def generic_decode_transfer_log(_log):
+    # how the logs were decoded before
+    if len(_log['topics']) == 3 and len(_log['data']) == 66:
+        return (decode_single(('address', '', []), data_decoder(_log['topics'][1])),
+                decode_single(('address', '', []), data_decoder(_log['topics'][2])),
+                decode_abi(['uint256'], data_decoder(_log['data']))[0])
+    elif len(_log['topics']) == 1 and len(_log['data']) == 194:
+        return tuple(decode_abi(['address', 'address', 'uint256'], data_decoder(_log['data'])))
+    return None
+
+class EventDecodingTest(unittest.TestCase):
+
+    def test_transfer_parity(self):
+
+        for _ in range(200):
+            _log = transfer_log(random_address(), random_address(), random_address(), random_value(),
+                                indexed=random.choice([True, False]))
+            self.assertEqual(decode_transfer_log(_log), generic_decode_transfer_log(_log))
+
+    def test_weth_parity(self):
+
+        for _ in range(100):
+            address = random_address()
+            value = random_value()
+            _log = weth_log(DEPOSIT_TOPIC, address, value)
+            self.assertEqual(decode_weth_log(_log), (
+                ZERO_ADDRESS, decode_single(('address', '', []), data_decoder(_log['topics'][1])),
+                decode_abi(['uint256'], data_decoder(_log['data']))[0]))
+            _log = weth_log(WITHDRAWAL_TOPIC, address, value)
+            self.assertEqual(decode_weth_log(_log), (
+                decode_single(('address', '', []), data_decoder(_log['topics'][1])), ZERO_ADDRESS,
+                decode_abi(['uint256'], data_decoder(_log['data']))[0]))
+
+    def test_invalid_transfer(self):
+
+        _log = transfer_log(random_address(), random_address(), random_address(), 1)
+        _log['topics'] = _log['topics'][:2]
+        self.assertIsNone(decode_transfer_log(_log))
+        self.assertIsNone(generic_decode_transfer_log(_log))
+
+    def test_decode_token_logs(self):
+
+        token_address = random_address()
+        unknown_token_address = random_address()
+        address = random_address()
+        logs_list = [
+            transfer_log(token_address, address, ZERO_ADDRESS, 100, log_index=0),
+            transfer_log(unknown_token_address, address, ZERO_ADDRESS, 100, log_index=1),
+            weth_log(DEPOSIT_TOPIC, address, 200, log_index=2),
+            transfer_log(token_address, ZERO_ADDRESS, address, 300, indexed=False, log_index=3),
+            # not a token event
+            {"address": token_address, "topics": [random_hash()], "data": "0x",
+             "transactionHash": random_hash(), "transactionLogIndex": "0x4"},
+            # anonymous event
+            {"address": token_address, "topics": [], "data": "0x",
+             "transactionHash": random_hash(), "transactionLogIndex": "0x5"},
+        ]
+        invalid_log = transfer_log(token_address, address, ZERO_ADDRESS, 100, log_index=6)
+        invalid_log['data'] = "0x"
+        logs_list.append(invalid_log)
+
+        transfers, invalid_logs = decode_token_logs(logs_list, {token_address})
+        self.assertEqual(transfers, [
+            (logs_list[0]['transactionHash'], token_address, 0, address, ZERO_ADDRESS, 100),
+            (logs_list[2]['transactionHash'], WETH_CONTRACT_ADDRESS, 2, ZERO_ADDRESS, address, 200),
+            (logs_list[3]['transactionHash'], token_address, 3, ZERO_ADDRESS, address, 300)])
+        self.assertEqual(invalid_logs, [invalid_log])
+
+    def test_decode_token_logs_parity(self):
+
+        logs_list, known_tokens = generate_logs(1000)
+        # leave some of the tokens out
+        known_tokens = set(list(known_tokens)[:15])
+        transfers, invalid_logs = decode_token_logs(logs_list, known_tokens)
+        self.assertEqual(transfers, generic_decode_token_logs(logs_list, known_tokens))
+        self.assertEqual(invalid_logs, [])
@@ -1,20 +1,98 @@
+import asyncio
+import unittest
 from tornado.escape import json_decode
 from tornado.testing import gen_test
 from toshieth.test.base import EthServiceBaseTest
 from toshi.test.redis import requires_redis
+from toshi.test.ethereum.parity import requires_parity
 from toshi.ethereum.tx import DEFAULT_GASPRICE
 
+from toshieth.gasprice import (
+    get_gas_price_oracle, set_gas_prices, combine_gas_prices, GasPriceEstimator, GAS_PRICE_CHANNEL
+)
+
+def make_block(number, gas_prices):
+    return {'number': hex(number), 'transactions': [{'gasPrice': hex(gas_price)} for gas_price in gas_prices]}
+
 class GasPriceTest(EthServiceBaseTest):
 
     @gen_test(timeout=15)
     @requires_redis
+    @requires_parity
     async def test_gas_station_gas_price(self):
 
+        # without a gas station price the node's gas price is used
+        node_gas_price = await self.eth.eth_gasPrice()
+        resp = await self.fetch("/gasprice")
+        self.assertResponseCodeEqual(resp, 200)
+        body = json_decode(resp.body)
+        self.assertEqual(body['gas_price'], hex(node_gas_price))
+
         gas_price = 50000000000
         assert(gas_price != DEFAULT_GASPRICE)
-        await self.redis.set("gas_station_standard_gas_price", hex(gas_price))
+        assert(gas_price != node_gas_price)
+        await set_gas_prices(self.redis, fast=hex(gas_price))
 
         resp = await self.fetch("/gasprice")
         self.assertResponseCodeEqual(resp, 200)
         body = json_decode(resp.body)
         self.assertEqual(body['gas_price'], hex(gas_price))
+
+class GasPriceOracleTest(EthServiceBaseTest):
+
+    @gen_test(timeout=15)
+    @requires_redis
+    async def test_gas_price_oracle(self):
+
+        oracle = get_gas_price_oracle()
+        self.assertIsNone(await oracle.get('fast'))
+
+        await set_gas_prices(self.redis, safelow=hex(10 * 10 ** 9), fast=hex(20 * 10 ** 9))
+        self.assertEqual(await oracle.get('safelow'), 10 * 10 ** 9)
+        self.assertEqual(await oracle.get('fast'), 20 * 10 ** 9)
+        self.assertIsNone(await oracle.get('standard'))
+
+        # changes made directly in redis aren't seen until they're published
+        await self.redis.set('gas_station_fast_gas_price', hex(30 * 10 ** 9))
+        self.assertEqual(await oracle.get('fast'), 20 * 10 ** 9)
+
+        await self.redis.publish(GAS_PRICE_CHANNEL, "changed")
+        for _ in range(10):
+            if await oracle.get('fast') != 20 * 10 ** 9:
+                break
+            await asyncio.sleep(0.1)
+        self.assertEqual(await oracle.get('fast'), 30 * 10 ** 9)
+
+class GasPriceEstimatorTest(unittest.TestCase):
+
+    def test_estimates(self):
+
+        estimator = GasPriceEstimator(window=2)
+        estimator.add_block(make_block(1, range(1, 41)))
+        # not enough transactions yet
+        self.assertIsNone(estimator.estimate())
+
+        estimator.add_block(make_block(2, [0] + list(range(41, 101))))
+        self.assertEqual(estimator.estimate(), {'safelow': 36, 'standard': 61, 'fast': 91})
+
+        # the first block drops out of the window
+        estimator.add_block(make_block(3, range(101, 141)))
+        self.assertEqual(estimator.prices, list(range(41, 141)))
+
+        # reorgs replace the blocks
+        estimator.add_block(make_block(3, range(141, 181)))
+        self.assertEqual(estimator.prices, list(range(41, 101)) + list(range(141, 181)))
+        estimator.remove_blocks_from(3)
+        self.assertEqual(estimator.prices, list(range(41, 101)))
+
+        # gaps larger than the window clear out the old blocks
+        estimator.add_block(make_block(10, range(1, 11)))
+        self.assertEqual(estimator.prices, list(range(1, 11)))
+
+    def test_combine_gas_prices(self):
+
+        self.assertEqual(combine_gas_prices({'safelow': 10, 'standard': 20, 'fast': 30},
+                                            {'safelow': 15, 'standard': None, 'fast': 25}),
+                         {'safelow': hex(15), 'standard': hex(20), 'fast': hex(30)})
+        self.assertEqual(combine_gas_prices({}, {'fast': 25}), {'fast': hex(25)})
+        self.assertEqual(combine_gas_prices({}, {}), {})
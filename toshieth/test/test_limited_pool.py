@@ -0,0 +1,67 @@
+import asyncio
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from toshieth.utils import LimitedPool
+
+class DummyAcquireContext:
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def __aenter__(self):
+        self.pool.in_use += 1
+        self.pool.max_in_use = max(self.pool.max_in_use, self.pool.in_use)
+        return self.pool
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.pool.in_use -= 1
+
+class DummyPool:
+
+    def __init__(self):
+        self.in_use = 0
+        self.max_in_use = 0
+
+    def acquire(self):
+        return DummyAcquireContext(self)
+
+class LimitedPoolTest(AsyncTestCase):
+
+    @gen_test(timeout=10)
+    async def test_limits_connections(self):
+
+        pool = DummyPool()
+        limited_pool = LimitedPool(pool, 3)
+
+        async def use_connection():
+            async with limited_pool.acquire():
+                await asyncio.sleep(0.01)
+
+        await asyncio.gather(*[use_connection() for _ in range(10)])
+
+        self.assertEqual(pool.max_in_use, 3)
+        self.assertEqual(pool.in_use, 0)
+        metrics = limited_pool.metrics()
+        self.assertEqual(metrics['acquired'], 10)
+        self.assertEqual(metrics['waiting'], 0)
+        self.assertGreaterEqual(metrics['max_waiting'], 7)
+        self.assertGreater(metrics['max_wait_time'], 0)
+
+        limited_pool.reset_metrics()
+        self.assertEqual(limited_pool.metrics()['acquired'], 0)
+
+    @gen_test(timeout=10)
+    async def test_releases_on_error(self):
+
+        pool = DummyPool()
+        limited_pool = LimitedPool(pool, 1)
+
+        with self.assertRaises(ValueError):
+            async with limited_pool.acquire():
+                raise ValueError()
+
+        # make sure the connection was given back
+        async with limited_pool.acquire():
+            self.assertEqual(pool.in_use, 1)
+        self.assertEqual(pool.in_use, 0)
@@ -0,0 +1,215 @@
+import asyncio
+import gc
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from toshi.jsonrpc.errors import JsonRPCError
+from toshieth.nodepool import JsonRPCClientPool, MAX_CONSECUTIVE_ERRORS, MIN_HEDGE_SAMPLES, MIN_ERROR_RATE_SAMPLES
+
+class DummyNode:
+
+    def __init__(self, name, delay=0, fail=False, flaky=False):
+        self.name = name
+        self.delay = delay
+        self.fail = fail
+        # fail every other request
+        self.flaky = flaky
+        self.calls = []
+
+    async def eth_blockNumber(self):
+        self.calls.append('eth_blockNumber')
+        await asyncio.sleep(self.delay)
+        if self.fail or (self.flaky and len(self.calls) % 2 == 0):
+            raise ConnectionRefusedError()
+        return self.name
+
+    async def eth_getBlockByNumber(self, block_number):
+        self.calls.append('eth_getBlockByNumber')
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise JsonRPCError(None, -32602, "Invalid params", None)
+        return {'number': hex(block_number)}
+
+    async def eth_sendRawTransaction(self, tx):
+        self.calls.append('eth_sendRawTransaction')
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise JsonRPCError(None, -32000, "Transaction nonce is too low", None)
+        return tx
+
+    def bulk(self):
+        return DummyBulk(self)
+
+class DummyBulk:
+
+    def __init__(self, node):
+        self.node = node
+        self.calls = []
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            future = asyncio.Future()
+            self.calls.append((getattr(self.node, name), args, kwargs, future))
+            return future
+        return call
+
+    async def execute(self):
+        results = []
+        for method, args, kwargs, future in self.calls:
+            result = await method(*args, **kwargs)
+            future.set_result(result)
+            results.append(result)
+        return results
+
+class NodePoolTest(AsyncTestCase):
+
+    @gen_test(timeout=10)
+    async def test_reads_go_to_fastest_node(self):
+
+        slow = DummyNode('slow', delay=0.05)
+        fast = DummyNode('fast', delay=0.001)
+        pool = JsonRPCClientPool([slow, fast], ['slow', 'fast'])
+
+        # make sure both have been tried
+        for _ in range(4):
+            await pool.eth_blockNumber()
+        self.assertTrue(slow.calls)
+
+        slow.calls = []
+        for _ in range(10):
+            self.assertEqual(await pool.eth_blockNumber(), 'fast')
+        self.assertEqual(slow.calls, [])
+
+    @gen_test(timeout=10)
+    async def test_failover(self):
+
+        broken = DummyNode('broken', fail=True)
+        working = DummyNode('working', delay=0.01)
+        pool = JsonRPCClientPool([broken, working], ['broken', 'working'])
+
+        for _ in range(MAX_CONSECUTIVE_ERRORS * 2):
+            self.assertEqual(await pool.eth_blockNumber(), 'working')
+        self.assertFalse(pool.stats[0].healthy)
+        self.assertTrue(pool.stats[1].healthy)
+
+    @gen_test(timeout=10)
+    async def test_flaky_node_taken_out_of_rotation(self):
+
+        flaky = DummyNode('flaky', flaky=True)
+        working = DummyNode('working', delay=0.01)
+        pool = JsonRPCClientPool([flaky, working], ['flaky', 'working'])
+
+        # the flaky node is faster, but never fails enough times in a
+        # row to be taken out of rotation for that
+        for _ in range(MIN_ERROR_RATE_SAMPLES * 2):
+            await pool.eth_blockNumber()
+        self.assertFalse(pool.stats[0].healthy)
+        self.assertGreater(pool.stats[0].error_rate, 0.25)
+        self.assertEqual(pool.ranked_nodes()[0], 1)
+
+        flaky.calls = []
+        for _ in range(5):
+            self.assertEqual(await pool.eth_blockNumber(), 'working')
+        self.assertEqual(flaky.calls, [])
+
+    @gen_test(timeout=10)
+    async def test_sticky(self):
+
+        first = DummyNode('first', delay=0.01)
+        second = DummyNode('second')
+        pool = JsonRPCClientPool([first, second], ['first', 'second'], sticky=True)
+
+        for _ in range(5):
+            self.assertEqual(await pool.eth_blockNumber(), 'first')
+        first.fail = True
+        self.assertEqual(await pool.eth_blockNumber(), 'second')
+        first.fail = False
+        # stays on the second node until it fails
+        self.assertEqual(await pool.eth_blockNumber(), 'second')
+
+    @gen_test(timeout=10)
+    async def test_bulk_failover(self):
+
+        broken = DummyNode('broken', fail=True)
+        working = DummyNode('working')
+        pool = JsonRPCClientPool([broken, working], ['broken', 'working'], sticky=True)
+
+        bulk = pool.bulk()
+        first = bulk.eth_blockNumber()
+        second = bulk.eth_blockNumber()
+        self.assertEqual(await bulk.execute(), ['working', 'working'])
+        self.assertEqual(first.result(), 'working')
+        self.assertEqual(second.result(), 'working')
+        self.assertEqual(broken.calls, ['eth_blockNumber'])
+        self.assertEqual(working.calls, ['eth_blockNumber', 'eth_blockNumber'])
+        # the sticky node moves on to the one that worked
+        self.assertEqual(pool.ranked_nodes()[0], 1)
+
+        working.fail = True
+        bulk = pool.bulk()
+        bulk.eth_blockNumber()
+        with self.assertRaises(ConnectionRefusedError):
+            await bulk.execute()
+
+    @gen_test(timeout=10)
+    async def test_hedged_reads(self):
+
+        node1 = DummyNode('node1', delay=0.005)
+        node2 = DummyNode('node2', delay=0.02)
+        pool = JsonRPCClientPool([node1, node2], ['node1', 'node2'], hedge=True)
+
+        # node1 is faster so gets all but the first few requests
+        for _ in range(MIN_HEDGE_SAMPLES * 2):
+            await pool.eth_blockNumber()
+        self.assertEqual(pool.ranked_nodes()[0], 0)
+
+        node1.delay = 1.0
+        start_time = asyncio.get_event_loop().time()
+        self.assertEqual(await pool.eth_blockNumber(), 'node2')
+        self.assertLess(asyncio.get_event_loop().time() - start_time, 0.5)
+
+    @gen_test(timeout=10)
+    async def test_hedged_read_request_errors(self):
+
+        node1 = DummyNode('node1', delay=0.005)
+        node2 = DummyNode('node2', delay=0.02)
+        pool = JsonRPCClientPool([node1, node2], ['node1', 'node2'], hedge=True)
+
+        for _ in range(MIN_HEDGE_SAMPLES * 2):
+            await pool.eth_getBlockByNumber(1)
+        self.assertEqual(pool.ranked_nodes()[0], 0)
+
+        errors = []
+        asyncio.get_event_loop().set_exception_handler(lambda loop, context: errors.append(context))
+
+        # the request itself fails after the hedged request has been sent
+        node1.delay = 0.2
+        node1.fail = True
+        node2.delay = 0.5
+        node2.fail = True
+        with self.assertRaises(JsonRPCError):
+            await pool.eth_getBlockByNumber(1)
+
+        # the hedged request's error is retrieved once it finishes
+        await asyncio.sleep(0.5)
+        gc.collect()
+        self.assertEqual(errors, [])
+
+    @gen_test(timeout=10)
+    async def test_writes_go_to_all_nodes(self):
+
+        nodes = [DummyNode('node{}'.format(i)) for i in range(3)]
+        pool = JsonRPCClientPool(nodes)
+
+        self.assertEqual(await pool.eth_sendRawTransaction("0x1234"), "0x1234")
+        for node in nodes:
+            self.assertEqual(node.calls, ['eth_sendRawTransaction'])
+
+        # if any node accepts the transaction, it's a success
+        nodes[0].fail = True
+        self.assertEqual(await pool.eth_sendRawTransaction("0x1234"), "0x1234")
+
+        for node in nodes:
+            node.fail = True
+        with self.assertRaises(JsonRPCError):
+            await pool.eth_sendRawTransaction("0x1234")
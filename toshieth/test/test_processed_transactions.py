@@ -0,0 +1,54 @@
+import unittest
+
+from toshieth.monitor import ProcessedTransactions
+from toshieth.test.utils import random_hash
+
+class ProcessedTransactionsTest(unittest.TestCase):
+
+    def test_pending_and_confirmed_are_separate(self):
+
+        processed = ProcessedTransactions()
+        tx_hash = random_hash()
+        processed.add(tx_hash, True, 1)
+
+        self.assertEqual(processed.get(tx_hash, True, 0), 1)
+        self.assertIsNone(processed.get(tx_hash, False, 0))
+
+        processed.add(tx_hash, False, 1)
+        self.assertEqual(processed.get(tx_hash, False, 0), 1)
+
+        processed.discard(tx_hash)
+        self.assertIsNone(processed.get(tx_hash, True, 0))
+        self.assertIsNone(processed.get(tx_hash, False, 0))
+
+    def test_drops_least_recently_used(self):
+
+        processed = ProcessedTransactions(size=3)
+        tx_hashes = [random_hash() for _ in range(4)]
+        for transaction_id, tx_hash in enumerate(tx_hashes[:3], 1):
+            processed.add(tx_hash, True, transaction_id)
+        # use the oldest so the second becomes the least recently used
+        self.assertEqual(processed.get(tx_hashes[0], True, 0), 1)
+        processed.add(tx_hashes[3], True, 4)
+
+        self.assertEqual(len(processed.transactions), 3)
+        self.assertEqual(processed.get(tx_hashes[0], True, 0), 1)
+        self.assertIsNone(processed.get(tx_hashes[1], True, 0))
+        self.assertEqual(processed.get(tx_hashes[3], True, 0), 4)
+
+    def test_uninteresting_depends_on_generation(self):
+
+        processed = ProcessedTransactions()
+        tx_hash = random_hash()
+        # can't tell when it becomes out of date without a generation
+        processed.add(tx_hash, True, False)
+        self.assertIsNone(processed.get(tx_hash, True, 1))
+
+        processed.add(tx_hash, True, False, 1)
+        self.assertIs(processed.get(tx_hash, True, 1), False)
+        self.assertIsNone(processed.get(tx_hash, True, None))
+        self.assertIsNone(processed.get(tx_hash, True, 1))
+
+        # transaction ids don't depend on the registrations
+        processed.add(tx_hash, True, 5)
+        self.assertEqual(processed.get(tx_hash, True, 2), 5)
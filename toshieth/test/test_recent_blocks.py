@@ -0,0 +1,40 @@
+import unittest
+
+from toshieth.monitor import RecentBlocks
+from toshieth.test.utils import random_hash
+
+class RecentBlocksTest(unittest.TestCase):
+
+    def test_drops_oldest_blocks(self):
+
+        recent_blocks = RecentBlocks(size=5)
+        parent_hash = random_hash()
+        for block_number in range(1, 11):
+            block_hash = random_hash()
+            recent_blocks.add(block_number, block_hash, parent_hash)
+            parent_hash = block_hash
+
+        self.assertEqual(sorted(recent_blocks.blocks), [6, 7, 8, 9, 10])
+        self.assertEqual(recent_blocks.lowest, 6)
+        self.assertFalse(recent_blocks.covers(5))
+        self.assertTrue(recent_blocks.covers(6))
+        # blocks that haven't been seen yet are covered
+        self.assertTrue(recent_blocks.covers(11))
+        self.assertIsNone(recent_blocks.get(11))
+        self.assertEqual(recent_blocks.get(10)['hash'], parent_hash)
+        self.assertEqual(recent_blocks.get(10)['parent_hash'], recent_blocks.get(9)['hash'])
+
+    def test_mark_stale(self):
+
+        recent_blocks = RecentBlocks(size=5)
+        for block_number in range(1, 4):
+            recent_blocks.add(block_number, random_hash(), random_hash())
+        recent_blocks.mark_stale(1)
+
+        self.assertFalse(recent_blocks.get(1)['stale'])
+        self.assertTrue(recent_blocks.get(2)['stale'])
+        self.assertTrue(recent_blocks.get(3)['stale'])
+
+        # replacing a stale block makes it current again
+        recent_blocks.add(2, random_hash(), recent_blocks.get(1)['hash'])
+        self.assertFalse(recent_blocks.get(2)['stale'])
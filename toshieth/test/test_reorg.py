@@ -72,6 +72,8 @@ class ReorgTest(EthServiceBaseTest):
                                       [(hash, 2) for hash in tx_hashes[-5:]])
                 await con.execute("UPDATE transactions SET blocknumber = $1 WHERE blocknumber IS NOT NULL",
                                   0)
+            # the monitor keeps the recent block hashes in memory
+            await monitor.recent_blocks.load(con)
 
         while monitor.last_block_number <= last_block:
             await asyncio.sleep(0.1)
@@ -0,0 +1,136 @@
+import asyncio
+import os
+
+from tornado.escape import json_decode, json_encode
+from tornado.testing import AsyncHTTPTestCase, gen_test
+from tornado.web import Application
+from tornado.websocket import WebSocketHandler
+
+from toshieth.subscriptions import NodeSubscription, NEW_HEADS, NEW_PENDING_TRANSACTIONS
+
+class StandInNodeHandler(WebSocketHandler):
+    """Implements just enough of a node's websocket interface to
+    test eth_subscribe"""
+
+    def open(self):
+        self.subscriptions = {}
+        self.application.settings['connections'].append(self)
+
+    def on_close(self):
+        self.application.settings['connections'].remove(self)
+
+    def on_message(self, message):
+        request = json_decode(message)
+        subscription_type = request['params'][0]
+        if request['method'] != 'eth_subscribe' or \
+           subscription_type not in self.application.settings['supported_subscriptions']:
+            self.write_message(json_encode({
+                "jsonrpc": "2.0", "id": request['id'],
+                "error": {"code": -32601, "message": "Method not found"}}))
+            return
+        subscription_id = "0x{}".format(os.urandom(16).hex())
+        self.subscriptions[subscription_type] = subscription_id
+        self.write_message(json_encode({"jsonrpc": "2.0", "id": request['id'], "result": subscription_id}))
+
+    def notify(self, subscription_type, result):
+        self.write_message(json_encode({
+            "jsonrpc": "2.0",
+            "method": "eth_subscription",
+            "params": {"subscription": self.subscriptions[subscription_type], "result": result}}))
+
+class NodeSubscriptionTest(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.connections = []
+        self.supported_subscriptions = [NEW_HEADS, NEW_PENDING_TRANSACTIONS]
+        return Application([(r"/", StandInNodeHandler)],
+                           connections=self.connections,
+                           supported_subscriptions=self.supported_subscriptions)
+
+    def create_subscription(self, **kwargs):
+        self.heads = asyncio.Queue()
+        self.pending_transactions = asyncio.Queue()
+        self.connection_lost = asyncio.Queue()
+        return NodeSubscription("ws://127.0.0.1:{}/".format(self.get_http_port()),
+                                self.heads.put_nowait,
+                                self.pending_transactions.put_nowait,
+                                on_connection_lost=lambda: self.connection_lost.put_nowait(True),
+                                **kwargs)
+
+    async def wait_for(self, condition):
+        while not condition():
+            await asyncio.sleep(0.01)
+
+    @gen_test(timeout=10)
+    async def test_new_heads_and_pending_transactions(self):
+
+        subscription = self.create_subscription()
+        subscription.start()
+        try:
+            await self.wait_for(lambda: subscription.heads_subscribed and subscription.pending_transactions_subscribed)
+
+            node = self.connections[0]
+            tx_hash = "0x{}".format(os.urandom(32).hex())
+            node.notify(NEW_HEADS, {"number": "0x10", "hash": "0x{}".format(os.urandom(32).hex())})
+            node.notify(NEW_PENDING_TRANSACTIONS, tx_hash)
+
+            head = await self.heads.get()
+            self.assertEqual(head['number'], "0x10")
+            self.assertEqual(await self.pending_transactions.get(), tx_hash)
+        finally:
+            await subscription.stop()
+
+    @gen_test(timeout=10)
+    async def test_pending_transactions_not_supported(self):
+
+        self.supported_subscriptions.remove(NEW_PENDING_TRANSACTIONS)
+        subscription = self.create_subscription()
+        subscription.start()
+        try:
+            await self.wait_for(lambda: subscription.heads_subscribed)
+            # give the node a chance to respond to the second subscription
+            await asyncio.sleep(0.1)
+            self.assertFalse(subscription.pending_transactions_subscribed)
+        finally:
+            await subscription.stop()
+
+    @gen_test(timeout=10)
+    async def test_reconnects_when_connection_lost(self):
+
+        subscription = self.create_subscription()
+        subscription.start()
+        try:
+            await self.wait_for(lambda: subscription.heads_subscribed)
+
+            self.connections[0].close()
+            await self.connection_lost.get()
+            self.assertFalse(subscription.heads_subscribed)
+            self.assertFalse(subscription.pending_transactions_subscribed)
+
+            await self.wait_for(lambda: subscription.heads_subscribed and subscription.pending_transactions_subscribed)
+            self.assertEqual(len(self.connections), 1)
+        finally:
+            await subscription.stop()
+
+    @gen_test(timeout=10)
+    async def test_reconnects_when_heads_stop(self):
+
+        subscription = self.create_subscription(head_timeout=1)
+        subscription.start()
+        try:
+            await self.wait_for(lambda: subscription.heads_subscribed and subscription.pending_transactions_subscribed)
+            node = self.connections[0]
+
+            # pending transactions don't count as the node being alive
+            for _ in range(4):
+                node.notify(NEW_PENDING_TRANSACTIONS, "0x{}".format(os.urandom(32).hex()))
+                await asyncio.sleep(0.1)
+            self.assertTrue(self.connection_lost.empty())
+
+            await self.connection_lost.get()
+            self.assertEqual(self.pending_transactions.qsize(), 4)
+            await self.wait_for(lambda: subscription.heads_subscribed and subscription.pending_transactions_subscribed)
+            self.assertEqual(len(self.connections), 1)
+            self.assertIsNot(self.connections[0], node)
+        finally:
+            await subscription.stop()
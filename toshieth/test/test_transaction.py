@@ -13,6 +13,7 @@ from toshi.request import sign_request
 from toshi.ethereum.utils import data_decoder, data_encoder
 from toshi.ethereum.tx import create_transaction, sign_transaction, decode_transaction, signature_from_transaction, encode_transaction, DEFAULT_STARTGAS, DEFAULT_GASPRICE
 from toshi.utils import parse_int
+from toshieth.gasprice import set_gas_prices
 
 TEST_PRIVATE_KEY = data_decoder("0xe8f32e723decf4051aefac8e2c93c9c5b214313817cdb01a1494b917c8436b35")
 TEST_ADDRESS = "0x056db290f8ba3250ca64a45d16284d04bc6f5fbf"
@@ -813,8 +814,7 @@ class TransactionTest(EthServiceBaseTest):
         self.assertEqual(tx['status'], 'queued')
 
         # fix up gas prices
-        await self.redis.set("gas_station_standard_gas_price", hex(safe_low_gas_price))
-        await self.redis.set("gas_station_safelow_gas_price", hex(too_low_gas_price))
+        await set_gas_prices(self.redis, standard=hex(safe_low_gas_price), safelow=hex(too_low_gas_price))
 
         manager_dispatcher.process_transaction_queue(FAUCET_ADDRESS)
 
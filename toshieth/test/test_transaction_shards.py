@@ -0,0 +1,24 @@
+import unittest
+
+from toshieth.monitor import transaction_shard
+from toshieth.test.utils import random_address
+
+class TransactionShardTest(unittest.TestCase):
+
+    def test_addresses_spread_over_shards(self):
+
+        addresses = [random_address() for _ in range(1000)]
+        shards = [transaction_shard(address, 4) for address in addresses]
+
+        self.assertEqual(set(shards), {0, 1, 2, 3})
+        for shard in range(4):
+            # should be roughly 250 in each
+            self.assertGreater(shards.count(shard), 150)
+
+        self.assertEqual(shards, [transaction_shard(address, 4) for address in addresses])
+
+    def test_shards_are_stable(self):
+        # the monitor and workers are different processes, so this can't
+        # depend on anything like python's randomised hash()
+        self.assertEqual(transaction_shard("0x0000000000000000000000000000000000000000", 4), 3)
+        self.assertEqual(transaction_shard("0x0000000000000000000000000000000000000000", 7), 1)
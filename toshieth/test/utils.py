@@ -0,0 +1,7 @@
+import os
+
+def random_address():
+    return "0x{}".format(os.urandom(20).hex())
+
+def random_hash():
+    return "0x{}".format(os.urandom(32).hex())
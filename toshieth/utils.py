@@ -30,6 +30,75 @@ class RedisLock:
         if self.locked:
             await get_redis_connection().delete(self.key)
 
+class LimitedPool:
+    """Wraps a database connection pool, limiting the number of connections
+    that can be acquired through it at once so that a single busy process
+    can't use up the whole pool.
+
+    Keeps track of how many callers are waiting for a connection and how
+    long they had to wait, see `metrics`.
+    """
+
+    def __init__(self, pool, limit):
+        self.pool = pool
+        self.limit = limit
+        self._semaphore = asyncio.Semaphore(limit)
+        self.waiting = 0
+        self.reset_metrics()
+
+    def acquire(self):
+        return LimitedPoolAcquireContext(self)
+
+    def reset_metrics(self):
+        self.max_waiting = 0
+        self.acquired = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def metrics(self):
+        """Returns the metrics collected since the last call to `reset_metrics`"""
+        return {
+            'limit': self.limit,
+            'waiting': self.waiting,
+            'max_waiting': self.max_waiting,
+            'acquired': self.acquired,
+            'average_wait_time': self.total_wait_time / self.acquired if self.acquired else 0.0,
+            'max_wait_time': self.max_wait_time
+        }
+
+class LimitedPoolAcquireContext:
+
+    def __init__(self, limited_pool):
+        self.limited_pool = limited_pool
+        self._acquire_context = None
+
+    async def __aenter__(self):
+        limited_pool = self.limited_pool
+        start_time = asyncio.get_event_loop().time()
+        limited_pool.waiting += 1
+        limited_pool.max_waiting = max(limited_pool.max_waiting, limited_pool.waiting)
+        try:
+            await limited_pool._semaphore.acquire()
+            try:
+                self._acquire_context = limited_pool.pool.acquire()
+                con = await self._acquire_context.__aenter__()
+            except:
+                limited_pool._semaphore.release()
+                raise
+        finally:
+            limited_pool.waiting -= 1
+        wait_time = asyncio.get_event_loop().time() - start_time
+        limited_pool.acquired += 1
+        limited_pool.total_wait_time += wait_time
+        limited_pool.max_wait_time = max(limited_pool.max_wait_time, wait_time)
+        return con
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        try:
+            await self._acquire_context.__aexit__(exc_type, exc_value, traceback)
+        finally:
+            self.limited_pool._semaphore.release()
+
 def database_transaction_to_rlp_transaction(transaction):
     """returns an rlp transaction for the given transaction"""
 
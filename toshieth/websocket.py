@@ -306,6 +306,10 @@ class WebsocketNotificationHandler:
                 except:
                     traceback.print_exc()
 
+    async def send_filter_notifications(self, notifications):
+        for filter_id, topic, data in notifications:
+            await self.send_filter_notification(filter_id, topic, data)
+
 class EthServiceWorker(Worker):
     def __init__(self):
         super().__init__([(WebsocketNotificationHandler, self)],